@@ -0,0 +1,2253 @@
+import datetime as dt
+import hashlib
+import imaplib
+import json
+import os
+import re
+import sqlite3
+from itertools import chain, islice
+from typing import Callable, Mapping
+
+import numpy as np
+import pandas as pd
+import pytz
+
+import metrics
+from archive import ResponseArchive
+from bookeo import BOOKEO_API, BookeoClient, BookeoError
+from db import Database
+from fill import fill_by_hour_of_week, fill_by_key, fill_rate
+from history import HistoryStore
+from refresh import RefreshCoordinator
+from resources import background_cache, process_resource, versioned_cache
+from roster import fetch_latest_attachment, read_roster
+from snapshot import ReportSnapshot
+from square import SQUARE_API, SquareClient
+
+ZULU_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+BOOKINGS_START = dt.date(year=2023, month=1, day=1)
+BOOKINGS_HORIZON = dt.timedelta(days=180)
+TIMEZONE = pytz.timezone("US/Eastern")
+# A PID in free text: nine digits, optionally grouped 3-3-3 by hyphens or
+# spaces
+PID = re.compile(r"(?<![\d-])(\d{3})[-\s]?(\d{3})[-\s]?(\d{3})(?![\d-])")
+# Tables a full resync rebuilds, and the fraction of their current rows it
+# must download before it replaces them
+STAGED_TABLES = ("bookings", "participants")
+MIN_RESYNC_RATIO = 0.9
+# Bookings that started in a month that ended this long ago are moved out
+# of the database to Parquet files (compact_history)
+HISTORY_AFTER = dt.timedelta(days=31)
+# Bookeo booking custom fields segmenting customers. Bookings without a
+# contact method field are classified by who made them.
+GROUP_CATEGORY_FIELD = "Group category"
+CONTACT_METHOD_FIELD = "Contact method"
+UNSPECIFIED = "Unspecified"
+# Report breakdown -> (bookings column, dimension table)
+SEGMENTS = {
+    "Group category": ("groupCategory", "groupCategories"),
+    "Contact method": ("contactMethod", "contactMethods"),
+}
+USER_AGENT = "CTE Sales Report Engine v0.1"
+# Setting (Streamlit secret or TOML key) -> environment variable read here.
+# SQUARE_API_KEY is optional, revenue is left out of reports without it,
+# and the IMAP settings are only needed to fetch the roster. ARCHIVE_PATH
+# and HISTORY_PATH default to bookeo-archive and history next to the
+# database. SQUARE_ITEMS is a table of Bookeo product name -> the Square
+# item name(s) it is sold as, for products sold under another name.
+CONFIG_KEYS = {
+    "BOOKEO_API_KEY": "BOOKEO_API_KEY",
+    "BOOKEO_SECRET_KEY": "BOOKEO_SECRET_KEY",
+    "SQUARE_API_KEY": "SQUARE_API_KEY",
+    "DATABASE_PATH": "DATABASE",
+    "IMAP_SERVER": "IMAP_SERVER",
+    "EMAIL": "EMAIL",
+    "EMAIL_PASSWORD": "EMAIL_PASSWORD",
+    "ROSTER_SUBJECT": "ROSTER_SUBJECT",
+    "ROSTER_SENDER": "ROSTER_SENDER",
+    "ARCHIVE_PATH": "BOOKEO_ARCHIVE",
+    "HISTORY_PATH": "BOOKINGS_HISTORY",
+    "SQUARE_ITEMS": "SQUARE_ITEMS",
+}
+REPORT_METRICS = {
+    "rooms_booked": "Rooms booked",
+    "slots_booked": "Slots booked",
+    "rooms_run": "Rooms run",
+    "slots_run": "Slots run",
+    "on_campus_booked": "On-campus slots booked",
+    "on_campus_run": "On-campus slots run",
+}
+# Columns of bookings loaded into the report snapshot
+SNAPSHOT_COLUMNS = (
+    "id",
+    "eventId",
+    "creationTime",
+    "startTime",
+    "endTime",
+    "canceled",
+    "productId",
+    "groupCategory",
+    "contactMethod",
+)
+# SQL expressions mapping a rollup day to the start of its bucket
+TREND_BUCKETS = {
+    "Day": "day",
+    "Week": "date(day, '-6 days', 'weekday 1')",
+    "Month": "strftime('%Y-%m-01', day)",
+}
+
+
+def configure(config: Mapping, override: bool = True):
+    # Copies the settings in config (st.secrets, a TOML table) to the
+    # environment. Without override, variables already set win.
+    os.environ["USER_AGENT"] = USER_AGENT
+    for key, var in CONFIG_KEYS.items():
+        if key in config and (override or var not in os.environ):
+            value = config[key]
+            # Tables are passed on as JSON
+            if isinstance(value, Mapping):
+                value = json.dumps(dict(value))
+            os.environ[var] = str(value)
+
+
+# Schema changes, applied in order. PRAGMA user_version records how many
+# have been applied to a database file.
+MIGRATIONS = [
+    # 1: initial schema
+    """CREATE TABLE IF NOT EXISTS bookings (
+        id INT PRIMARY KEY,
+        eventId INT NOT NULL,
+        startTime TEXT NOT NULL,
+        endTime TEXT NOT NULL,
+        customerId TEXT,
+        title TEXT,
+        canceled INT NOT NULL CHECK(canceled=0 OR canceled=1),
+        accepted INT NOT NULL CHECK(accepted=0 OR accepted=1),
+        sourceIP TEXT,
+        creationTime TEXT NOT NULL,
+        privateEvent INT NOT NULL CHECK(privateEvent=0 OR privateEvent=1),
+        noShow INT NOT NULL CHECK(noShow=0 OR noShow=1),
+        productId TEXT NOT NULL,
+        creationAgent TEXT,
+        FOREIGN KEY(productId) REFERENCES products(id));
+    CREATE TABLE IF NOT EXISTS participants (
+        bookingId INT NOT NULL,
+        firstName TEXT,
+        lastName TEXT,
+        peopleCategory TEXT,
+        pid INT,
+        FOREIGN KEY(peopleCategory) REFERENCES peopleCategories(id),
+        FOREIGN KEY(bookingId) REFERENCES bookings(id));
+    CREATE TABLE IF NOT EXISTS peopleCategories (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS products (
+        id TEXT PRIMARY KEY,
+        name TEXT);
+    CREATE TABLE IF NOT EXISTS onCampusPids (
+        pid INT PRIMARY KEY,
+        firstName TEXT,
+        lastName TEXT);
+    CREATE TABLE IF NOT EXISTS syncState (
+        key TEXT PRIMARY KEY,
+        value TEXT);""",
+    # 2: times as unix epoch seconds, booking id as the rowid, and indexes
+    # covering the report queries
+    """CREATE TABLE bookings_v2 (
+        id INTEGER PRIMARY KEY,
+        eventId INT NOT NULL,
+        startTime INT NOT NULL,
+        endTime INT NOT NULL,
+        customerId TEXT,
+        title TEXT,
+        canceled INT NOT NULL CHECK(canceled=0 OR canceled=1),
+        accepted INT NOT NULL CHECK(accepted=0 OR accepted=1),
+        sourceIP TEXT,
+        creationTime INT NOT NULL,
+        privateEvent INT NOT NULL CHECK(privateEvent=0 OR privateEvent=1),
+        noShow INT NOT NULL CHECK(noShow=0 OR noShow=1),
+        productId TEXT NOT NULL,
+        creationAgent TEXT,
+        FOREIGN KEY(productId) REFERENCES products(id));
+    INSERT INTO bookings_v2 SELECT id, eventId,
+        CAST(strftime('%s', startTime) AS INT),
+        CAST(strftime('%s', endTime) AS INT),
+        customerId, title, canceled, accepted, sourceIP,
+        CAST(strftime('%s', creationTime) AS INT),
+        privateEvent, noShow, productId, creationAgent
+        FROM bookings;
+    DROP TABLE bookings;
+    ALTER TABLE bookings_v2 RENAME TO bookings;
+    CREATE INDEX bookingsByStart ON bookings(startTime, productId, canceled);
+    CREATE INDEX bookingsByCreation ON bookings(creationTime, productId, canceled);
+    CREATE INDEX participantsByBooking ON participants(bookingId, peopleCategory);""",
+    # 3: per-day rollups for trend reports
+    """CREATE TABLE dailyRollup (
+        day TEXT NOT NULL,
+        productId TEXT NOT NULL,
+        peopleCategory TEXT NOT NULL,
+        roomsBooked INT NOT NULL DEFAULT 0,
+        slotsBooked INT NOT NULL DEFAULT 0,
+        onCampusBooked INT NOT NULL DEFAULT 0,
+        roomsRun INT NOT NULL DEFAULT 0,
+        slotsRun INT NOT NULL DEFAULT 0,
+        onCampusRun INT NOT NULL DEFAULT 0,
+        PRIMARY KEY(day, productId, peopleCategory)) WITHOUT ROWID;""",
+    # 4: participant PIDs as normalized integers, matched against the roster
+    # once at ingest/roster load instead of on every report
+    lambda cur: normalize_pids(cur),
+    # 5: Square payments and orders, amounts in integer cents, and per-day
+    # revenue rollups. Return line items are stored negated.
+    """CREATE TABLE squarePayments (
+        id TEXT PRIMARY KEY,
+        orderId TEXT,
+        locationId TEXT,
+        status TEXT NOT NULL,
+        createdAt INT NOT NULL,
+        updatedAt INT NOT NULL,
+        amount INT NOT NULL,
+        tip INT NOT NULL,
+        refunded INT NOT NULL,
+        currency TEXT);
+    CREATE INDEX squarePaymentsByCreation
+        ON squarePayments(status, createdAt, amount, refunded);
+    CREATE TABLE squareOrders (
+        id TEXT PRIMARY KEY,
+        locationId TEXT,
+        state TEXT NOT NULL,
+        createdAt INT NOT NULL,
+        updatedAt INT NOT NULL,
+        closedAt INT);
+    CREATE INDEX squareOrdersByClose ON squareOrders(state, closedAt);
+    CREATE TABLE squareOrderLines (
+        orderId TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        name TEXT,
+        catalogObjectId TEXT,
+        quantity REAL NOT NULL,
+        grossSales INT NOT NULL,
+        discount INT NOT NULL,
+        tax INT NOT NULL,
+        total INT NOT NULL,
+        PRIMARY KEY(orderId, uid)) WITHOUT ROWID;
+    CREATE TABLE dailyRevenue (
+        day TEXT NOT NULL,
+        product TEXT NOT NULL,
+        orders INT NOT NULL DEFAULT 0,
+        netSales INT NOT NULL DEFAULT 0,
+        collected INT NOT NULL DEFAULT 0,
+        refunded INT NOT NULL DEFAULT 0,
+        PRIMARY KEY(day, product)) WITHOUT ROWID;""",
+    # 6: slots offered per product, from Bookeo availability, for fill
+    # rates. capacity is the seats a slot offered when last synced, and a
+    # product's capacity the most any of its slots offered.
+    """CREATE TABLE slots (
+        eventId INT PRIMARY KEY,
+        productId TEXT NOT NULL,
+        startTime INT NOT NULL,
+        endTime INT NOT NULL,
+        capacity INT NOT NULL);
+    CREATE INDEX slotsByStart
+        ON slots(startTime, productId, endTime, capacity, eventId);
+    CREATE INDEX slotsByProduct ON slots(productId, capacity);
+    CREATE INDEX bookingsByEvent ON bookings(eventId);
+    ALTER TABLE products ADD COLUMN capacity INT;""",
+    # 7: customer segments, classified at ingest into dimension tables. The
+    # booking indexes and the rollup gain the group category for its
+    # filter (0 in the rollup for all groups). Stored bookings lack the
+    # fields to classify them, so the next sync reloads them all.
+    """CREATE TABLE groupCategories (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE COLLATE NOCASE);
+    CREATE TABLE contactMethods (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE COLLATE NOCASE);
+    ALTER TABLE bookings
+        ADD COLUMN groupCategory INT REFERENCES groupCategories(id);
+    ALTER TABLE bookings
+        ADD COLUMN contactMethod INT REFERENCES contactMethods(id);
+    DROP INDEX bookingsByStart;
+    DROP INDEX bookingsByCreation;
+    CREATE INDEX bookingsByStart
+        ON bookings(startTime, productId, canceled, groupCategory);
+    CREATE INDEX bookingsByCreation
+        ON bookings(creationTime, productId, canceled, groupCategory);
+    DROP TABLE dailyRollup;
+    CREATE TABLE dailyRollup (
+        day TEXT NOT NULL,
+        productId TEXT NOT NULL,
+        peopleCategory TEXT NOT NULL,
+        groupCategory INT NOT NULL,
+        roomsBooked INT NOT NULL DEFAULT 0,
+        slotsBooked INT NOT NULL DEFAULT 0,
+        onCampusBooked INT NOT NULL DEFAULT 0,
+        roomsRun INT NOT NULL DEFAULT 0,
+        slotsRun INT NOT NULL DEFAULT 0,
+        onCampusRun INT NOT NULL DEFAULT 0,
+        PRIMARY KEY(day, productId, peopleCategory, groupCategory)) WITHOUT ROWID;
+    DELETE FROM syncState WHERE key='bookingsLastUpdated';""",
+    # 8: bookings of closed months moved to Parquet files by compact_history,
+    # with their participants. historyPartitions lists the files in use and
+    # the range of times in each, historyBookings which one each booking
+    # moved to.
+    """CREATE TABLE historyPartitions (
+        id INTEGER PRIMARY KEY,
+        month TEXT NOT NULL,
+        name TEXT NOT NULL,
+        bookings INT NOT NULL,
+        participants INT NOT NULL,
+        firstStart INT NOT NULL,
+        lastStart INT NOT NULL,
+        firstCreation INT NOT NULL,
+        lastCreation INT NOT NULL);
+    CREATE INDEX historyPartitionsByMonth ON historyPartitions(month);
+    CREATE TABLE historyBookings (
+        id INTEGER PRIMARY KEY,
+        partitionId INT NOT NULL REFERENCES historyPartitions(id));
+    CREATE INDEX historyBookingsByPartition ON historyBookings(partitionId);""",
+    # 9: participantsByBooking covers the rollup's joins, which also read
+    # onCampus (added by 4)
+    """DROP INDEX participantsByBooking;
+    CREATE INDEX participantsByBooking
+        ON participants(bookingId, peopleCategory, onCampus);""",
+    # 10: PIDs normalized by gluing together every digit in the field, too
+    # long to be one, are unknown
+    """UPDATE participants SET pid=NULL, onCampus=0 WHERE pid > 999999999;
+    DELETE FROM onCampusPids WHERE pid > 999999999;""",
+]
+
+
+def migrate_db(connection: sqlite3.Connection):
+    # Brings an existing database up to date, keeping its data. A new file
+    # starts at version 0 and gets every migration.
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(MIGRATIONS):
+        raise RuntimeError(
+            f"Database schema version {version} is newer than this code's "
+            f"({len(MIGRATIONS)})"
+        )
+    if version == 0:
+        # Files from before versioned schemas, which the app emptied on
+        # every start, can hold tables of any older shape. Nothing in them
+        # is worth keeping, so they start over rather than be migrated.
+        tables = connection.execute(
+            """SELECT name FROM sqlite_schema
+            WHERE type='table' AND name NOT LIKE 'sqlite_%'"""
+        ).fetchall()
+        if tables:
+            drops = "".join(f'DROP TABLE "{name}"; ' for (name,) in tables)
+            connection.executescript(f"BEGIN; {drops}COMMIT;")
+    history = connection.execute(
+        "SELECT 1 FROM sqlite_schema WHERE name='historyPartitions'"
+    ).fetchone()
+    if version < len(MIGRATIONS) and history:
+        # History files keep the schema they were written with, so their
+        # rows come back into the tables the migrations change
+        cur = connection.cursor()
+        cur.execute("BEGIN")
+        thaw_partitions(cur)
+        connection.commit()
+        cur.close()
+    for v in range(version, len(MIGRATIONS)):
+        migration = MIGRATIONS[v]
+        try:
+            if callable(migration):
+                # Data migrations that need Python
+                cur = connection.cursor()
+                cur.execute("BEGIN")
+                migration(cur)
+                cur.execute(f"PRAGMA user_version = {v + 1}")
+                connection.commit()
+                cur.close()
+            else:
+                connection.executescript(
+                    f"BEGIN; {migration} PRAGMA user_version = {v + 1}; COMMIT;"
+                )
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+    if version < len(MIGRATIONS):
+        # Rollups are derived data, rebuild them against the new schema
+        cur = connection.cursor()
+        refresh_rollup(cur)
+        refresh_revenue(cur)
+        snapshot_changed(cur)
+        connection.commit()
+        cur.close()
+        connection.execute("ANALYZE")
+
+
+def normalize_pids(cur: sqlite3.Cursor):
+    cur.execute("ALTER TABLE participants ADD COLUMN onCampus INT NOT NULL DEFAULT 0")
+    for table in ("participants", "onCampusPids"):
+        rows = cur.execute(
+            f"SELECT rowid, pid FROM {table} WHERE typeof(pid) NOT IN ('integer', 'null')"
+        ).fetchall()
+        cur.executemany(
+            f"UPDATE OR IGNORE {table} SET pid=? WHERE rowid=?",
+            [(normalize_pid(pid), rowid) for rowid, pid in rows],
+        )
+    cur.execute("CREATE INDEX participantsByPid ON participants(pid)")
+    cur.execute(
+        "UPDATE participants SET onCampus=1 WHERE pid IN (SELECT pid FROM onCampusPids)"
+    )
+
+
+def init_db() -> Database:
+    # Opens the database left by the last run, or creates it. Synced data
+    # persists across restarts, and each sync resumes from its stored marks.
+    db = Database(os.environ["DATABASE"])
+    with db.write() as conn:
+        migrate_db(conn)
+    return db
+
+
+@process_resource
+def get_db() -> Database:
+    # Once per process, not on every rerun of this script
+    return init_db()
+
+
+@process_resource
+def get_bookeo() -> BookeoClient:
+    return BookeoClient(
+        os.environ["BOOKEO_API_KEY"],
+        os.environ["BOOKEO_SECRET_KEY"],
+        os.environ["USER_AGENT"],
+        base_url=os.environ.get("BOOKEO_API_URL", BOOKEO_API),
+    )
+
+
+@process_resource
+def get_roster_refresher() -> RefreshCoordinator:
+    return RefreshCoordinator(
+        fetch_roster, dt.timedelta(hours=12), last_synced=synced_at("rosterFetched")
+    )
+
+
+def fetch_roster():
+    # https://gist.github.com/kngeno/5337e543eb72174a6ac95e028b3b6456
+    with metrics.timer("imap_command_duration_seconds", command="connect"):
+        imap = imaplib.IMAP4_SSL(os.environ["IMAP_SERVER"], port=993)
+    with metrics.TimedIMAP(imap) as imap:
+        val, _ = imap.login(os.environ["EMAIL"], os.environ["EMAIL_PASSWORD"])
+        if val != "OK":
+            return
+
+        imap.select("Inbox", readonly=True)
+        data = fetch_latest_attachment(
+            imap,
+            f'(FROM "{os.environ["ROSTER_SENDER"]}" SUBJECT "{os.environ["ROSTER_SUBJECT"]}")',
+        )
+    if data is None:
+        print("Could not find roster")
+        return
+    load_roster(data)
+    mark_synced("rosterFetched")
+
+
+def load_roster(data: bytes):
+    # Applies a roster CSV as a diff against onCampusPids. Skipped entirely
+    # when the attachment is byte-identical to the last one loaded.
+    with get_db().write() as conn:
+        cur = conn.cursor()
+        try:
+            digest = hashlib.sha256(data).hexdigest()
+            if get_sync_state(cur, "rosterHash") == digest:
+                return
+            cur.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS rosterImport (
+                pid INT PRIMARY KEY,
+                firstName TEXT,
+                lastName TEXT)"""
+            )
+            cur.execute("DELETE FROM rosterImport")
+            # The roster may contain duplicate entries... let's ignore them
+            q = """INSERT OR IGNORE INTO rosterImport (pid, firstName, lastName)
+                VALUES (?, ?, ?)"""
+            try:
+                for batch in read_roster(data):
+                    batch = [(normalize_pid(r[0]), r[1], r[2]) for r in batch]
+                    cur.executemany(q, [r for r in batch if r[0] is not None])
+            except ValueError as e:
+                print(e)
+                conn.rollback()
+                return
+
+            # PIDs joining or leaving the roster are the only participants whose
+            # onCampus flag, and so whose rollup days, change
+            cur.execute(
+                """CREATE TEMP TABLE IF NOT EXISTS rosterChanges (
+                pid INT PRIMARY KEY,
+                onCampus INT NOT NULL)"""
+            )
+            cur.execute("DELETE FROM rosterChanges")
+            cur.execute(
+                """INSERT INTO rosterChanges (pid, onCampus)
+                SELECT pid, 0 FROM onCampusPids
+                WHERE pid NOT IN (SELECT pid FROM rosterImport)
+                UNION ALL
+                SELECT pid, 1 FROM rosterImport
+                WHERE pid NOT IN (SELECT pid FROM onCampusPids)"""
+            )
+            cur.execute(
+                "DELETE FROM onCampusPids WHERE pid NOT IN (SELECT pid FROM rosterImport)"
+            )
+            cur.execute(
+                """INSERT INTO onCampusPids (pid, firstName, lastName)
+                SELECT pid, firstName, lastName FROM rosterImport WHERE true
+                ON CONFLICT(pid) DO UPDATE SET
+                firstName=excluded.firstName, lastName=excluded.lastName
+                WHERE firstName IS NOT excluded.firstName
+                OR lastName IS NOT excluded.lastName"""
+            )
+            cur.execute(
+                """UPDATE participants SET onCampus=c.onCampus
+                FROM rosterChanges c WHERE participants.pid=c.pid
+                AND participants.pid IN (SELECT pid FROM rosterChanges)"""
+            )
+            touched = cur.execute(
+                """SELECT DISTINCT b.startTime, b.creationTime
+                FROM rosterChanges c
+                CROSS JOIN participants p ON p.pid=c.pid
+                CROSS JOIN bookings b ON b.id=p.bookingId"""
+            ).fetchall()
+            # Compacted participants' flags are computed when read, but
+            # their rollup days change too
+            partitions = cur.execute("SELECT id, month, name FROM historyPartitions")
+            partitions = partitions.fetchall()
+            if partitions:
+                changed = [
+                    pid for (pid,) in cur.execute("SELECT pid FROM rosterChanges")
+                ]
+                p = history_frame(partitions, "participants", ("bookingId", "pid"))
+                b = history_frame(
+                    partitions, "bookings", ("id", "startTime", "creationTime")
+                )
+                b = b[b.id.isin(p.bookingId[p.pid.isin(changed)])]
+                touched += zip(b.startTime.tolist(), b.creationTime.tolist())
+            refresh_rollup(cur, {local_day(t) for row in touched for t in row})
+            if cur.execute("SELECT 1 FROM rosterChanges LIMIT 1").fetchone():
+                snapshot_changed(cur)
+            set_sync_state(cur, "rosterHash", digest)
+            conn.commit()
+        finally:
+            cur.close()
+
+
+@process_resource
+def get_square() -> SquareClient:
+    if not os.environ.get("SQUARE_API_KEY"):
+        return None
+    return SquareClient(
+        os.environ["SQUARE_API_KEY"],
+        os.environ["USER_AGENT"],
+        base_url=os.environ.get("SQUARE_API_URL", SQUARE_API),
+    )
+
+
+@process_resource
+def get_bookings_refresher() -> RefreshCoordinator:
+    return RefreshCoordinator(
+        update_bookings,
+        dt.timedelta(hours=1),
+        last_synced=synced_at("bookingsLastUpdated"),
+    )
+
+
+def update_bookings(full_resync: bool = False, replay: bool = False):
+    # https://www.bookeo.com/apiref/#tag/Bookings/paths/~1bookings/get
+    with get_db().read() as conn:
+        last_updated = get_sync_state(conn.cursor(), "bookingsLastUpdated")
+    if replay:
+        rebuild_bookings(offline=True)
+    elif full_resync:
+        # Downloads everything again, to repair drift even in closed months
+        rebuild_bookings(redownload=True)
+    elif last_updated is None:
+        rebuild_bookings()
+    else:
+        sync_bookings(dt.datetime.strptime(last_updated, ZULU_FORMAT))
+
+
+def sync_bookings(since: dt.datetime):
+    # Incremental: only bookings created/changed since the last sync, in one
+    # transaction. Readers keep seeing the last committed bookings until it
+    # commits.
+    with get_db().write() as conn:
+        cur = conn.cursor()
+        try:
+            sync_time = dt.datetime.now(dt.timezone.utc)
+            pages = get_bookeo().get_all(
+                "bookings",
+                booking_windows(
+                    since,
+                    sync_time.replace(tzinfo=None),
+                    ("lastUpdatedStartTime", "lastUpdatedEndTime"),
+                ),
+                on_page=archive_pages("updates", sync_time.strftime(ZULU_FORMAT)),
+                expandParticipants=True,
+                includeCanceled=True,
+                itemsPerPage=100,
+            )
+            try:
+                days = ingest_bookings(cur, pages)
+            except BookeoError:
+                # Leave the high-water mark where it is so the next sync
+                # retries the same window
+                conn.rollback()
+                raise
+
+            refresh_rollup(cur, days)
+            if days:
+                snapshot_changed(cur)
+            set_sync_state(cur, "bookingsLastUpdated", sync_time.strftime(ZULU_FORMAT))
+            conn.commit()
+            cur.execute("PRAGMA optimize")
+        finally:
+            cur.close()
+
+
+def rebuild_bookings(offline: bool = False, redownload: bool = False):
+    # Full reload of every booking since BOOKINGS_START, including those
+    # already booked for the coming months. Rows go into staging tables,
+    # committed batch by batch so other writers aren't locked out for the
+    # whole download, and replace the live tables in one transaction once
+    # complete. Until then readers query the previous snapshot, which a
+    # failed download leaves in place.
+    # Blocks that had already ended when they were archived aren't
+    # downloaded again. They are replayed from the archive, with the
+    # incremental syncs archived since, in the order they were fetched.
+    # Then the changes since the last of those and the remaining blocks are
+    # downloaded. Offline, everything is replayed from the archive and
+    # nothing is downloaded. With redownload, nothing is replayed and every
+    # block is downloaded (and archived) again.
+    db = get_db()
+    sync_time = dt.datetime.now(dt.timezone.utc).strftime(ZULU_FORMAT)
+    archive = get_archive()
+    # Latest complete fetch of each window
+    archived = {
+        json.dumps(f["window"], sort_keys=True): f for f in archive.fetches("blocks")
+    }
+    windows = []
+    if offline:
+        replayed = list(archived.values())
+    else:
+        replayed = []
+        for window in booking_windows(
+            dt.datetime.combine(BOOKINGS_START, dt.time(0, 0, 0)),
+            dt.datetime.now() + BOOKINGS_HORIZON,
+            ("startTime", "endTime"),
+        ):
+            fetch = (
+                None if redownload else archived.get(json.dumps(window, sort_keys=True))
+            )
+            if fetch is not None and window["endTime"] <= fetch["fetched"]:
+                replayed.append(fetch)
+            else:
+                windows.append(window)
+    if replayed:
+        oldest = min(f["fetched"] for f in replayed)
+        replayed += [f for f in archive.fetches("updates") if f["fetched"] >= oldest]
+        replayed.sort(key=lambda f: f["fetched"])
+    if offline:
+        if not replayed:
+            print("No archived bookings to replay")
+            return
+        # The data is as of the last fetch replayed
+        sync_time = replayed[-1]["fetched"]
+
+    with db.write() as conn:
+        roster = get_sync_state(conn.cursor(), "rosterHash")
+        create_staging(conn)
+    pages = (
+        archive.get(digest).get("data", []) for f in replayed for digest in f["digests"]
+    )
+    if replayed and not offline:
+        pages = chain(
+            pages,
+            get_bookeo().get_all(
+                "bookings",
+                booking_windows(
+                    dt.datetime.strptime(replayed[-1]["fetched"], ZULU_FORMAT),
+                    dt.datetime.strptime(sync_time, ZULU_FORMAT),
+                    ("lastUpdatedStartTime", "lastUpdatedEndTime"),
+                ),
+                on_page=archive_pages("updates", sync_time),
+                expandParticipants=True,
+                includeCanceled=True,
+                itemsPerPage=100,
+            ),
+        )
+    if windows:
+        pages = chain(
+            pages,
+            get_bookeo().get_all(
+                "bookings",
+                windows,
+                on_page=archive_pages("blocks", sync_time),
+                expandParticipants=True,
+                includeCanceled=True,
+                itemsPerPage=100,
+            ),
+        )
+    try:
+        for batch in booking_batches(pages):
+            with db.write() as conn:
+                upsert_bookings(conn.cursor(), batch, track_days=False, staging=True)
+                conn.commit()
+    except (BookeoError, OSError):
+        with db.write() as conn:
+            drop_staging(conn)
+        raise
+
+    with db.write() as conn:
+        cur = conn.cursor()
+        try:
+            problem = validate_staging(cur)
+            if problem:
+                print(f"Keeping the previous bookings: {problem}")
+                drop_staging(conn)
+                return
+            cur.execute("BEGIN")
+            if get_sync_state(cur, "rosterHash") != roster:
+                # The roster changed mid-download, so some staged onCampus
+                # flags were computed against the old one
+                cur.execute(
+                    """UPDATE participantsStaging SET onCampus=EXISTS(
+                    SELECT 1 FROM onCampusPids o WHERE o.pid=participantsStaging.pid)"""
+                )
+            swap_staging(cur)
+            refresh_rollup(cur)
+            snapshot_changed(cur)
+            set_sync_state(cur, "bookingsLastUpdated", sync_time)
+            conn.commit()
+            # Statistics for the new tables, sampled to keep this quick
+            cur.execute("PRAGMA analysis_limit = 1000")
+            cur.execute("ANALYZE")
+        finally:
+            cur.close()
+
+
+@process_resource
+def get_archive() -> ResponseArchive:
+    # Raw Bookeo bookings pages, next to the database unless configured
+    root = os.environ.get("BOOKEO_ARCHIVE") or os.path.join(
+        os.path.dirname(os.path.abspath(os.environ["DATABASE"])), "bookeo-archive"
+    )
+    return ResponseArchive(root)
+
+
+def archive_pages(kind: str, fetched: str) -> Callable:
+    # get_all's on_page for bookings: archives each raw page as part of
+    # the fetch of its window at time fetched. kind is "blocks" for windows
+    # of start times, "updates" for windows of last changes.
+    archive = get_archive()
+
+    def on_page(window: dict, number: int, total: int, page: dict):
+        archive.record(
+            kind=kind,
+            fetched=fetched,
+            window=window,
+            page=number,
+            pages=total,
+            digest=archive.put(page),
+        )
+
+    return on_page
+
+
+@process_resource
+def get_history() -> HistoryStore:
+    # Compacted bookings, next to the database unless configured
+    root = os.environ.get("BOOKINGS_HISTORY") or os.path.join(
+        os.path.dirname(os.path.abspath(os.environ["DATABASE"])), "history"
+    )
+    return HistoryStore(root)
+
+
+@process_resource
+def get_history_refresher() -> RefreshCoordinator:
+    return RefreshCoordinator(
+        compact_history,
+        dt.timedelta(hours=24),
+        last_synced=synced_at("historyCompacted"),
+    )
+
+
+def compact_history():
+    # Moves the bookings that started in months that ended HISTORY_AFTER
+    # ago, and their participants, from the tables to a Parquet file per
+    # month, a month per transaction. Reports read the tables and the
+    # files listed in historyPartitions together, so each month is counted
+    # once whichever side it's on. Compacted rows are never changed in
+    # place: a booking Bookeo changes moves its month back into the tables
+    # (thaw_partitions) until the next compaction.
+    db = get_db()
+    cutoff = (dt.datetime.now(TIMEZONE).date() - HISTORY_AFTER).replace(day=1)
+    with db.read() as conn:
+        (first,) = conn.execute("SELECT MIN(startTime) FROM bookings").fetchone()
+    month = first and dt.date.fromisoformat(local_day(first)).replace(day=1)
+    while month and month < cutoff:
+        following = (month + dt.timedelta(days=32)).replace(day=1)
+        with db.write() as conn:
+            cur = conn.cursor()
+            try:
+                # Immediate, so no other process writes between reading the
+                # month's rows and deleting them
+                cur.execute("BEGIN IMMEDIATE")
+                compact_month(cur, month, following)
+                conn.commit()
+            finally:
+                cur.close()
+        month = following
+    with db.write() as conn:
+        # The first compaction frees most of the file, later ones reuse
+        # what they free
+        pages, free = conn.execute(
+            "SELECT * FROM pragma_page_count, pragma_freelist_count"
+        ).fetchone()
+        if free > pages / 2:
+            conn.execute("VACUUM")
+        names = {name for (name,) in conn.execute("SELECT name FROM historyPartitions")}
+    get_history().collect_garbage(names)
+    mark_synced("historyCompacted")
+
+
+def compact_month(cur: sqlite3.Cursor, month: dt.date, following: dt.date):
+    # Writes the bookings starting in [month, following) to a new file,
+    # lists it and deletes them, within the caller's transaction. A month
+    # compacted before, then given late or changed bookings, is rewritten
+    # whole into one file.
+    params = dict(
+        zip(("start", "end"), day_range(month, following - dt.timedelta(days=1)))
+    )
+    params["month"] = month.strftime("%Y-%m")
+    in_month = "b.startTime >= :start AND b.startTime < :end"
+    if not cur.execute(
+        f"SELECT 1 FROM bookings b WHERE {in_month} LIMIT 1", params
+    ).fetchone():
+        return
+    thaw_partitions(
+        cur,
+        [
+            id
+            for (id,) in cur.execute(
+                "SELECT id FROM historyPartitions WHERE month=:month", params
+            )
+        ],
+    )
+    tables = {}
+    for table, q in (
+        ("bookings", f"SELECT * FROM bookings b WHERE {in_month} ORDER BY b.id"),
+        (
+            "participants",
+            f"""SELECT p.* FROM bookings b JOIN participants p ON p.bookingId=b.id
+            WHERE {in_month} ORDER BY p.bookingId""",
+        ),
+    ):
+        rows = cur.execute(q, params).fetchall()
+        tables[table] = ([c[0] for c in cur.description], rows)
+    params["name"] = get_history().write(params["month"], tables)
+    params["participants"] = len(tables["participants"][1])
+    cur.execute(
+        f"""INSERT INTO historyPartitions (month, name, bookings, participants,
+        firstStart, lastStart, firstCreation, lastCreation)
+        SELECT :month, :name, COUNT(*), :participants, MIN(startTime),
+        MAX(startTime), MIN(creationTime), MAX(creationTime)
+        FROM bookings b WHERE {in_month}""",
+        params,
+    )
+    params["partition"] = cur.lastrowid
+    cur.execute(
+        f"""INSERT INTO historyBookings (id, partitionId)
+        SELECT id, :partition FROM bookings b WHERE {in_month}""",
+        params,
+    )
+    cur.execute(
+        """DELETE FROM participants WHERE bookingId IN (
+        SELECT id FROM historyBookings WHERE partitionId=:partition)""",
+        params,
+    )
+    cur.execute(
+        """DELETE FROM bookings WHERE id IN (
+        SELECT id FROM historyBookings WHERE partitionId=:partition)""",
+        params,
+    )
+
+
+def thaw_partitions(cur: sqlite3.Cursor, ids: list[int] = None):
+    # Moves compacted bookings back into the tables, within the caller's
+    # transaction: those of the partitions with ids, or all of them.
+    # Participants' onCampus flags are recomputed for the current roster.
+    if ids is not None and not ids:
+        return
+    q = "SELECT id, month, name FROM historyPartitions"
+    if ids is None:
+        partitions = cur.execute(q).fetchall()
+    else:
+        q += " WHERE id IN (SELECT value FROM json_each(?))"
+        partitions = cur.execute(q, (json.dumps(ids),)).fetchall()
+    history = get_history()
+    for id, month, name in partitions:
+        for table in STAGED_TABLES:
+            columns, rows = history.rows(table, month, name)
+            cur.executemany(
+                f"""INSERT INTO {table} ({", ".join(columns)})
+                VALUES ({", ".join("?" * len(columns))})""",
+                rows,
+            )
+        cur.execute(
+            """UPDATE participants SET onCampus=EXISTS(
+            SELECT 1 FROM onCampusPids o WHERE o.pid=participants.pid)
+            WHERE bookingId IN (SELECT id FROM historyBookings WHERE partitionId=?)""",
+            (id,),
+        )
+        cur.execute("DELETE FROM historyBookings WHERE partitionId=?", (id,))
+        cur.execute("DELETE FROM historyPartitions WHERE id=?", (id,))
+
+
+def history_partitions(
+    cur: sqlite3.Cursor, start: int, end: int, created: bool = True
+) -> list[tuple]:
+    # (id, month, name) of each history file with bookings starting in
+    # [start, end), or, with created, made in it
+    q = """SELECT id, month, name FROM historyPartitions
+        WHERE (firstStart < ? AND lastStart >= ?)"""
+    if created:
+        q += " OR (firstCreation < ? AND lastCreation >= ?)"
+    return cur.execute(q, (end, start) * (1 + created)).fetchall()
+
+
+def history_frame(partitions: list[tuple], table: str, columns: tuple) -> pd.DataFrame:
+    # Columns of a table's rows in the given history files
+    history = get_history()
+    frames = [
+        history.frame(table, month, name, columns) for _, month, name in partitions
+    ]
+    frames = [f for f in frames if len(f)]
+    if not frames:
+        return pd.DataFrame(columns=list(columns))
+    return pd.concat(frames, ignore_index=True)
+
+
+def on_campus(cur: sqlite3.Cursor, pids: pd.Series) -> np.ndarray:
+    # Participants' onCampus flags from their PIDs, as stored ones are
+    # computed at ingest and roster load
+    roster = [pid for (pid,) in cur.execute("SELECT pid FROM onCampusPids")]
+    return pids.isin(roster).to_numpy()
+
+
+def booking_windows(
+    start: dt.datetime, end: dt.datetime, time_params: tuple[str, str]
+) -> list[dict]:
+    return [
+        {
+            time_params[0]: block_start.strftime(ZULU_FORMAT),
+            time_params[1]: block_end.strftime(ZULU_FORMAT),
+        }
+        for block_start, block_end in date_blocks(start, end)
+    ]
+
+
+def create_staging(conn: sqlite3.Connection):
+    # Empty copies of the staged tables without their secondary indexes,
+    # which are cheaper to build once at swap time. The DDL comes from the
+    # live schema so staging follows future migrations.
+    for table in STAGED_TABLES:
+        (sql,) = conn.execute(
+            "SELECT sql FROM sqlite_schema WHERE type='table' AND name=?", (table,)
+        ).fetchone()
+        conn.execute(f"DROP TABLE IF EXISTS {table}Staging")
+        conn.execute(
+            re.sub(r'^CREATE TABLE "?\w+"?', f"CREATE TABLE {table}Staging", sql)
+        )
+    # Bookings on a window boundary come back twice, and upsert_bookings
+    # replaces their participants by bookingId
+    conn.execute("CREATE INDEX stagingByBooking ON participantsStaging(bookingId)")
+
+
+def drop_staging(conn: sqlite3.Connection):
+    for table in STAGED_TABLES:
+        conn.execute(f"DROP TABLE IF EXISTS {table}Staging")
+
+
+def validate_staging(cur: sqlite3.Cursor) -> str:
+    # Bookeo returns canceled bookings too, so a complete download never
+    # has much less than the snapshot it replaces. Returns the problem, or
+    # None when the staged tables can be swapped in. Compacted rows are part
+    # of the snapshot being replaced.
+    compacted = cur.execute(
+        """SELECT COALESCE(SUM(bookings), 0), COALESCE(SUM(participants), 0)
+        FROM historyPartitions"""
+    ).fetchone()
+    for table, moved in zip(("bookings", "participants"), compacted):
+        live, staged = cur.execute(
+            f"SELECT (SELECT COUNT(*) FROM {table}), (SELECT COUNT(*) FROM {table}Staging)"
+        ).fetchone()
+        live += moved
+        if staged < live * MIN_RESYNC_RATIO:
+            return f"only {staged} rows downloaded for {table}, which has {live}"
+    return None
+
+
+def swap_staging(cur: sqlite3.Cursor):
+    # Must run inside a transaction: readers see either the old tables or
+    # the new ones, never neither
+    indexes = cur.execute(
+        f"""SELECT sql FROM sqlite_schema WHERE type='index' AND sql IS NOT NULL
+        AND tbl_name IN ({", ".join("?" * len(STAGED_TABLES))})""",
+        STAGED_TABLES,
+    ).fetchall()
+    for table in STAGED_TABLES:
+        cur.execute(f"DROP TABLE {table}")
+        cur.execute(f"ALTER TABLE {table}Staging RENAME TO {table}")
+    cur.execute("DROP INDEX stagingByBooking")
+    for (sql,) in indexes:
+        cur.execute(sql)
+    # The download had every booking, compacted ones included, so history
+    # starts over with the next compaction
+    cur.execute("DELETE FROM historyBookings")
+    cur.execute("DELETE FROM historyPartitions")
+    cur.execute("DELETE FROM syncState WHERE key='historyCompacted'")
+
+
+def date_blocks(start: dt.datetime, end: dt.datetime, days: int = 30):
+    # Bookeo limits each bookings query to a 31 day window
+    block_start = start
+    while block_start < end:
+        block_end = min(block_start + dt.timedelta(days=days), end)
+        yield block_start, block_end
+        block_start = block_end
+
+
+def booking_rows(bookings: list[dict]):
+    # Yields a (booking row, participant rows) pair per booking, in the
+    # column order of the INSERTs in upsert_bookings. The booking row ends
+    # with its segment names, which upsert_bookings swaps for their ids.
+    for b in bookings:
+        id = b["bookingNumber"]
+        participants = []
+        for p in b.get("participants", {}).get("details", []):
+            details = p.get("personDetails") or {}
+            participants.append(
+                (
+                    id,
+                    details.get("firstName"),
+                    details.get("lastName"),
+                    p["peopleCategoryId"],
+                    extract_pid(p),
+                )
+            )
+        booking = (
+            id,
+            b.get("eventId"),
+            to_epoch(b["startTime"]),
+            to_epoch(b["endTime"]),
+            b.get("customerId"),
+            b.get("title"),
+            b.get("canceled", False),
+            b.get("accepted"),
+            b.get("sourceIp"),
+            to_epoch(b["creationTime"]),
+            b.get("creationAgent"),
+            b.get("productId"),
+            b.get("privateEvent"),
+            b.get("noShow"),
+            extract_group_category(b),
+            extract_contact_method(b),
+        )
+        yield booking, participants
+
+
+def ingest_bookings(
+    cur: sqlite3.Cursor, pages, batch_size: int = 5000, track_days: bool = True
+) -> set[str]:
+    # Streams pages of bookings into the database batch_size bookings at a
+    # time. Returns the local days to recompute in the rollup, unless
+    # track_days is off (a full resync rebuilds all of them anyway).
+    days = set()
+    for batch in booking_batches(pages, batch_size):
+        touched = upsert_bookings(cur, batch, track_days)
+        days |= {local_day(t) for t in touched}
+    return days
+
+
+def booking_batches(pages, batch_size: int = 5000):
+    # Regroups the rows of each page into lists of batch_size bookings,
+    # whatever the page size, so only one batch is held in memory
+    rows = (row for bookings in pages for row in booking_rows(bookings))
+    while batch := list(islice(rows, batch_size)):
+        yield batch
+
+
+def upsert_bookings(
+    cur: sqlite3.Cursor,
+    rows: list[tuple],
+    track_days: bool = True,
+    staging: bool = False,
+) -> set[int]:
+    # Bookings that changed since the last sync (including cancellations)
+    # replace the stored row and its participants. Returns the old and new
+    # start/creation times so the affected rollup days can be recomputed.
+    suffix = "Staging" if staging else ""
+    q1 = f"""INSERT INTO bookings{suffix} (id, eventId, startTime, endTime,
+        customerId, title, canceled, accepted, sourceIp, creationTime,
+        creationAgent, productId, privateEvent, noShow, groupCategory,
+        contactMethod)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+        eventId=excluded.eventId, startTime=excluded.startTime,
+        endTime=excluded.endTime, customerId=excluded.customerId,
+        title=excluded.title, canceled=excluded.canceled,
+        accepted=excluded.accepted, sourceIp=excluded.sourceIp,
+        creationTime=excluded.creationTime,
+        creationAgent=excluded.creationAgent, productId=excluded.productId,
+        privateEvent=excluded.privateEvent, noShow=excluded.noShow,
+        groupCategory=excluded.groupCategory,
+        contactMethod=excluded.contactMethod"""
+    q2 = f"""INSERT INTO participants{suffix} (bookingId, firstName,
+        lastName, peopleCategory, pid, onCampus)
+        VALUES (?, ?, ?, ?, ?, EXISTS(SELECT 1 FROM onCampusPids WHERE pid=?5))"""
+    q3 = f"""SELECT startTime, creationTime FROM bookings{suffix}
+        WHERE id IN (SELECT value FROM json_each(?))"""
+    # The same booking can come back in two windows of one batch
+    rows = list({booking[0]: (booking, ps) for booking, ps in rows}.values())
+    ids = json.dumps([booking[0] for booking, _ in rows])
+    if not staging:
+        # Compacted bookings aren't changed in place, their months come back
+        # into the tables first
+        q4 = """SELECT DISTINCT partitionId FROM historyBookings
+            WHERE id IN (SELECT value FROM json_each(?))"""
+        thaw_partitions(cur, [id for (id,) in cur.execute(q4, (ids,)).fetchall()])
+    touched = set()
+    if track_days:
+        touched = {t for row in cur.execute(q3, (ids,)) for t in row}
+        touched |= {t for booking, _ in rows for t in (booking[2], booking[9])}
+    groups = segment_ids(cur, "groupCategories", {b[14] for b, _ in rows})
+    contacts = segment_ids(cur, "contactMethods", {b[15] for b, _ in rows})
+    cur.executemany(
+        q1,
+        [
+            (*b[:14], groups[b[14].casefold()], contacts[b[15].casefold()])
+            for b, _ in rows
+        ],
+    )
+    cur.executemany(
+        f"DELETE FROM participants{suffix} WHERE bookingId=?",
+        [(booking[0],) for booking, _ in rows],
+    )
+    cur.executemany(q2, [p for _, participants in rows for p in participants])
+    return touched
+
+
+def segment_ids(cur: sqlite3.Cursor, table: str, names: set[str]) -> dict[str, int]:
+    # Adds any new names to a segment dimension table. Returns the ids of
+    # every name in it, keyed case-insensitively like the table.
+    cur.executemany(
+        f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", [(n,) for n in names]
+    )
+    return {
+        name.casefold(): id for id, name in cur.execute(f"SELECT id, name FROM {table}")
+    }
+
+
+def refresh_rollup(cur: sqlite3.Cursor, days: set[str] = None):
+    # Recomputes dailyRollup for the given local days, or every day when
+    # days is None. Each day holds the bookings created that day (*Booked)
+    # and the bookings run that day (*Run), per product, both for all
+    # participants (peopleCategory '') and per people category, each for
+    # all groups (groupCategory 0) and per group category. Rooms are
+    # distinct times per product, so summing rooms across products or
+    # categories can differ slightly from get_report(). Days with compacted
+    # bookings are computed from copies of theirs and the tables' rows.
+    if days is None:
+        cur.execute("DELETE FROM dailyRollup")
+        bounds = cur.execute(
+            """SELECT MIN(startTime), MAX(startTime),
+            MIN(creationTime), MAX(creationTime) FROM bookings
+            UNION ALL
+            SELECT MIN(firstStart), MAX(lastStart),
+            MIN(firstCreation), MAX(lastCreation) FROM historyPartitions"""
+        ).fetchall()
+        bounds = [t for row in bounds for t in row if t is not None]
+        if not bounds:
+            return
+        days = every_day(min(bounds), max(bounds))
+    else:
+        days = [dt.date.fromisoformat(d) for d in days]
+    fill_rollup_days(cur, days)
+    cur.execute("DELETE FROM dailyRollup WHERE day IN (SELECT day FROM rollupDays)")
+    bookings, participants = "bookings", "participants"
+    partitions = (
+        history_partitions(cur, *day_range(min(days), max(days))) if days else []
+    )
+    if partitions:
+        stage_rollup_rows(cur, partitions)
+        bookings, participants = "rollupBookings", "rollupParticipants"
+    q = """INSERT INTO dailyRollup (day, productId, peopleCategory,
+        groupCategory, rooms{side}, slots{side}, onCampus{side})
+        SELECT d.day, b.productId, {category}, {group},
+        COUNT(DISTINCT b.{column}), COUNT(p.bookingId),
+        COALESCE(SUM(p.onCampus), 0)
+        FROM rollupDays d
+        JOIN {bookings} b ON b.{column} >= d.start AND b.{column} < d.end
+        {join} {participants} p ON p.bookingId=b.id
+        WHERE NOT b.canceled AND {category} IS NOT NULL AND {group} IS NOT NULL
+        GROUP BY d.day, b.productId, {category} {group_by}
+        ON CONFLICT(day, productId, peopleCategory, groupCategory) DO UPDATE SET
+        rooms{side}=excluded.rooms{side}, slots{side}=excluded.slots{side},
+        onCampus{side}=excluded.onCampus{side}"""
+    for side, column in (("Booked", "creationTime"), ("Run", "startTime")):
+        # A literal 0 in GROUP BY would mean the first column
+        for group, group_by in (("0", ""), ("b.groupCategory", ", b.groupCategory")):
+            for category, join in (("''", "LEFT JOIN"), ("p.peopleCategory", "JOIN")):
+                cur.execute(
+                    q.format(
+                        side=side,
+                        column=column,
+                        category=category,
+                        group=group,
+                        group_by=group_by,
+                        join=join,
+                        bookings=bookings,
+                        participants=participants,
+                    )
+                )
+
+
+def stage_rollup_rows(cur: sqlite3.Cursor, partitions: list[tuple]):
+    # Copies the bookings made or run on the rollupDays, from the tables
+    # and the given history files, with their participants into temp
+    # tables for refresh_rollup
+    cur.execute(
+        """CREATE TEMP TABLE IF NOT EXISTS rollupBookings (
+        id INTEGER PRIMARY KEY,
+        productId TEXT NOT NULL,
+        canceled INT NOT NULL,
+        groupCategory INT,
+        startTime INT NOT NULL,
+        creationTime INT NOT NULL)"""
+    )
+    cur.execute(
+        """CREATE TEMP TABLE IF NOT EXISTS rollupParticipants (
+        bookingId INT NOT NULL,
+        peopleCategory TEXT,
+        onCampus INT NOT NULL)"""
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS temp.rollupByStart ON rollupBookings(startTime)"
+    )
+    cur.execute(
+        """CREATE INDEX IF NOT EXISTS temp.rollupByCreation
+        ON rollupBookings(creationTime)"""
+    )
+    cur.execute(
+        """CREATE INDEX IF NOT EXISTS temp.rollupByBooking
+        ON rollupParticipants(bookingId, peopleCategory, onCampus)"""
+    )
+    cur.execute("DELETE FROM rollupBookings")
+    cur.execute("DELETE FROM rollupParticipants")
+    columns = (
+        "id",
+        "productId",
+        "canceled",
+        "groupCategory",
+        "startTime",
+        "creationTime",
+    )
+    for column in ("startTime", "creationTime"):
+        cur.execute(
+            f"""INSERT OR IGNORE INTO rollupBookings
+            SELECT {", ".join(f"b.{c}" for c in columns)}
+            FROM rollupDays d
+            JOIN bookings b ON b.{column} >= d.start AND b.{column} < d.end"""
+        )
+    cur.execute(
+        """INSERT INTO rollupParticipants
+        SELECT p.bookingId, p.peopleCategory, p.onCampus
+        FROM rollupBookings b JOIN participants p ON p.bookingId=b.id"""
+    )
+    bounds = np.array(
+        cur.execute("SELECT start, end FROM rollupDays ORDER BY start").fetchall(),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+
+    def on_days(times: pd.Series) -> np.ndarray:
+        day = np.searchsorted(bounds[:, 0], times.to_numpy(), side="right") - 1
+        return (day >= 0) & (times.to_numpy() < bounds[np.maximum(day, 0), 1])
+
+    b = history_frame(partitions, "bookings", columns)
+    b = b[on_days(b.startTime) | on_days(b.creationTime)]
+    p = history_frame(
+        partitions, "participants", ("bookingId", "peopleCategory", "pid")
+    )
+    p = p[p.bookingId.isin(b.id)]
+    cur.executemany(
+        "INSERT INTO rollupBookings VALUES (?, ?, ?, ?, ?, ?)",
+        zip(*(b[c].tolist() for c in columns)),
+    )
+    cur.executemany(
+        "INSERT INTO rollupParticipants VALUES (?, ?, ?)",
+        zip(
+            p.bookingId.tolist(),
+            p.peopleCategory.tolist(),
+            on_campus(cur, p.pid).astype(int).tolist(),
+        ),
+    )
+
+
+def fill_rollup_days(cur: sqlite3.Cursor, days: list[dt.date]):
+    # The temp table rollupDays holds the [start, end) epoch bounds of each
+    # local day being recomputed
+    cur.execute(
+        """CREATE TEMP TABLE IF NOT EXISTS rollupDays (
+        day TEXT PRIMARY KEY,
+        start INT NOT NULL,
+        end INT NOT NULL)"""
+    )
+    cur.execute("DELETE FROM rollupDays")
+    cur.executemany(
+        "INSERT INTO rollupDays (day, start, end) VALUES (?, ?, ?)",
+        [(d.isoformat(), *day_range(d, d)) for d in days],
+    )
+
+
+def every_day(first: int, last: int) -> list[dt.date]:
+    # Local days from the one containing epoch first to the one with last
+    first = dt.date.fromisoformat(local_day(first))
+    last = dt.date.fromisoformat(local_day(last))
+    return [first + dt.timedelta(days=d) for d in range((last - first).days + 1)]
+
+
+def local_day(timestamp: int) -> str:
+    return dt.datetime.fromtimestamp(timestamp, TIMEZONE).date().isoformat()
+
+
+def to_epoch(timestamp: str) -> int:
+    # Square's times end in Z, which fromisoformat only takes from 3.11
+    if timestamp.endswith("Z"):
+        timestamp = timestamp[:-1] + "+00:00"
+    return int(dt.datetime.fromisoformat(timestamp).timestamp())
+
+
+def day_range(start: dt.date, end: dt.date) -> tuple[int, int]:
+    # [start 00:00, end + 1 day 00:00) in local time, as epoch seconds
+    start = TIMEZONE.localize(dt.datetime.combine(start, dt.time(0, 0)))
+    end = end + dt.timedelta(days=1)
+    end = TIMEZONE.localize(dt.datetime.combine(end, dt.time(0, 0)))
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def get_sync_state(cur: sqlite3.Cursor, key: str) -> str:
+    row = cur.execute("SELECT value FROM syncState WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_sync_state(cur: sqlite3.Cursor, key: str, value: str):
+    # Every sync records its progress here, in the transaction that writes
+    # its data, so this also moves the data generation on
+    cur.execute(
+        """INSERT INTO syncState (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value""",
+        (key, value),
+    )
+    cur.execute(
+        """INSERT INTO syncState (key, value) VALUES ('generation', 1)
+        ON CONFLICT(key) DO UPDATE SET value=value + 1"""
+    )
+
+
+def get_generation() -> int:
+    # Changes with every committed sync, in this process or another (the
+    # CLI); cached reports are keyed by it
+    with get_db().read() as conn:
+        cur = conn.cursor()
+        try:
+            return int(get_sync_state(cur, "generation") or 0)
+        finally:
+            cur.close()
+
+
+def snapshot_changed(cur: sqlite3.Cursor):
+    # Moves the snapshot generation on, in the transaction that changes a
+    # booking, participant, slot, roster or dimension row. Sync marks alone
+    # leave it, so the report snapshot is only reloaded for new data.
+    cur.execute(
+        """INSERT INTO syncState (key, value) VALUES ('snapshotGeneration', 1)
+        ON CONFLICT(key) DO UPDATE SET value=value + 1"""
+    )
+
+
+def get_snapshot_generation() -> int:
+    with get_db().read() as conn:
+        cur = conn.cursor()
+        try:
+            return int(get_sync_state(cur, "snapshotGeneration") or 0)
+        finally:
+            cur.close()
+
+
+def synced_at(*keys: str):
+    # For RefreshCoordinator: when the oldest of the sync marks under keys
+    # was set, as epoch seconds, or None if one hasn't been yet
+    def last_synced() -> float:
+        with get_db().read() as conn:
+            cur = conn.cursor()
+            try:
+                marks = [get_sync_state(cur, key) for key in keys]
+            finally:
+                cur.close()
+        if None in marks:
+            return None
+        return min(
+            dt.datetime.strptime(mark, ZULU_FORMAT)
+            .replace(tzinfo=dt.timezone.utc)
+            .timestamp()
+            for mark in marks
+        )
+
+    return last_synced
+
+
+def mark_synced(key: str):
+    # Sync mark for jobs that don't resume from one, so a restart knows how
+    # fresh their data is
+    with get_db().write() as conn:
+        cur = conn.cursor()
+        try:
+            now = dt.datetime.now(dt.timezone.utc)
+            set_sync_state(cur, key, now.strftime(ZULU_FORMAT))
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def extract_pid(participant: dict) -> int:
+    try:
+        for f in participant["personDetails"]["customFields"]:
+            if f["name"] == "PID":
+                return normalize_pid(f["value"])
+        return None
+    except:
+        return None
+
+
+def normalize_pid(value) -> int:
+    # PIDs arrive as free text from Bookeo ("730-123-456", "730 123 456")
+    # and as numbers from the roster; store both as the same integer. Text
+    # without exactly one PID in it (several, or only a phone number) has
+    # none.
+    pids = {"".join(m) for m in PID.findall(str(value))}
+    return int(pids.pop()) if len(pids) == 1 else None
+
+
+def get_group_options() -> list[str]:
+    with get_db().read() as conn:
+        cur = conn.cursor()
+        try:
+            q = "SELECT name FROM groupCategories ORDER BY name"
+            return [n[0] for n in cur.execute(q).fetchall()]
+        finally:
+            cur.close()
+
+
+def custom_field(data: dict, name: str) -> str:
+    # Value of a booking custom field, whitespace collapsed, or None when
+    # the booking doesn't have it or left it blank
+    for f in data.get("customFields") or []:
+        if str(f.get("name", "")).casefold() == name.casefold():
+            return " ".join(str(f.get("value") or "").split()) or None
+    return None
+
+
+def extract_group_category(data: dict) -> str:
+    return custom_field(data, GROUP_CATEGORY_FIELD) or UNSPECIFIED
+
+
+def extract_contact_method(data: dict) -> str:
+    # Bookeo names the staff member who entered a booking (phone, email,
+    # walk-in) as its creationAgent; customers booking online have none
+    method = custom_field(data, CONTACT_METHOD_FIELD)
+    if method:
+        return method
+    return "Staff" if data.get("creationAgent") else "Online"
+
+
+@process_resource
+def get_settings_refresher() -> RefreshCoordinator:
+    return RefreshCoordinator(
+        update_settings, dt.timedelta(hours=6), last_synced=synced_at("settingsSynced")
+    )
+
+
+def update_settings():
+    # Either update failing raises before the mark, so the refresher
+    # retries settings after its retry_after rather than max_age
+    update_people_categories()
+    update_products()
+    mark_synced("settingsSynced")
+
+
+def payload_changed(cur: sqlite3.Cursor, key: str, payload) -> bool:
+    # Compares a settings payload with the hash stored by the last write
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    if get_sync_state(cur, key) == digest:
+        return False
+    set_sync_state(cur, key, digest)
+    return True
+
+
+def update_people_categories():
+    # https://www.bookeo.com/apiref/#tag/Settings/paths/~1settings~1peoplecategories/get
+    with get_db().write() as conn:
+        cur = conn.cursor()
+        try:
+            etag = get_sync_state(cur, "peopleCategoriesETag")
+            res = get_bookeo().get(
+                "settings/peoplecategories",
+                headers={"If-None-Match": etag} if etag else None,
+            )
+            if res.status_code == 304:
+                return
+            if res.status_code != 200:
+                raise BookeoError(res)
+            data = res.json()
+            if "categories" not in data.keys():
+                raise ValueError("Bookeo sent people categories without a list")
+            if res.headers.get("ETag"):
+                set_sync_state(cur, "peopleCategoriesETag", res.headers["ETag"])
+            if payload_changed(cur, "peopleCategoriesHash", data["categories"]):
+                cur.execute("DELETE FROM peopleCategories")
+                q = """INSERT INTO peopleCategories (id, name)
+                    VALUES (:id, :name)"""
+                cur.executemany(q, data["categories"])
+                snapshot_changed(cur)
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def get_people_categories() -> list[str]:
+    with get_db().read() as conn:
+        cur = conn.cursor()
+        try:
+            q = "SELECT name FROM peopleCategories"
+            names = cur.execute(q).fetchall()
+            return [n[0] for n in names]
+        finally:
+            cur.close()
+
+
+def update_products():
+    # https://www.bookeo.com/apiref/#tag/Settings/paths/~1settings~1products/get
+    pages = get_bookeo().get_all("settings/products", [{}], itemsPerPage=100)
+    products = [(p["name"], p["productCode"]) for page in pages for p in page]
+    with get_db().write() as conn:
+        cur = conn.cursor()
+        try:
+            if payload_changed(cur, "productsHash", products):
+                cur.execute("DELETE FROM products")
+                q = """INSERT INTO products (name, id)
+                    VALUES (?, ?)"""
+                cur.executemany(q, products)
+                refresh_capacity(cur)
+                snapshot_changed(cur)
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def get_products() -> list[str]:
+    with get_db().read() as conn:
+        cur = conn.cursor()
+        try:
+            q = "SELECT name FROM products"
+            names = cur.execute(q).fetchall()
+            return [n[0] for n in names]
+        finally:
+            cur.close()
+
+
+@process_resource
+def get_slots_refresher() -> RefreshCoordinator:
+    return RefreshCoordinator(
+        update_slots, dt.timedelta(hours=6), last_synced=synced_at("slotsLastSynced")
+    )
+
+
+def update_slots():
+    # https://www.bookeo.com/apiref/#tag/Availability/paths/~1availability~1slots/get
+    # Slots of every product from its last sync (BOOKINGS_START the first
+    # time, so a product added later gets its past slots too) through
+    # BOOKINGS_HORIZON. Bookeo reports the seats still available, so
+    # bookings are synced first and each slot's capacity adds the seats
+    # booked in it. Slots that have started keep what was last seen of
+    # them; future ones are replaced, dropping any taken off the schedule.
+    get_settings_refresher().refresh()
+    get_bookings_refresher().refresh()
+    with get_db().read() as conn:
+        cur = conn.cursor()
+        starts = {}
+        for (product,) in cur.execute("SELECT id FROM products").fetchall():
+            since = get_sync_state(cur, f"slotsLastSynced:{product}")
+            starts[product] = (
+                dt.datetime.combine(BOOKINGS_START, dt.time(0, 0, 0))
+                if since is None
+                else dt.datetime.strptime(since, ZULU_FORMAT)
+            )
+        cur.close()
+    if not starts:
+        # Marking slots synced now would skip their history once products
+        # arrive
+        raise RuntimeError("No products to fetch slots of; settings haven't synced")
+    sync_time = dt.datetime.now(dt.timezone.utc)
+    end = sync_time.replace(tzinfo=None) + BOOKINGS_HORIZON
+    pages = get_bookeo().get_all(
+        "availability/slots",
+        [
+            {"productId": product, **window}
+            for product, start in starts.items()
+            for window in booking_windows(start, end, ("startTime", "endTime"))
+        ],
+        itemsPerPage=100,
+    )
+    with get_db().write() as conn:
+        cur = conn.cursor()
+        try:
+            first = int(
+                min(starts.values()).replace(tzinfo=dt.timezone.utc).timestamp()
+            )
+            last = int(end.replace(tzinfo=dt.timezone.utc).timestamp())
+            before = slots_digest(cur, first)
+            # Every product is fetched from before now, so this is all
+            # refetched
+            cur.execute(
+                "DELETE FROM slots WHERE startTime >= ? AND startTime < ?",
+                (int(sync_time.timestamp()), last),
+            )
+            stage_history_seats(cur, first, last)
+            try:
+                for page in pages:
+                    upsert_slots(cur, page)
+            except BookeoError:
+                conn.rollback()
+                raise
+
+            refresh_capacity(cur)
+            if slots_digest(cur, first) != before:
+                snapshot_changed(cur)
+            mark = sync_time.strftime(ZULU_FORMAT)
+            for product in starts:
+                set_sync_state(cur, f"slotsLastSynced:{product}", mark)
+            set_sync_state(cur, "slotsLastSynced", mark)
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def slots_digest(cur: sqlite3.Cursor, start: int) -> str:
+    # Hash of what update_slots can change: the slots starting from start
+    # and the products' capacities. Most syncs find the same schedule.
+    digest = hashlib.sha256()
+    rows = cur.execute(
+        """SELECT eventId, productId, startTime, endTime, capacity FROM slots
+        WHERE startTime >= ? ORDER BY eventId""",
+        (start,),
+    )
+    for row in rows:
+        digest.update(repr(row).encode())
+    for row in cur.execute("SELECT id, capacity FROM products ORDER BY id"):
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+
+def upsert_slots(cur: sqlite3.Cursor, slots: list[dict]):
+    # The page goes into a temp table first so its booked seats are
+    # counted in one grouped join rather than a lookup per slot. Compacted
+    # bookings' seats come from historySeats, which update_slots fills.
+    cur.execute(
+        """CREATE TEMP TABLE IF NOT EXISTS fetchedSlots (
+        eventId INT PRIMARY KEY,
+        productId TEXT NOT NULL,
+        startTime INT NOT NULL,
+        endTime INT NOT NULL,
+        available INT NOT NULL)"""
+    )
+    cur.execute("DELETE FROM fetchedSlots")
+    cur.executemany(
+        """INSERT OR REPLACE INTO fetchedSlots
+        (eventId, productId, startTime, endTime, available)
+        VALUES (?, ?, ?, ?, ?)""",
+        [
+            (
+                s["eventId"],
+                s["productId"],
+                to_epoch(s["startTime"]),
+                to_epoch(s["endTime"]),
+                s.get("numSeatsAvailable", 0),
+            )
+            for s in slots
+        ],
+    )
+    cur.execute(
+        """INSERT INTO slots (eventId, productId, startTime, endTime, capacity)
+        SELECT f.eventId, f.productId, f.startTime, f.endTime,
+        f.available + COALESCE(k.seats, 0) + COALESCE(h.seats, 0)
+        FROM fetchedSlots f LEFT JOIN historySeats h ON h.eventId=f.eventId
+        LEFT JOIN (
+            SELECT b.eventId, COUNT(p.bookingId) AS seats
+            FROM bookings b JOIN participants p ON p.bookingId=b.id
+            WHERE b.eventId IN (SELECT eventId FROM fetchedSlots)
+            AND NOT b.canceled
+            GROUP BY b.eventId
+        ) k ON k.eventId=f.eventId
+        WHERE true
+        ON CONFLICT(eventId) DO UPDATE SET
+        productId=excluded.productId, startTime=excluded.startTime,
+        endTime=excluded.endTime, capacity=excluded.capacity"""
+    )
+
+
+def stage_history_seats(cur: sqlite3.Cursor, start: int, end: int):
+    # Fills the temp table historySeats with the seats booked per event
+    # starting in [start, end) among compacted bookings, counted like the
+    # slot queries count them in the tables
+    cur.execute(
+        """CREATE TEMP TABLE IF NOT EXISTS historySeats (
+        eventId INT PRIMARY KEY,
+        productId TEXT NOT NULL,
+        startTime INT NOT NULL,
+        endTime INT NOT NULL,
+        seats INT NOT NULL)"""
+    )
+    cur.execute("DELETE FROM historySeats")
+    partitions = history_partitions(cur, start, end, created=False)
+    if not partitions:
+        return
+    columns = ("id", "eventId", "productId", "startTime", "endTime", "canceled")
+    b = history_frame(partitions, "bookings", columns)
+    b = b[(b.startTime >= start) & (b.startTime < end) & (b.canceled == 0)]
+    p = history_frame(partitions, "participants", ("bookingId",))
+    seats = p.bookingId[p.bookingId.isin(b.id)].value_counts()
+    b = b.assign(seats=b.id.map(seats)).dropna(subset=["seats"])
+    events = b.groupby("eventId", sort=False).agg(
+        productId=("productId", "first"),
+        startTime=("startTime", "min"),
+        endTime=("endTime", "max"),
+        seats=("seats", "sum"),
+    )
+    cur.executemany(
+        "INSERT INTO historySeats VALUES (?, ?, ?, ?, ?)",
+        zip(
+            events.index.tolist(),
+            events.productId.tolist(),
+            events.startTime.tolist(),
+            events.endTime.tolist(),
+            events.seats.astype(int).tolist(),
+        ),
+    )
+
+
+def refresh_capacity(cur: sqlite3.Cursor):
+    cur.execute(
+        """UPDATE products SET capacity=(
+        SELECT MAX(capacity) FROM slots WHERE productId=products.id)"""
+    )
+
+
+@process_resource
+def get_revenue_refresher() -> RefreshCoordinator:
+    return RefreshCoordinator(
+        update_revenue,
+        dt.timedelta(hours=1),
+        last_synced=synced_at("squareOrdersUpdated", "squarePaymentsUpdated"),
+    )
+
+
+def update_revenue():
+    # https://developer.squareup.com/reference/square/orders-api/search-orders
+    # https://developer.squareup.com/reference/square/payments-api/list-payments
+    # Incremental by updated_at, so refunds and late completions are picked
+    # up. Each query is split into 30 day windows that page concurrently.
+    # Everything is downloaded before the write connection is taken, so a
+    # long first sync doesn't hold up the other syncs' writes. A failed
+    # download raises SquareError and leaves the watermarks where they are.
+    square = get_square()
+    if square is None:
+        return
+    sync_time = dt.datetime.now(dt.timezone.utc)
+    with get_db().read() as conn:
+        cur = conn.cursor()
+        try:
+            order_windows = square_windows(cur, "squareOrdersUpdated")
+            payment_windows = square_windows(cur, "squarePaymentsUpdated")
+        finally:
+            cur.close()
+    locations = square.request("GET", "locations").get("locations", [])
+    orders = list(
+        square.list_all(
+            "POST",
+            "orders/search",
+            "orders",
+            [
+                {
+                    # At most 10 locations per search
+                    "location_ids": [l["id"] for l in locations[i : i + 10]],
+                    "limit": 500,
+                    "query": {
+                        "filter": {
+                            "date_time_filter": {
+                                "updated_at": {"start_at": start, "end_at": end}
+                            }
+                        },
+                        "sort": {"sort_field": "UPDATED_AT"},
+                    },
+                }
+                for start, end in order_windows
+                for i in range(0, len(locations), 10)
+            ],
+        )
+    )
+    payments = list(
+        square.list_all(
+            "GET",
+            "payments",
+            "payments",
+            [
+                {
+                    "updated_at_begin_time": start,
+                    "updated_at_end_time": end,
+                    "sort_field": "UPDATED_AT",
+                    "limit": 100,
+                }
+                for start, end in payment_windows
+            ],
+        )
+    )
+    with get_db().write() as conn:
+        cur = conn.cursor()
+        try:
+            touched = set()
+            for page in orders:
+                touched |= upsert_square_orders(cur, page)
+            for page in payments:
+                touched |= upsert_square_payments(cur, page)
+            refresh_revenue(cur, {local_day(t) for t in touched})
+            for key in ("squareOrdersUpdated", "squarePaymentsUpdated"):
+                set_sync_state(cur, key, sync_time.strftime(ZULU_FORMAT))
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def square_windows(cur: sqlite3.Cursor, key: str) -> list[tuple[str, str]]:
+    # updated_at windows from the watermark stored under key (BOOKINGS_START
+    # on the first sync) to now
+    last_updated = get_sync_state(cur, key)
+    if last_updated:
+        start = dt.datetime.strptime(last_updated, ZULU_FORMAT)
+    else:
+        start = dt.datetime.combine(BOOKINGS_START, dt.time(0, 0, 0))
+    end = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+    return [
+        (block_start.strftime(ZULU_FORMAT), block_end.strftime(ZULU_FORMAT))
+        for block_start, block_end in date_blocks(start, end)
+    ]
+
+
+def cents(money: dict) -> int:
+    # Square Money is already in the smallest currency unit
+    return (money or {}).get("amount", 0)
+
+
+def upsert_square_orders(cur: sqlite3.Cursor, orders: list[dict]) -> set[int]:
+    # Replaces each order and its line items. Returns the old and new close
+    # times so the affected revenue days can be recomputed.
+    ids = json.dumps([o["id"] for o in orders])
+    touched = {
+        t
+        for (t,) in cur.execute(
+            """SELECT closedAt FROM squareOrders
+            WHERE id IN (SELECT value FROM json_each(?)) AND closedAt IS NOT NULL""",
+            (ids,),
+        )
+    }
+    rows = []
+    lines = []
+    for o in orders:
+        closed = to_epoch(o["closed_at"]) if o.get("closed_at") else None
+        if closed is not None:
+            touched.add(closed)
+        rows.append(
+            (
+                o["id"],
+                o.get("location_id"),
+                o.get("state", "OPEN"),
+                to_epoch(o["created_at"]),
+                to_epoch(o["updated_at"]),
+                closed,
+            )
+        )
+        items = [(1, li) for li in o.get("line_items", [])]
+        for r in o.get("returns", []):
+            items += [(-1, li) for li in r.get("return_line_items", [])]
+        for sign, li in items:
+            lines.append(
+                (
+                    o["id"],
+                    li["uid"],
+                    li.get("name"),
+                    li.get("catalog_object_id"),
+                    sign * float(li.get("quantity", 1)),
+                    sign
+                    * cents(
+                        li.get("gross_sales_money") or li.get("gross_return_money")
+                    ),
+                    sign * cents(li.get("total_discount_money")),
+                    sign * cents(li.get("total_tax_money")),
+                    sign * cents(li.get("total_money")),
+                )
+            )
+    cur.executemany(
+        """INSERT INTO squareOrders (id, locationId, state, createdAt,
+        updatedAt, closedAt) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+        locationId=excluded.locationId, state=excluded.state,
+        createdAt=excluded.createdAt, updatedAt=excluded.updatedAt,
+        closedAt=excluded.closedAt""",
+        rows,
+    )
+    cur.execute(
+        "DELETE FROM squareOrderLines WHERE orderId IN (SELECT value FROM json_each(?))",
+        (ids,),
+    )
+    cur.executemany(
+        """INSERT OR REPLACE INTO squareOrderLines (orderId, uid, name,
+        catalogObjectId, quantity, grossSales, discount, tax, total)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        lines,
+    )
+    return touched
+
+
+def upsert_square_payments(cur: sqlite3.Cursor, payments: list[dict]) -> set[int]:
+    # Returns the creation times of the payments, the day they count on
+    rows = [
+        (
+            p["id"],
+            p.get("order_id"),
+            p.get("location_id"),
+            p["status"],
+            to_epoch(p["created_at"]),
+            to_epoch(p["updated_at"]),
+            cents(p.get("amount_money")),
+            cents(p.get("tip_money")),
+            cents(p.get("refunded_money")),
+            (p.get("amount_money") or {}).get("currency"),
+        )
+        for p in payments
+    ]
+    cur.executemany(
+        """INSERT INTO squarePayments (id, orderId, locationId, status,
+        createdAt, updatedAt, amount, tip, refunded, currency)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(id) DO UPDATE SET
+        orderId=excluded.orderId, locationId=excluded.locationId,
+        status=excluded.status, createdAt=excluded.createdAt,
+        updatedAt=excluded.updatedAt, amount=excluded.amount,
+        tip=excluded.tip, refunded=excluded.refunded,
+        currency=excluded.currency""",
+        rows,
+    )
+    return {r[4] for r in rows}
+
+
+def refresh_revenue(cur: sqlite3.Cursor, days: set[str] = None):
+    # Recomputes dailyRevenue for the given local days, or every day when
+    # days is None. Net sales (gross less discounts, before tax) of
+    # completed orders count on the day the order closed, per line item
+    # name, with product '' holding the total over all items. The '' rows
+    # also hold the completed payments taken that day and how much of them
+    # has been refunded since.
+    if days is None:
+        cur.execute("DELETE FROM dailyRevenue")
+        bounds = cur.execute(
+            """SELECT MIN(closedAt), MAX(closedAt) FROM squareOrders
+            UNION ALL
+            SELECT MIN(createdAt), MAX(createdAt) FROM squarePayments"""
+        ).fetchall()
+        bounds = [t for row in bounds for t in row if t is not None]
+        if not bounds:
+            return
+        days = every_day(min(bounds), max(bounds))
+    else:
+        days = [dt.date.fromisoformat(d) for d in days]
+    fill_rollup_days(cur, days)
+    cur.execute("DELETE FROM dailyRevenue WHERE day IN (SELECT day FROM rollupDays)")
+    q = """INSERT INTO dailyRevenue (day, product, orders, netSales)
+        SELECT d.day, {product}, COUNT(DISTINCT o.id),
+        SUM(l.grossSales - l.discount)
+        FROM rollupDays d
+        JOIN squareOrders o ON o.closedAt >= d.start AND o.closedAt < d.end
+        JOIN squareOrderLines l ON l.orderId=o.id
+        WHERE o.state='COMPLETED'
+        GROUP BY d.day, {product}"""
+    cur.execute(q.format(product="''"))
+    # Unnamed line items are the dashboard's "Custom Amount" sales
+    cur.execute(q.format(product="COALESCE(NULLIF(l.name, ''), 'Custom Amount')"))
+    cur.execute(
+        """INSERT INTO dailyRevenue (day, product, collected, refunded)
+        SELECT d.day, '', SUM(p.amount), SUM(p.refunded)
+        FROM rollupDays d
+        JOIN squarePayments p ON p.createdAt >= d.start AND p.createdAt < d.end
+        WHERE p.status='COMPLETED'
+        GROUP BY d.day
+        ON CONFLICT(day, product) DO UPDATE SET
+        collected=excluded.collected, refunded=excluded.refunded"""
+    )
+
+
+@background_cache(get_snapshot_generation)
+def get_snapshot() -> ReportSnapshot:
+    # The report snapshot. Once one is loaded, new data is loaded into the
+    # next in the background, and reports keep reading the previous one
+    # until it is ready.
+    return load_snapshot()
+
+
+def served_generation() -> int:
+    # The snapshot generation reports are currently answered from, which
+    # trails the database's while the next snapshot loads
+    get_snapshot()
+    return get_snapshot.generation()
+
+
+@metrics.timed("snapshot_load_duration_seconds")
+def load_snapshot() -> ReportSnapshot:
+    # Every booking, participant and slot, from the tables and history in
+    # one snapshot of the database. History files are cached once read, so
+    # after the first load only the hot window comes from SQLite.
+    with get_db().read() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN")
+            bookings = pd.read_sql_query(
+                f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM bookings", conn
+            )
+            participants = pd.read_sql_query(
+                "SELECT bookingId, peopleCategory, onCampus FROM participants", conn
+            )
+            partitions = cur.execute(
+                "SELECT id, month, name FROM historyPartitions"
+            ).fetchall()
+            history = history_frame(
+                partitions, "participants", ("bookingId", "peopleCategory", "pid")
+            )
+            history = history.assign(onCampus=on_campus(cur, history.pid))
+            slots = pd.read_sql_query(
+                "SELECT eventId, productId, startTime, endTime, capacity FROM slots",
+                conn,
+            )
+            dimensions = {
+                "products": pd.read_sql_query(
+                    "SELECT id, name, capacity FROM products ORDER BY rowid", conn
+                ),
+                **{
+                    table: pd.read_sql_query(
+                        f"SELECT id, name FROM {table} ORDER BY rowid", conn
+                    )
+                    for table in ("peopleCategories", *dict(SEGMENTS.values()).values())
+                },
+            }
+        finally:
+            cur.close()
+    bookings = concat_rows(
+        bookings, history_frame(partitions, "bookings", SNAPSHOT_COLUMNS)
+    )
+    participants = concat_rows(participants, history.drop(columns="pid"))
+    return ReportSnapshot(
+        bookings[bookings.canceled == 0],
+        participants,
+        slots,
+        dimensions,
+        dict(SEGMENTS.values()),
+    )
+
+
+def concat_rows(*frames: pd.DataFrame) -> pd.DataFrame:
+    # The frames' rows, skipping empty frames, whose columns' types would
+    # otherwise decide the result's
+    return pd.concat([f for f in frames if len(f)] or frames[:1], ignore_index=True)
+
+
+def report_rows(
+    start: dt.date, end: dt.date, options: dict, segment: str = None
+) -> list[tuple]:
+    # The report's metrics over [start, end] from the snapshot, as one row
+    # or one per value of the bookings column segment, led by that value
+    first, last = day_range(start, end)
+    return get_snapshot().report(
+        first,
+        last,
+        products=options.get("product"),
+        groups=options.get("groupcat"),
+        categories=options.get("pricingcat"),
+        segment=segment,
+    )
+
+
+@versioned_cache(served_generation, maxsize=256)
+@metrics.timed("report_duration_seconds")
+def get_report(start: dt.date, end: dt.date, **options) -> dict:
+    (row,) = report_rows(start, end, options)
+    return dict(zip(REPORT_METRICS, row[1:]))
+
+
+@versioned_cache(served_generation, maxsize=64)
+@metrics.timed("report_duration_seconds")
+def get_segments(start: dt.date, end: dt.date, segment: str, **options) -> pd.DataFrame:
+    # get_report's metrics per value of a SEGMENTS dimension
+    column, _ = SEGMENTS[segment]
+    rows = report_rows(start, end, options, column)
+    result = pd.DataFrame(
+        [row[1:] for row in rows],
+        index=pd.Index(
+            [UNSPECIFIED if row[0] is None else row[0] for row in rows], name=segment
+        ),
+        columns=list(REPORT_METRICS),
+    )
+    return result.groupby(level=0).sum().sort_index()
+
+
+@versioned_cache(get_generation, maxsize=64)
+@metrics.timed("report_duration_seconds")
+def get_trend(
+    start: dt.date, end: dt.date, bucket: str = "Day", **options
+) -> pd.DataFrame:
+    # Metric series per day/week/month, answered from dailyRollup
+    params = {"start": start.isoformat(), "end": end.isoformat()}
+    filters = ""
+    if options.get("product"):
+        filters += """AND productId IN (SELECT id FROM products
+            WHERE name IN (SELECT value FROM json_each(:product)))"""
+        params["product"] = json.dumps(options["product"])
+    if options.get("pricingcat"):
+        filters += """AND peopleCategory IN (SELECT id FROM peopleCategories
+            WHERE name IN (SELECT value FROM json_each(:pricingcat)))"""
+        params["pricingcat"] = json.dumps(options["pricingcat"])
+    else:
+        filters += "AND peopleCategory=''"
+    if options.get("groupcat"):
+        filters += """AND groupCategory IN (SELECT id FROM groupCategories
+            WHERE name IN (SELECT value FROM json_each(:groupcat)))"""
+        params["groupcat"] = json.dumps(options["groupcat"])
+    else:
+        filters += "AND groupCategory=0"
+    q = f"""SELECT {TREND_BUCKETS[bucket]} AS period,
+        SUM(roomsBooked) AS rooms_booked, SUM(slotsBooked) AS slots_booked,
+        SUM(roomsRun) AS rooms_run, SUM(slotsRun) AS slots_run,
+        SUM(onCampusBooked) AS on_campus_booked,
+        SUM(onCampusRun) AS on_campus_run
+        FROM dailyRollup
+        WHERE day BETWEEN :start AND :end {filters}
+        GROUP BY period
+        ORDER BY period"""
+    with get_db().read() as conn:
+        return pd.read_sql_query(q, conn, params=params, index_col="period")
+
+
+def previous_period(start: dt.date, end: dt.date) -> tuple[dt.date, dt.date]:
+    # The same number of days immediately before start
+    return start - (end - start) - dt.timedelta(days=1), start - dt.timedelta(days=1)
+
+
+def get_rooms_booked(start: dt.date, end: dt.date, **options) -> int:
+    return get_report(start, end, **options)["rooms_booked"]
+
+
+def get_slots_booked(start: dt.date, end: dt.date, **options) -> int:
+    return get_report(start, end, **options)["slots_booked"]
+
+
+def get_rooms_run(start: dt.date, end: dt.date, **options) -> int:
+    return get_report(start, end, **options)["rooms_run"]
+
+
+def get_slots_run(start: dt.date, end: dt.date, **options) -> int:
+    return get_report(start, end, **options)["slots_run"]
+
+
+@versioned_cache(get_generation, maxsize=256)
+@metrics.timed("report_duration_seconds")
+def get_revenue(start: dt.date, end: dt.date, **options) -> int:
+    # Net sales in cents from dailyRevenue, or None under a people or group
+    # category filter, as Square sales have neither. The product filter
+    # selects the Square items the products are sold as (square_items).
+    if options.get("pricingcat") or options.get("groupcat"):
+        return None
+    params = {"start": start.isoformat(), "end": end.isoformat()}
+    if options.get("product"):
+        product_filter = "product IN (SELECT value FROM json_each(:product))"
+        params["product"] = json.dumps(square_items(options["product"]))
+    else:
+        product_filter = "product=''"
+    q = f"""SELECT COALESCE(SUM(netSales), 0) FROM dailyRevenue
+        WHERE day BETWEEN :start AND :end AND {product_filter}"""
+    with get_db().read() as conn:
+        return conn.execute(q, params).fetchone()[0]
+
+
+def square_items(products: list[str]) -> list[str]:
+    # The Square item names the Bookeo products are sold as: those listed
+    # for a product in SQUARE_ITEMS, else its own name
+    mapping = json.loads(os.environ.get("SQUARE_ITEMS") or "{}")
+    items = []
+    for product in products:
+        names = mapping.get(product, product)
+        items += [names] if isinstance(names, str) else names
+    return items
+
+
+@versioned_cache(served_generation, maxsize=32)
+@metrics.timed("report_duration_seconds")
+def get_fill_rates(start: dt.date, end: dt.date, **options) -> dict:
+    # Booked vs offered seats of the slots starting in [start, end]: per
+    # slot, per product and per local hour of the week. The snapshot gives
+    # each slot's seats, fill.py aggregates them. Booked slots missing from
+    # availability (fully booked, or before slots were synced) count as
+    # offered at their product's capacity, and are left out while it isn't
+    # known. Seats aren't split by people or group category, so only the
+    # product filter applies.
+    first, last = day_range(start, end)
+    snapshot = get_snapshot()
+    starts, ends, products, offered, booked = snapshot.slot_seats(
+        first, last, options.get("product")
+    )
+    names = snapshot.names["products"]
+    by_product = fill_by_key(products, offered, booked)
+    by_product.index = by_product.index.map(lambda p: names[p] or "Other")
+    slots = pd.DataFrame(
+        {
+            "startTime": starts,
+            "endTime": ends,
+            "product": pd.Series(names[products]).fillna("Other"),
+            "offered": offered,
+            "booked": booked,
+            "fill": fill_rate(booked, offered),
+        }
+    )
+    return {
+        "offered": int(offered.sum()),
+        "booked": int(booked.sum()),
+        "fill": float(fill_rate(booked.sum(), offered.sum())),
+        "slots": slots,
+        "by_product": by_product,
+        "by_hour": fill_by_hour_of_week(
+            starts, ends, offered, booked, first, last, TIMEZONE
+        ),
+    }
+
+
+def format_cents(amount: int) -> str:
+    return f"{'-' if amount < 0 else ''}${abs(amount) / 100:,.2f}"
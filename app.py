@@ -1,552 +1,144 @@
 import datetime as dt
-import email
-import imaplib
-import json
-import os
-import sqlite3
-from csv import DictReader
 
 import pandas as pd
-import pytz
-import requests
 import streamlit as st
 
+import metrics
+from analytics import (
+    REPORT_METRICS,
+    SEGMENTS,
+    TIMEZONE,
+    TREND_BUCKETS,
+    configure,
+    format_cents,
+    get_bookings_refresher,
+    get_db,
+    get_fill_rates,
+    get_group_options,
+    get_history_refresher,
+    get_people_categories,
+    get_products,
+    get_report,
+    get_revenue,
+    get_revenue_refresher,
+    get_roster_refresher,
+    get_segments,
+    get_settings_refresher,
+    get_slots_refresher,
+    get_snapshot,
+    get_snapshot_generation,
+    get_square,
+    get_trend,
+    previous_period,
+)
+
+# The Streamlit dashboard. Syncing and the metrics themselves live in
+# analytics.py, which cli.py also runs without Streamlit.
+
 # TODO:
 # -> Square functionality <-
-# https://developer.squareup.com/reference/square/orders-api
-# https://developer.squareup.com/reference/square/payments-api
-# https://developer.squareup.com/reference/square/catalog-api
-# Revenue
-# - Bookings
-# - Invoices
 # Cost of labor
 # - Hourly wages
 # - Bonuses
-# -> Bookeo functionality <-
-# Fill rate (low priority)
-# Customer segmentation
-# - Group category
-# - Contact method
 # -> Google functionality <-
 # Number of reviews (low priority)
 # Reviews by quality (low priority)
 
-ZULU_FORMAT = "%Y-%m-%dT%H:%M:00Z"
-
-
-def BookeoUpdate(func):
-    def wrapper(*args, **kwargs):
-        update_bookings()
-        return func(*args, **kwargs)
-
-    return wrapper
-
 
 def init_keys():
-    os.environ["USER_AGENT"] = "CTE Sales Report Engine v0.1"
-    # os.environ["SQUARE_API_KEY"] = st.secrets["SQUARE_API_KEY"]
-    os.environ["BOOKEO_API_KEY"] = st.secrets["BOOKEO_API_KEY"]
-    os.environ["BOOKEO_SECRET_KEY"] = st.secrets["BOOKEO_SECRET_KEY"]
-    os.environ["DATABASE"] = st.secrets["DATABASE_PATH"]
-    os.environ["IMAP_SERVER"] = st.secrets["IMAP_SERVER"]
-    os.environ["EMAIL"] = st.secrets["EMAIL"]
-    os.environ["EMAIL_PASSWORD"] = st.secrets["EMAIL_PASSWORD"]
-    os.environ["ROSTER_SUBJECT"] = st.secrets["ROSTER_SUBJECT"]
-    os.environ["ROSTER_SENDER"] = st.secrets["ROSTER_SENDER"]
-    os.environ["TEMPFILE"] = st.secrets["TEMPFILE"]
-
-
-def init_db():
-    db_path = os.environ["DATABASE"]
-    open(db_path, "w+").close()  # create file if not exists
-    # Set up tables
-    connection = sqlite3.connect(db_path, check_same_thread=False)
-    cur = connection.cursor()
-    try:
-        cur.execute(
-            """CREATE TABLE IF NOT EXISTS bookings (
-            id INT PRIMARY KEY,
-            eventId INT NOT NULL,
-            startTime TEXT NOT NULL,
-            endTime TEXT NOT NULL,
-            customerId TEXT,
-            title TEXT,
-            canceled INT NOT NULL CHECK(canceled=0 OR canceled=1),
-            accepted INT NOT NULL CHECK(accepted=0 OR accepted=1),
-            sourceIP TEXT,
-            creationTime TEXT NOT NULL,
-            privateEvent INT NOT NULL CHECK(privateEvent=0 OR privateEvent=1),
-            noShow INT NOT NULL CHECK(noShow=0 OR noShow=1),
-            productId TEXT NOT NULL,
-            creationAgent TEXT,
-            FOREIGN KEY(productId) REFERENCES products(id))"""
-        )
-        cur.execute(
-            """CREATE TABLE IF NOT EXISTS participants (
-            bookingId INT NOT NULL,
-            firstName TEXT,
-            lastName TEXT,
-            peopleCategory TEXT,
-            pid INT,
-            FOREIGN KEY(peopleCategory) REFERENCES peopleCategories(id),
-            FOREIGN KEY(bookingId) REFERENCES bookings(id))"""
+    configure(st.secrets)
+
+
+def generate_report(start: dt.date, end: dt.date, bucket: str = "Day", **options):
+    refresher = get_bookings_refresher()
+    revenue_refresher = get_revenue_refresher()
+    slots_refresher = get_slots_refresher()
+    with st.spinner("Fetching latest bookings..."):
+        # Only blocks when nothing has been synced yet
+        refresher.refresh(wait=False)
+        revenue_refresher.refresh(wait=False)
+        slots_refresher.refresh(wait=False)
+    if (
+        refresher.refreshing
+        or revenue_refresher.refreshing
+        or slots_refresher.refreshing
+    ):
+        st.caption("Syncing new bookings in the background, showing the last sync.")
+    with st.spinner("Loading bookings..."):
+        # Only waits before the first load; later syncs are loaded in the
+        # background while every report below reads the previous snapshot
+        get_snapshot()
+    if get_snapshot.generation() != get_snapshot_generation():
+        st.caption("Loading the latest bookings in the background, showing the last.")
+    report = get_report(start, end, **options)
+    prev_start, prev_end = previous_period(start, end)
+    previous = get_report(prev_start, prev_end, **options)
+    square = get_square() is not None
+    # None under pricing or group category filters, which Square sales lack
+    revenue = get_revenue(start, end, **options) if square else None
+    columns = st.columns(len(REPORT_METRICS) + (revenue is not None))
+    for col, (metric, label) in zip(columns, REPORT_METRICS.items()):
+        col.metric(label, report[metric], report[metric] - previous[metric])
+    if revenue is not None:
+        change = revenue - get_revenue(prev_start, prev_end, **options)
+        columns[-1].metric("Revenue", format_cents(revenue), format_cents(change))
+    st.caption(f"Change vs. {prev_start:%m/%d/%Y} - {prev_end:%m/%d/%Y}")
+    if square and revenue is None:
+        st.caption("Revenue isn't split by pricing or group category.")
+
+    st.write("## Customer segments")
+    for col, segment in zip(st.columns(len(SEGMENTS)), SEGMENTS):
+        col.dataframe(
+            get_segments(start, end, segment, **options).rename(columns=REPORT_METRICS)
         )
-        cur.execute(
-            """CREATE TABLE IF NOT EXISTS peopleCategories (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL)"""
-        )
-        cur.execute(
-            """CREATE TABLE IF NOT EXISTS products (
-            id TEXT PRIMARY KEY,
-            name TEXT)"""
+
+    rates = get_fill_rates(start, end, **options)
+    if rates["offered"]:
+        st.write("## Fill rate")
+        previous_fill = get_fill_rates(prev_start, prev_end, **options)["fill"]
+        st.metric(
+            "Seats filled",
+            f"{rates['fill']:.1%}",
+            None
+            if pd.isna(previous_fill)
+            else f"{(rates['fill'] - previous_fill) * 100:+.1f} pts",
         )
-        cur.execute(
-            """CREATE TABLE IF NOT EXISTS onCampusPids (
-            pid INT PRIMARY KEY,
-            firstName TEXT,
-            lastName TEXT)"""
+        st.dataframe(
+            rates["by_product"],
+            column_config={
+                "offered": "Seats offered",
+                "booked": "Seats booked",
+                "fill": st.column_config.ProgressColumn(
+                    "Fill rate", format="%.2f", min_value=0, max_value=1
+                ),
+            },
         )
-        connection.commit()
-    finally:
-        cur.close()
-
-
-@st.cache_resource
-def get_db() -> sqlite3.Connection:
-    connection = sqlite3.connect(os.environ["DATABASE"], check_same_thread=False)
-    return connection
-
-
-@st.cache_data(ttl="12 hours", show_spinner="Fetching on-campus PIDs...")
-def update_roster():
-    # https://gist.github.com/kngeno/5337e543eb72174a6ac95e028b3b6456
-    with imaplib.IMAP4_SSL(os.environ["IMAP_SERVER"], port=993) as imap:
-        val, _ = imap.login(os.environ["EMAIL"], os.environ["EMAIL_PASSWORD"])
-        if val != "OK":
-            return
-
-        imap.select("Inbox")
-        val, f = imap.search(
-            None,
-            f'(FROM "{os.environ["ROSTER_SENDER"]}" SUBJECT "{os.environ["ROSTER_SUBJECT"]}")',
+        by_hour = rates["by_hour"]
+        heatmap = by_hour.pivot(index="hour", columns="weekday", values="fill")
+        st.caption("Seats filled by local hour of the week (%)")
+        st.dataframe(
+            (heatmap[by_hour["weekday"].unique()] * 100).round().dropna(how="all")
         )
-        if val != "OK":
-            return
-
-        # Fetch from IMAP, download roster to temp file
-        with open(os.environ["TEMPFILE"], "wb") as temp:
-            for id in reversed(f[0].split()):
-                val, msgParts = imap.fetch(id, "(RFC822)")
-                if val != "OK":
-                    continue
-                mail = msgParts[0][1]
-                mail = mail.decode("utf-8")
-                mail = email.message_from_string(mail)
-                for part in mail.walk():
-                    fname = part.get_filename()
-                    if fname:
-                        temp.write(part.get_payload(decode=True))
-                        escape = True
-                        break
-                if escape:
-                    break
-
-        with open(os.environ["TEMPFILE"], "r") as f:
-            roster = DictReader(f)
-            roster = list(roster)  # iterable -> list[dict]
-
-            for key in roster[0].keys():
-                if "pid" in key.lower():
-                    pidKey = key
-                elif "first" in key.lower():
-                    firstNameKey = key
-                elif "last" in key.lower():
-                    lastNameKey = key
-
-            if None in [pidKey, firstNameKey, lastNameKey]:
-                print("Could not read roster")
-                return
-
-            conn = get_db()
-            cur = conn.cursor()
-            try:
-                cur.execute("DELETE FROM onCampusPids")
-                # The roster may contain duplicate entries... let's ignore them
-                q = """INSERT OR IGNORE INTO onCampusPids (pid, firstName, lastName)
-                        VALUES (?, ?, ?)"""
-                roster = [(r[pidKey], r[firstNameKey], r[lastNameKey]) for r in roster]
-                cur.executemany(q, roster)
-                conn.commit()
-            finally:
-                cur.close()
-                os.remove(os.environ["TEMPFILE"])
 
-
-@st.cache_data(ttl="1 hour", show_spinner="Fetching latest bookings...")
-def update_bookings():
-    # https://www.bookeo.com/apiref/#tag/Bookings/paths/~1bookings/get
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        cur.execute("DELETE FROM bookings")
-        cur.execute("DELETE FROM participants")
-
-        q1 = """INSERT INTO bookings (id, eventId, startTime, endTime,
-            customerId, title, canceled, accepted, sourceIp, creationTime,
-            creationAgent, productId, privateEvent, noShow)
-            VALUES (:bookingNumber, :eventId, :startTime, :endTime,
-            :customerId, :title, :canceled, :accepted, :sourceIp,
-            :creationTime, :creationAgent, :productId, :privateEvent,
-            :noShow)"""
-        q2 = """INSERT INTO participants (bookingId, firstName,
-            lastName, peopleCategory, pid)
-            VALUES (?, ?, ?, ?, ?)"""
-
-        start = dt.date(year=2023, month=1, day=1)
-        start = dt.datetime.combine(start, dt.time(0, 0, 0))
-        end = dt.datetime.now()
-        day_range = (end - start).days
-        block_start = start
-        for b in range(day_range // 30):
-            block_start = start + dt.timedelta(days=31 * b)
-            block_end = block_start + dt.timedelta(days=30)
-            block_end = dt.datetime.combine(block_end, dt.time(23, 59, 59))
-            block_end = min(block_end, end)
-            res = requests.get(
-                "https://api.bookeo.com/v2/bookings",
-                params={
-                    "startTime": block_start.strftime(ZULU_FORMAT),
-                    "endTime": block_end.strftime(ZULU_FORMAT),
-                    "secretKey": os.environ["BOOKEO_SECRET_KEY"],
-                    "apiKey": os.environ["BOOKEO_API_KEY"],
-                    "expandParticipants": True,
-                    "itemsPerPage": 100,
-                },
-                headers={"User-Agent": os.environ["USER_AGENT"]},
-            )
-            if res.status_code == 200:
-                bookings = res.json()["data"]
-                cur.executemany(
-                    q1,
-                    [
-                        {
-                            "bookingNumber": b.get("bookingNumber"),
-                            "eventId": b.get("eventId"),
-                            "startTime": b.get("startTime"),
-                            "endTime": b.get("endTime"),
-                            "customerId": b.get("customerId"),
-                            "title": b.get("title"),
-                            "canceled": b.get("canceled"),
-                            "accepted": b.get("accepted"),
-                            "sourceIp": b.get("sourceIp"),
-                            "creationTime": b.get("creationTime"),
-                            "creationAgent": b.get("creationAgent"),
-                            "productId": b.get("productId"),
-                            "privateEvent": b.get("privateEvent"),
-                            "noShow": b.get("noShow"),
-                        }
-                        for b in bookings
-                    ],
-                )
-                for booking in bookings:
-                    participant_data = booking["participants"]["details"]
-                    for p in participant_data:
-                        if p.get("personDetails") is None:
-                            p["firstName"] = None
-                            p["lastName"] = None
-                    cur.executemany(
-                        q2,
-                        [
-                            (
-                                booking["bookingNumber"],
-                                p.get("firstName"),
-                                p.get("lastName"),
-                                p["peopleCategoryId"],
-                                extract_pid(p),
-                            )
-                            for p in participant_data
-                        ],
-                    )
-            page_token = res.json()["info"].get("pageNavigationToken")
-            total_pages = res.json()["info"]["totalPages"]
-            page_number = 2
-
-            while page_number <= total_pages:
-                res = requests.get(
-                    "https://api.bookeo.com/v2/bookings",
-                    params={
-                        "pageNavigationToken": page_token,
-                        "pageNumber": page_number,
-                        "secretKey": os.environ["BOOKEO_SECRET_KEY"],
-                        "apiKey": os.environ["BOOKEO_API_KEY"],
-                    },
-                    headers={"User-Agent": os.environ["USER_AGENT"]},
-                )
-                if res.status_code == 200:
-                    bookings = res.json()["data"]
-                    cur.executemany(
-                        q1,
-                        [
-                            {
-                                "bookingNumber": b.get("bookingNumber"),
-                                "eventId": b.get("eventId"),
-                                "startTime": b.get("startTime"),
-                                "endTime": b.get("endTime"),
-                                "customerId": b.get("customerId"),
-                                "title": b.get("title"),
-                                "canceled": b.get("canceled"),
-                                "accepted": b.get("accepted"),
-                                "sourceIp": b.get("sourceIp"),
-                                "creationTime": b.get("creationTime"),
-                                "creationAgent": b.get("creationAgent"),
-                                "productId": b.get("productId"),
-                                "privateEvent": b.get("privateEvent"),
-                                "noShow": b.get("noShow"),
-                            }
-                            for b in bookings
-                        ],
-                    )
-                    for booking in bookings:
-                        participant_data = booking["participants"]["details"]
-                        for p in participant_data:
-                            if p.get("personDetails") is None:
-                                p["firstName"] = None
-                                p["lastName"] = None
-                        cur.executemany(
-                            q2,
-                            [
-                                (
-                                    booking["bookingNumber"],
-                                    p.get("firstName"),
-                                    p.get("lastName"),
-                                    p["peopleCategoryId"],
-                                    extract_pid(p),
-                                )
-                                for p in participant_data
-                            ],
-                        )
-                page_number += 1
-
-        conn.commit()
-    finally:
-        cur.close()
-
-
-def extract_pid(participant: dict) -> str:
-    try:
-        for f in participant["personDetails"]["customFields"]:
-            if f["name"] == "PID":
-                return f["value"]
-        return None
-    except:
-        return None
-
-
-def update_group_categories():
-    return
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM groupCategories")
-    cur.close()
-
-
-def get_group_options() -> list[str]:
-    update_group_categories()
-    return []
-
-
-def extract_group_category(data: dict) -> str:
-    return ""
-
-
-def update_people_categories():
-    # https://www.bookeo.com/apiref/#tag/Settings/paths/~1settings~1peoplecategories/get
-    res = requests.get(
-        "https://api.bookeo.com/v2/settings/peoplecategories",
-        params={
-            "secretKey": os.environ["BOOKEO_SECRET_KEY"],
-            "apiKey": os.environ["BOOKEO_API_KEY"],
-        },
-        headers={"User-Agent": os.environ["USER_AGENT"]},
-    )
-    data = res.json()
-    if res.status_code != 200 or "categories" not in data.keys():
+    trend = get_trend(start, end, bucket, **options).rename(columns=REPORT_METRICS)
+    if trend.empty:
         return
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        cur.execute("DELETE FROM peopleCategories")
-        q = """INSERT INTO peopleCategories (id, name)
-            VALUES (:id, :name)"""
-        cur.executemany(q, data["categories"])
-        conn.commit()
-    finally:
-        cur.close()
-
-
-def get_people_categories() -> list[str]:
-    update_people_categories()
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        q = "SELECT name FROM peopleCategories"
-        names = cur.execute(q).fetchall()
-        return [n[0] for n in names]
-    finally:
-        cur.close()
-
-
-def update_products():
-    # https://www.bookeo.com/apiref/#tag/Settings/paths/~1settings~1products/get
-    res = requests.get(
-        "https://api.bookeo.com/v2/settings/products",
-        params={
-            "secretKey": os.environ["BOOKEO_SECRET_KEY"],
-            "apiKey": os.environ["BOOKEO_API_KEY"],
-            "itemsPerPage": 100,
-        },
-        headers={"User-Agent": os.environ["USER_AGENT"]},
+    st.write(f"## Trend by {bucket.lower()}")
+    st.line_chart(trend[[REPORT_METRICS["rooms_booked"], REPORT_METRICS["rooms_run"]]])
+    st.line_chart(
+        trend[
+            [
+                REPORT_METRICS["slots_booked"],
+                REPORT_METRICS["slots_run"],
+                REPORT_METRICS["on_campus_run"],
+            ]
+        ]
     )
-    data = res.json()
-    if res.status_code != 200 or "data" not in data.keys():
-        return
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        cur.execute("DELETE FROM products")
-        products = [(p["name"], p["productCode"]) for p in data["data"]]
-        q = """INSERT INTO products (name, id)
-            VALUES (?, ?)"""
-        cur.executemany(q, products)
-        conn.commit()
-    finally:
-        cur.close()
-
-
-def get_products() -> list[str]:
-    update_products()
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        q = "SELECT name FROM products"
-        names = cur.execute(q).fetchall()
-        return [n[0] for n in names]
-    finally:
-        cur.close()
-
-
-@BookeoUpdate
-def get_rooms_booked(start: dt.date, end: dt.date, **options) -> int:
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        params = {"start": start, "end": end}
-        q = """SELECT COUNT(DISTINCT creationTime)
-            FROM bookings
-            WHERE creationTime BETWEEN :start AND :end
-            AND NOT canceled """
-        if options["product"]:
-            sq = (
-                "SELECT id FROM products WHERE name IN (SELECT value FROM json_each(?))"
-            )
-            product_ids = cur.execute(sq, (json.dumps(options["product"]),)).fetchall()
-            q += " AND productId IN (SELECT value FROM json_each(:product_ids)) "
-            params["product_ids"] = json.dumps([p[0] for p in product_ids])
-        count = cur.execute(q, params).fetchone()
-        return count[0]
-    finally:
-        cur.close()
-
-
-@BookeoUpdate
-def get_slots_booked(start: dt.date, end: dt.date, **options) -> int:
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        params = {"start": start, "end": end}
-        q = """SELECT COUNT(*)
-            FROM participants p JOIN bookings b
-            ON p.bookingId=b.id
-            WHERE creationTime BETWEEN :start AND :end"""
-        if options["product"]:
-            sq = (
-                "SELECT id FROM products WHERE name IN (SELECT value FROM json_each(?))"
-            )
-            product_ids = cur.execute(sq, (json.dumps(options["product"]),)).fetchall()
-            q += " AND productId IN (SELECT value FROM json_each(:product_ids)) "
-            params["product_ids"] = json.dumps([p[0] for p in product_ids])
-        count = cur.execute(q, params).fetchone()
-        return count[0]
-    finally:
-        cur.close()
-
-
-@BookeoUpdate
-def get_rooms_run(start: dt.date, end: dt.date, **options) -> int:
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        params = {"start": start, "end": end}
-        q = """SELECT COUNT(DISTINCT startTime)
-            FROM bookings
-            WHERE startTime BETWEEN :start AND :end
-            AND NOT canceled """
-        if options["product"]:
-            sq = (
-                "SELECT id FROM products WHERE name IN (SELECT value FROM json_each(?))"
-            )
-            product_ids = cur.execute(sq, (json.dumps(options["product"]),)).fetchall()
-            q += " AND productId IN (SELECT value FROM json_each(:product_ids)) "
-            params["product_ids"] = json.dumps([p[0] for p in product_ids])
-        count = cur.execute(q, params).fetchone()
-        return count[0]
-    finally:
-        cur.close()
-
-
-@BookeoUpdate
-def get_slots_run(start: dt.date, end: dt.date, **options) -> int:
-    conn = get_db()
-    cur = conn.cursor()
-    try:
-        params = {"start": start, "end": end}
-        q = """SELECT COUNT(*)
-            FROM participants p JOIN bookings b
-            ON p.bookingId=b.id
-            WHERE startTime BETWEEN :start AND :end"""
-        if options["product"]:
-            sq = (
-                "SELECT id FROM products WHERE name IN (SELECT value FROM json_each(?))"
-            )
-            product_ids = cur.execute(sq, (json.dumps(options["product"]),)).fetchall()
-            q += " AND productId IN (SELECT value FROM json_each(:product_ids)) "
-            params["product_ids"] = json.dumps([p[0] for p in product_ids])
-        count = cur.execute(q, params).fetchone()
-        return count[0]
-    finally:
-        cur.close()
-
-
-def get_revenue(start: dt.date, end: dt.date, **options) -> int:
-    return -1
-
-
-def generate_report(start: dt.date, end: dt.date, **options):
-    rooms_booked = get_rooms_booked(start, end, **options)
-    slots_booked = get_slots_booked(start, end, **options)
-    rooms_run = get_rooms_run(start, end, **options)
-    slots_run = get_slots_run(start, end, **options)
-    # revenue = get_revenue(start, end, **options)
-    st.write(f"Rooms booked: {rooms_booked}")
-    st.write(f"Slots booked: {slots_booked}")
-    st.write(f"Rooms run: {rooms_run}")
-    st.write(f"Slots run: {slots_run}")
 
 
 def main():
     st.write("# Escape Room Analytics")
-    today = dt.datetime.now(pytz.timezone("US/Eastern"))
+    today = dt.datetime.now(TIMEZONE)
     start_date = st.date_input(
         "Start date",
         max_value=today,
@@ -563,6 +155,7 @@ def main():
         st.write("*End date cannot be before start date!*")
         return
     st.write("## Parameters")
+    get_settings_refresher().refresh(wait=False)
     report_options = {
         "pricingcat": st.multiselect(
             "Pricing category",
@@ -581,18 +174,75 @@ def main():
     # "cost_of_labor": st.checkbox("Cost of labor"),
     # "wages": st.checkbox("Wages"),
     # "bonuses": st.checkbox("Bonuses"),
-    # "contact_method": st.checkbox("Contact method"),
     # force_cache_refresh = st.checkbox("Force cache refresh?")
     # if force_cache_refresh:
 
     #     st.cache_data.clear()
-    update_roster()
+    if st.sidebar.checkbox("Show performance metrics"):
+        show_metrics()
+    if st.sidebar.button("Full Bookeo resync"):
+        # Repairs drift from the incremental sync by downloading all history
+        # again, rather than replaying the archive
+        with st.spinner("Reloading all bookings..."):
+            get_bookings_refresher().refresh(force=True, full_resync=True)
+    with st.spinner("Fetching on-campus PIDs..."):
+        # Only blocks the first time, before any roster has been loaded
+        get_roster_refresher().refresh(wait=False)
+    with st.spinner("Compacting booking history..."):
+        # Daily, and only blocks the first time
+        get_history_refresher().refresh(wait=False)
+    bucket = st.radio("Trend by", options=list(TREND_BUCKETS), horizontal=True)
     report_btn = st.button("Generate report")
     if report_btn:
-        generate_report(start_date, end_date, **report_options)
+        generate_report(start_date, end_date, bucket, **report_options)
+
+
+def show_metrics():
+    # Debug panel: report cache hit rates and latency per call site since
+    # the process started, then row, byte, retry and cache counters
+    with st.sidebar.expander("Performance metrics", expanded=True):
+        summary = pd.DataFrame(metrics.REGISTRY.summary())
+        if summary.empty:
+            st.write("Nothing recorded yet.")
+            return
+        requests = [
+            {"function": c["labels"]["function"], c["labels"]["result"]: c["value"]}
+            for c in metrics.REGISTRY.counters()
+            if c["name"] == "cache_requests_total"
+        ]
+        if requests:
+            cache = pd.DataFrame(requests).groupby("function").sum()
+            cache = cache.reindex(columns=["hit", "miss"], fill_value=0)
+            cache["hit_rate"] = cache["hit"] / (cache["hit"] + cache["miss"])
+            st.caption("Report cache")
+            st.dataframe(
+                cache,
+                column_config={
+                    "hit_rate": st.column_config.ProgressColumn(
+                        "Hit rate", format="%.2f", min_value=0, max_value=1
+                    )
+                },
+            )
+        for name, group in summary.groupby("metric", sort=False):
+            st.caption(name)
+            st.dataframe(
+                group.drop(columns="metric").dropna(axis=1, how="all"),
+                hide_index=True,
+            )
+        counters = pd.DataFrame(metrics.REGISTRY.counters())
+        if not counters.empty:
+            labels = counters.pop("labels").map(
+                lambda l: ", ".join(f"{k}={v}" for k, v in l.items())
+            )
+            st.caption("Counters")
+            st.dataframe(counters.assign(labels=labels), hide_index=True)
 
 
 if __name__ == "__main__":
     init_keys()
-    init_db()
-    main()
+    get_db()
+    try:
+        with metrics.timer("page_render_seconds"):
+            main()
+    finally:
+        metrics.export()
@@ -0,0 +1,75 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+
+class ResponseArchive:
+    # Raw API pages on local disk, so history can be re-derived without
+    # downloading it again. Each distinct page is stored once, gzipped,
+    # under the SHA-256 of its JSON (objects/ab/abcd....json.gz), and
+    # manifest.jsonl lists every fetch of every page in the order they
+    # came: when (the sync's start time), what kind of fetch, the window
+    # requested, page n of total, and the page's digest.
+    def __init__(self, root: str):
+        self.root = root
+        self.manifest = os.path.join(root, "manifest.jsonl")
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], f"{digest}.json.gz")
+
+    def put(self, page: dict) -> str:
+        data = json.dumps(page, sort_keys=True, separators=(",", ":")).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp, "wb", compresslevel=6) as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest: str) -> dict:
+        with gzip.open(self._path(digest), "rb") as f:
+            return json.loads(f.read())
+
+    def record(self, **entry):
+        line = json.dumps(entry, sort_keys=True) + "\n"
+        with self._lock, open(self.manifest, "a") as f:
+            f.write(line)
+
+    def entries(self) -> list[dict]:
+        if not os.path.exists(self.manifest):
+            return []
+        entries = []
+        with open(self.manifest) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Torn last line of a sync that died mid-write
+                    continue
+        return entries
+
+    def fetches(self, kind: str) -> list[dict]:
+        # Every complete fetch of a window, oldest first, as its fetch time,
+        # window and page digests in page order
+        pages = {}
+        for e in self.entries():
+            if e["kind"] == kind:
+                key = (e["fetched"], json.dumps(e["window"], sort_keys=True))
+                fetch = pages.setdefault(key, {"total": e["pages"], "pages": {}})
+                fetch["pages"][e["page"]] = e["digest"]
+        return [
+            {
+                "fetched": fetched,
+                "window": json.loads(window),
+                "digests": [f["pages"][n] for n in range(1, max(f["total"], 1) + 1)],
+            }
+            for (fetched, window), f in sorted(pages.items())
+            if all(n in f["pages"] for n in range(1, max(f["total"], 1) + 1))
+        ]
@@ -0,0 +1,438 @@
+import argparse
+import datetime as dt
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+import synthetic
+
+# Times the sync and report paths against synthetic data served by a local
+# mock Bookeo, without a Streamlit server:
+#   python benchmark.py --sizes 10000 100000 --output bench_results.json
+#   python benchmark.py --compare bench_results.json
+
+
+def percentile(samples: list[float], p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def measure(fn, repeat: int, memory: bool, setup=None) -> dict:
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    result = {
+        "runs": repeat,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "mean_ms": statistics.fmean(timings) * 1000,
+    }
+    if memory:
+        # Separate traced run, tracemalloc slows everything down
+        if setup:
+            setup()
+        tracemalloc.start()
+        fn()
+        result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result
+
+
+def random_ranges(n: int, seed: int, days: int = 30) -> list[tuple[dt.date, dt.date]]:
+    rng = random.Random(seed)
+    first = dt.date(2023, 1, 2)
+    span = (dt.date.today() - first).days - days
+    ranges = []
+    for _ in range(n):
+        start = first + dt.timedelta(days=rng.randrange(span))
+        ranges.append((start, start + dt.timedelta(days=days)))
+    return ranges
+
+
+def run_size(analytics, n: int, args) -> dict:
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=synthetic.serve, args=(n, args.seed, child), daemon=True
+    )
+    server.start()
+    url, square_url = parent.recv()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ["DATABASE"] = os.path.join(workdir, "bench.sqlite3")
+    os.environ["BOOKEO_API_URL"] = url
+    os.environ["SQUARE_API_URL"] = square_url
+    analytics.get_db.clear()
+    analytics.get_bookeo.clear()
+    analytics.get_square.clear()
+    analytics.get_archive.clear()
+    analytics.get_history.clear()
+    analytics.get_history_refresher.clear()
+    analytics.get_snapshot.clear()
+    analytics.get_bookings_refresher.clear()
+    analytics.get_settings_refresher.clear()
+    analytics.get_revenue_refresher.clear()
+    analytics.get_slots_refresher.clear()
+    analytics.get_db()
+    analytics.update_settings()
+    results = {}
+    try:
+
+        def cold_sync():
+            analytics.get_bookings_refresher().refresh(force=True, full_resync=True)
+
+        print(f"[{n}] cold sync...", file=sys.stderr)
+        results["cold_sync"] = measure(cold_sync, 1, args.memory)
+
+        def mutate(base_url: str):
+            req = urllib.request.Request(
+                f"{base_url}/_mutate?count={args.changes}"
+                f"&seed={random.randrange(2**31)}",
+                method="POST",
+            )
+            urllib.request.urlopen(req).read()
+
+        def incremental_sync():
+            analytics.get_bookings_refresher().refresh(force=True)
+
+        def replay():
+            analytics.get_bookings_refresher().refresh(force=True, replay=True)
+
+        print(f"[{n}] replay...", file=sys.stderr)
+        results["replay"] = measure(replay, args.sync_repeat, args.memory)
+
+        print(f"[{n}] incremental sync...", file=sys.stderr)
+        results["incremental_sync"] = measure(
+            incremental_sync,
+            args.sync_repeat,
+            args.memory,
+            setup=lambda: mutate(url),
+        )
+
+        def revenue_sync():
+            analytics.get_revenue_refresher().refresh(force=True)
+
+        def reset_revenue():
+            with analytics.get_db().write() as conn:
+                conn.execute(
+                    """DELETE FROM syncState
+                    WHERE key IN ('squareOrdersUpdated', 'squarePaymentsUpdated')"""
+                )
+                conn.commit()
+
+        print(f"[{n}] Square sync...", file=sys.stderr)
+        results["revenue_cold_sync"] = measure(
+            revenue_sync, 1, args.memory, setup=reset_revenue
+        )
+        results["revenue_incremental_sync"] = measure(
+            revenue_sync,
+            args.sync_repeat,
+            args.memory,
+            setup=lambda: mutate(square_url),
+        )
+
+        def slots_sync():
+            analytics.get_slots_refresher().refresh(force=True)
+
+        print(f"[{n}] slots sync...", file=sys.stderr)
+        results["slots_sync"] = measure(slots_sync, 1, args.memory)
+
+        # Alternate between two rosters so every load applies a real diff
+        data = synthetic.SyntheticBookeo(n, args.seed)
+        rosters = itertools.cycle([data.roster_csv(seed=1), data.roster_csv(seed=2)])
+        analytics.load_roster(next(rosters))
+
+        print(f"[{n}] roster load...", file=sys.stderr)
+        results["load_roster"] = measure(
+            lambda: analytics.load_roster(next(rosters)), args.sync_repeat, args.memory
+        )
+
+        # Ingest throughput without HTTP: pages decoded up front, written
+        # in one transaction that is rolled back afterwards
+        pages = [
+            [data.booking(i) for i in range(j, min(j + 100, n))]
+            for j in range(0, n, 100)
+        ]
+        total_rows = n + sum(
+            len(b["participants"]["details"]) for p in pages for b in p
+        )
+
+        def ingest():
+            with analytics.get_db().write() as conn:
+                cur = conn.cursor()
+                cur.execute("DELETE FROM bookings")
+                cur.execute("DELETE FROM participants")
+                analytics.ingest_bookings(cur, iter(pages), track_days=False)
+
+        def classify():
+            for page in pages:
+                for booking in page:
+                    analytics.extract_group_category(booking)
+                    analytics.extract_contact_method(booking)
+
+        print(f"[{n}] classify...", file=sys.stderr)
+        results["classify"] = measure(classify, args.sync_repeat, args.memory)
+        results["classify"]["rows_per_sec"] = n / (results["classify"]["p50_ms"] / 1000)
+
+        print(f"[{n}] ingest...", file=sys.stderr)
+        results["ingest"] = measure(ingest, args.sync_repeat, args.memory)
+        results["ingest"]["rows_per_sec"] = total_rows / (
+            results["ingest"]["p50_ms"] / 1000
+        )
+
+        conn = sqlite3.connect(os.environ["DATABASE"])
+        rows = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM bookings), (SELECT COUNT(*) FROM participants)"
+        ).fetchone()
+        conn.close()
+        results["rows"] = {"bookings": rows[0], "participants": rows[1]}
+
+        # Loading every booking into the report snapshot, as the first
+        # report does and the background reload after each sync
+        print(f"[{n}] load snapshot...", file=sys.stderr)
+        results["load_snapshot"] = measure(
+            analytics.get_snapshot,
+            args.sync_repeat,
+            args.memory,
+            setup=analytics.get_snapshot.clear,
+        )
+
+        # The dashboard's report page, drawn without a Streamlit server
+        import app
+
+        options = {"product": [], "pricingcat": [], "groupcat": []}
+        cases = {
+            "get_rooms_booked": analytics.get_rooms_booked,
+            "get_slots_booked": analytics.get_slots_booked,
+            "get_rooms_run": analytics.get_rooms_run,
+            "get_slots_run": analytics.get_slots_run,
+            "get_report": analytics.get_report,
+            "get_revenue": analytics.get_revenue,
+            "get_fill_rates": analytics.get_fill_rates,
+            "get_segments": lambda start, end, **options: analytics.get_segments(
+                start, end, "Group category", **options
+            ),
+            "generate_report": app.generate_report,
+        }
+        for name, fn in cases.items():
+            print(f"[{n}] {name}...", file=sys.stderr)
+            ranges = iter(random_ranges(args.repeat + 1, args.seed))
+
+            def run():
+                start, end = next(ranges)
+                fn(start, end, **options)
+
+            # Computed every time: these cases share their date ranges
+            results[name] = measure(
+                run, args.repeat, args.memory, setup=lambda: clear_caches(analytics)
+            )
+
+        # The same report again, with no sync in between
+        print(f"[{n}] get_report cached...", file=sys.stderr)
+        cached = random_ranges(1, args.seed)[0]
+        analytics.get_report(*cached, **options)
+        results["get_report_cached"] = measure(
+            lambda: analytics.get_report(*cached, **options), args.repeat, args.memory
+        )
+
+        # A year of hourly slots across every room
+        print(f"[{n}] get_fill_rates over a year...", file=sys.stderr)
+        years = iter(random_ranges(args.repeat + 1, args.seed, days=365))
+        results["fill_rates_year"] = measure(
+            lambda: analytics.get_fill_rates(*next(years), **options),
+            args.repeat,
+            args.memory,
+            setup=lambda: clear_caches(analytics),
+        )
+
+        # Reports over most of the history, before and after the closed
+        # months move to Parquet
+        def over_years(fn, days: int):
+            spans = iter(random_ranges(args.repeat + 1, args.seed, days=days))
+            return measure(
+                lambda: fn(*next(spans), **options),
+                args.repeat,
+                args.memory,
+                setup=lambda: clear_caches(analytics),
+            )
+
+        print(f"[{n}] get_report over three years...", file=sys.stderr)
+        results["report_3_years"] = over_years(analytics.get_report, 1000)
+
+        def compact():
+            analytics.get_history_refresher().refresh(force=True)
+
+        print(f"[{n}] compact history...", file=sys.stderr)
+        results["compact_history"] = measure(compact, 1, args.memory)
+        conn = sqlite3.connect(os.environ["DATABASE"])
+        results["rows_compacted"] = dict(
+            zip(
+                ("bookings", "participants"),
+                conn.execute(
+                    """SELECT COALESCE(SUM(bookings), 0),
+                    COALESCE(SUM(participants), 0) FROM historyPartitions"""
+                ).fetchone(),
+            )
+        )
+        conn.close()
+
+        print(f"[{n}] reports over compacted history...", file=sys.stderr)
+        results["report_3_years_compacted"] = over_years(analytics.get_report, 1000)
+        results["fill_rates_year_compacted"] = over_years(analytics.get_fill_rates, 365)
+
+        print(
+            f"[{n}] {args.sessions} sessions reading during a sync...", file=sys.stderr
+        )
+        results["reads_during_sync"] = reads_during_sync(
+            analytics, args.sessions, args.seed
+        )
+    finally:
+        parent.send("stop")
+        server.join()
+    return results
+
+
+def clear_caches(analytics):
+    for fn in (
+        analytics.get_report,
+        analytics.get_trend,
+        analytics.get_revenue,
+        analytics.get_fill_rates,
+        analytics.get_segments,
+    ):
+        fn.clear()
+
+
+def reads_during_sync(analytics, sessions: int, seed: int) -> dict:
+    # Simulated sessions run reports back to back while a full resync
+    # rewrites every booking; reads should neither fail nor wait for it
+    syncing = threading.Event()
+    timings = []
+    errors = []
+
+    def session(i: int):
+        ranges = random_ranges(1000, seed + i)
+        options = {"product": [], "pricingcat": [], "groupcat": []}
+        while syncing.is_set():
+            start, end = ranges[len(timings) % len(ranges)]
+            began = time.perf_counter()
+            try:
+                # Uncached; the snapshot is reloaded in the background as
+                # the sync commits, and reports keep reading the last one
+                analytics.get_report.__wrapped__(start, end, **options)
+            except Exception as e:
+                errors.append(repr(e))
+            timings.append(time.perf_counter() - began)
+
+    syncing.set()
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    for t in threads:
+        t.start()
+    began = time.perf_counter()
+    analytics.get_bookings_refresher().refresh(force=True, full_resync=True)
+    sync_ms = (time.perf_counter() - began) * 1000
+    syncing.clear()
+    for t in threads:
+        t.join()
+    return {
+        "runs": len(timings),
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "mean_ms": statistics.fmean(timings) * 1000,
+        "sync_ms": sync_ms,
+        "errors": len(errors),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(old: dict, new: dict):
+    for size, cases in new["results"].items():
+        before = old["results"].get(size, {})
+        for case, result in cases.items():
+            if "p50_ms" not in result or case not in before:
+                continue
+            ratio = result["p50_ms"] / before[case]["p50_ms"]
+            print(
+                f"{size:>9} {case:<24} {before[case]['p50_ms']:10.1f} ms"
+                f" -> {result['p50_ms']:10.1f} ms  ({ratio:.2f}x)"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Bookeo sync and report paths on synthetic data"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--sync-repeat", type=int, default=3)
+    parser.add_argument("--changes", type=int, default=500)
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", dest="memory", action="store_false")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    args = parser.parse_args()
+
+    os.environ.setdefault("USER_AGENT", "CTE Sales Report Engine benchmark")
+    os.environ.setdefault("BOOKEO_API_KEY", "bench")
+    os.environ.setdefault("BOOKEO_SECRET_KEY", "bench")
+    os.environ.setdefault("SQUARE_API_KEY", "bench")
+    # Calling st.* outside `streamlit run` logs a warning per call
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+    import analytics
+    import streamlit.logger
+
+    streamlit.logger.set_log_level("error")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": dt.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "results": {str(n): run_size(analytics, n, args) for n in args.sizes},
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for size, cases in report["results"].items():
+        for case, r in cases.items():
+            if "p50_ms" in r:
+                peak = f"{r['peak_mb']:8.1f} MB" if "peak_mb" in r else ""
+                rate = (
+                    f"{r['rows_per_sec']:10,.0f} rows/s" if "rows_per_sec" in r else ""
+                )
+                print(
+                    f"{size:>9} {case:<24} p50 {r['p50_ms']:10.1f} ms"
+                    f"  p95 {r['p95_ms']:10.1f} ms {peak} {rate}"
+                )
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
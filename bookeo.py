@@ -0,0 +1,148 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+BOOKEO_API = "https://api.bookeo.com/v2"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class BookeoError(Exception):
+    def __init__(self, response: requests.Response):
+        # Only the path: the query string carries the API keys
+        super().__init__(
+            f"Bookeo request failed: {response.status_code} "
+            f"{urlsplit(response.url).path}"
+        )
+        self.response = response
+
+
+class BookeoClient:
+    # Shared keep-alive session plus a bounded worker pool for the paged
+    # Bookeo endpoints. Requests to the same host never exceed max_per_host
+    # in flight, and 429/5xx responses are retried with backoff.
+    def __init__(
+        self,
+        api_key: str,
+        secret_key: str,
+        user_agent: str,
+        base_url: str = BOOKEO_API,
+        max_workers: int = 8,
+        max_per_host: int = 4,
+        max_retries: int = 5,
+        backoff: float = 0.5,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["User-Agent"] = user_agent
+        self.session.params = {"apiKey": api_key, "secretKey": secret_key}
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def _retry_delay(self, res: requests.Response, attempt: int) -> float:
+        retry_after = res.headers.get("Retry-After") if res is not None else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * 2**attempt * (1 + random.random())
+
+    def get(self, path: str, headers: dict = None, **params) -> requests.Response:
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        slot = self._host_slot(url)
+        endpoint = path.strip("/")
+        for attempt in range(self.max_retries + 1):
+            res = None
+            try:
+                with slot:
+                    began = time.perf_counter()
+                    res = self.session.get(
+                        url, params=params, headers=headers, timeout=30
+                    )
+            except requests.ConnectionError:
+                metrics.record_http("bookeo", endpoint, began)
+                if attempt == self.max_retries:
+                    # Its message would quote the URL, keys and all
+                    raise requests.ConnectionError(
+                        f"Could not connect to {urlsplit(url).netloc}"
+                        f"{urlsplit(url).path}"
+                    ) from None
+            else:
+                metrics.record_http("bookeo", endpoint, began, res)
+                if res.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    return res
+            metrics.inc("http_retries_total", service="bookeo", endpoint=endpoint)
+            # Sleep outside the host slot so other workers can use it
+            time.sleep(self._retry_delay(res, attempt))
+
+    def get_page(self, path: str, **params) -> dict:
+        res = self.get(path, **params)
+        if res.status_code != 200:
+            raise BookeoError(res)
+        return res.json()
+
+    def get_all(
+        self, path: str, windows: list[dict], on_page: Callable = None, **params
+    ):
+        # Yields the "data" list of every page of every window as it arrives.
+        # Page 1 of each window is requested first; once it reports
+        # totalPages, pages 2..N are queued on the same pool. At most
+        # 2 * max_workers pages are requested or waiting to be consumed at
+        # a time, so a slow consumer doesn't buffer the whole download.
+        # on_page(window, number, total, page) sees each whole response
+        # first, e.g. to archive it.
+        queue = deque((w, 1, None, {**params, **w}) for w in windows)
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            pending = {}
+            try:
+                while queue or pending:
+                    while queue and len(pending) < 2 * self.max_workers:
+                        window, number, total, page_params = queue.popleft()
+                        future = pool.submit(self.get_page, path, **page_params)
+                        pending[future] = (window, number, total)
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        page = future.result()
+                        window, number, total = pending.pop(future)
+                        if number == 1:
+                            info = page.get("info", {})
+                            token = info.get("pageNavigationToken")
+                            total = info.get("totalPages", 1)
+                            queue.extend(
+                                (
+                                    window,
+                                    n,
+                                    total,
+                                    {"pageNavigationToken": token, "pageNumber": n},
+                                )
+                                for n in range(2, total + 1)
+                            )
+                        if on_page is not None:
+                            on_page(window, number, total, page)
+                        yield page.get("data", [])
+            finally:
+                for future in pending:
+                    future.cancel()
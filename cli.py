@@ -0,0 +1,251 @@
+import argparse
+import datetime as dt
+import itertools
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import toml
+
+import analytics
+import metrics
+
+# Runs the sync and the reports without Streamlit, e.g. from cron:
+#   python cli.py sync
+#   python cli.py sync --only bookings --replay
+#   python cli.py sync --only history      # compact closed months to Parquet
+#   python cli.py report --start 2024-01-01 --end 2024-12-31 --every month \
+#       --split product --output monthly.parquet
+# Settings come from the environment variables analytics.py reads (DATABASE,
+# BOOKEO_API_KEY, ...), then the TOML file given by --config (default
+# .streamlit/secrets.toml, the dashboard's secrets).
+
+DEFAULT_CONFIG = os.path.join(".streamlit", "secrets.toml")
+SYNC_TARGETS = ("settings", "bookings", "slots", "roster", "revenue", "history")
+OUTPUT_FORMATS = ("csv", "parquet", "json")
+
+
+def load_config(path: str, required: bool):
+    # Fills in settings missing from the environment from a TOML file of
+    # the same keys as the dashboard's st.secrets
+    if not os.path.exists(path):
+        if required:
+            raise SystemExit(f"No config file at {path}")
+        return
+    analytics.configure(toml.load(path), override=False)
+
+
+def sync(args) -> int:
+    # Each target runs through its refresher, as in the dashboard, so a
+    # target depending on another (slots on bookings) doesn't repeat it.
+    # They resume from the sync marks stored in the database.
+    analytics.get_db()
+    targets = args.only or SYNC_TARGETS
+    if "roster" in targets and "IMAP_SERVER" not in os.environ:
+        print("Skipping roster: IMAP_SERVER is not configured", file=sys.stderr)
+        targets = [t for t in targets if t != "roster"]
+    if "revenue" in targets and analytics.get_square() is None:
+        print("Skipping revenue: SQUARE_API_KEY is not configured", file=sys.stderr)
+        targets = [t for t in targets if t != "revenue"]
+    refreshers = {
+        "settings": (analytics.get_settings_refresher(), {}),
+        "bookings": (
+            analytics.get_bookings_refresher(),
+            {"full_resync": args.full_resync, "replay": args.replay},
+        ),
+        "slots": (analytics.get_slots_refresher(), {}),
+        "roster": (analytics.get_roster_refresher(), {}),
+        "revenue": (analytics.get_revenue_refresher(), {}),
+        "history": (analytics.get_history_refresher(), {}),
+    }
+    failed = False
+    for target in SYNC_TARGETS:
+        if target not in targets:
+            continue
+        print(f"Syncing {target}...", file=sys.stderr)
+        refresher, kwargs = refreshers[target]
+        refresher.refresh(force=True, **kwargs)
+        failed |= refresher.last_error is not None
+    metrics.export(force=True)
+    return 1 if failed else 0
+
+
+def date_ranges(args) -> list[tuple[dt.date, dt.date]]:
+    # --range START:END pairs, plus [--start, --end] cut into consecutive
+    # days, weeks (starting Monday) or months when --every is given
+    ranges = []
+    for spec in args.range or []:
+        start, end = spec.split(":")
+        ranges.append((dt.date.fromisoformat(start), dt.date.fromisoformat(end)))
+    if args.start or args.end:
+        if not (args.start and args.end):
+            raise SystemExit("--start and --end go together")
+        start, end = args.start, args.end
+        while start <= end:
+            if args.every == "day":
+                last = start
+            elif args.every == "week":
+                last = start + dt.timedelta(days=6 - start.weekday())
+            elif args.every == "month":
+                following = (start.replace(day=1) + dt.timedelta(days=32)).replace(
+                    day=1
+                )
+                last = following - dt.timedelta(days=1)
+            else:
+                last = end
+            ranges.append((start, min(last, end)))
+            start = min(last, end) + dt.timedelta(days=1)
+    if not ranges:
+        raise SystemExit("Give at least one --range or --start/--end")
+    return ranges
+
+
+def report_jobs(args) -> list[tuple[dt.date, dt.date, dict]]:
+    # Every date range crossed with every filter combination. A --split
+    # dimension contributes one combination per value (those given, or all
+    # of them); otherwise its values, if any, filter together.
+    choices = {}
+    for option, names in (
+        ("product", analytics.get_products),
+        ("pricingcat", analytics.get_people_categories),
+        ("groupcat", analytics.get_group_options),
+    ):
+        values = getattr(args, option) or []
+        if option in (args.split or []):
+            choices[option] = [[v] for v in values or names()]
+        else:
+            choices[option] = [values]
+    return [
+        (start, end, dict(zip(choices, values)))
+        for (start, end), *values in itertools.product(
+            date_ranges(args), *choices.values()
+        )
+    ]
+
+
+def report_row(job: tuple[dt.date, dt.date, dict]) -> dict:
+    # Runs in a pool worker: every metric for one range and filter
+    start, end, options = job
+    row = {
+        "start": start,
+        "end": end,
+        "product": ", ".join(options["product"]),
+        "pricingcat": ", ".join(options["pricingcat"]),
+        "groupcat": ", ".join(options["groupcat"]),
+        **analytics.get_report(start, end, **options),
+    }
+    if analytics.get_square() is not None:
+        # Empty under pricing or group category filters
+        revenue = analytics.get_revenue(start, end, **options)
+        row["revenue"] = None if revenue is None else revenue / 100
+    fill = analytics.get_fill_rates(start, end, **options)
+    row.update(
+        seats_offered=fill["offered"], seats_booked=fill["booked"], fill=fill["fill"]
+    )
+    return row
+
+
+def report(args) -> int:
+    # Migrations run here, once, before the workers open the database
+    analytics.get_db()
+    jobs = report_jobs(args)
+    # Each worker loads its own report snapshot, which takes far longer
+    # than a report, so more than one only pays off for many thousands
+    workers = min(args.workers or 1, len(jobs))
+    if workers == 1:
+        rows = [report_row(job) for job in jobs]
+    else:
+        # Spawned, not forked: the parent's SQLite connections must not be
+        # shared with the workers
+        with ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            chunksize = max(1, len(jobs) // (4 * workers))
+            rows = list(pool.map(report_row, jobs, chunksize=chunksize))
+    write_report(pd.DataFrame(rows), args.output, args.format)
+    metrics.export(force=True)
+    return 0
+
+
+def write_report(frame: pd.DataFrame, output: str, format: str):
+    if format is None:
+        ext = os.path.splitext(output or "")[1].lstrip(".").lower()
+        format = ext if ext in OUTPUT_FORMATS else "csv"
+    if format == "parquet":
+        if not output:
+            raise SystemExit("Parquet output needs --output")
+        frame.to_parquet(output, index=False)
+    elif format == "json":
+        # Plain ISO dates rather than midnight timestamps
+        frame = frame.astype({"start": str, "end": str})
+        text = frame.to_json(orient="records", indent=2)
+        write_text(text + "\n", output)
+    else:
+        write_text(frame.to_csv(index=False), output)
+
+
+def write_text(text: str, output: str):
+    if output:
+        with open(output, "w", newline="") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Sync Bookeo/Square data and generate reports without Streamlit"
+    )
+    parser.add_argument("--config", help=f"TOML settings (default {DEFAULT_CONFIG})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sync_parser = commands.add_parser("sync", help="download new data")
+    sync_parser.add_argument(
+        "--only", nargs="+", choices=SYNC_TARGETS, help="sync just these"
+    )
+    reload = sync_parser.add_mutually_exclusive_group()
+    reload.add_argument(
+        "--full-resync",
+        action="store_true",
+        help="download every booking again, bypassing the archive",
+    )
+    reload.add_argument(
+        "--replay",
+        action="store_true",
+        help="rebuild bookings from the local archive, without downloading",
+    )
+    sync_parser.set_defaults(run=sync)
+
+    report_parser = commands.add_parser("report", help="compute metrics")
+    report_parser.add_argument(
+        "--range", action="append", metavar="START:END", help="inclusive dates"
+    )
+    report_parser.add_argument("--start", type=dt.date.fromisoformat)
+    report_parser.add_argument("--end", type=dt.date.fromisoformat)
+    report_parser.add_argument("--every", choices=("day", "week", "month"))
+    report_parser.add_argument("--product", action="append")
+    report_parser.add_argument("--pricingcat", action="append")
+    report_parser.add_argument("--groupcat", action="append")
+    report_parser.add_argument(
+        "--split",
+        action="append",
+        choices=("product", "pricingcat", "groupcat"),
+        help="one row per value instead of filtering by all of them",
+    )
+    report_parser.add_argument("--workers", type=int, help="default: 1")
+    report_parser.add_argument("--output", help="file to write (default stdout)")
+    report_parser.add_argument("--format", choices=OUTPUT_FORMATS)
+    report_parser.set_defaults(run=report)
+
+    args = parser.parse_args()
+    os.environ.setdefault("USER_AGENT", analytics.USER_AGENT)
+    load_config(args.config or DEFAULT_CONFIG, required=args.config is not None)
+    if "DATABASE" not in os.environ:
+        raise SystemExit("DATABASE_PATH is not configured")
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+import metrics
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_app_code = {}
+# First keyword of each SQL string seen, e.g. "SELECT"
+_statements = {}
+
+
+def caller() -> str:
+    # Name of the innermost function in this app, outside this module, on
+    # the stack: the metric label for the queries it runs, so pandas and
+    # helper frames are skipped. Which code objects qualify is cached.
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        app = _app_code.get(code)
+        if app is None:
+            path = os.path.abspath(code.co_filename)
+            app = _app_code[code] = os.path.dirname(
+                path
+            ) == APP_DIR and path != os.path.abspath(__file__)
+        if app:
+            return code.co_name
+        frame = frame.f_back
+    return "unknown"
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Records the latency of execute/executemany by calling function and
+    # statement, the rows they change or return, and the time spent in
+    # fetchall()/fetchmany(). Rows read by iterating the cursor or with
+    # fetchone() aren't counted, to keep the per-row path free of Python
+    # code.
+    def execute(self, sql, parameters=()):
+        began = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, began)
+
+    def executemany(self, sql, seq_of_parameters):
+        began = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(sql, began)
+
+    def executescript(self, sql_script):
+        began = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self._record(sql_script, began)
+
+    def _record(self, sql: str, began: float):
+        elapsed = time.perf_counter() - began
+        statement = _statements.get(sql)
+        if statement is None:
+            if len(_statements) > 10_000:
+                _statements.clear()
+            statement = sql.split(None, 1)[0].rstrip(";").upper() if sql else ""
+            _statements[sql] = statement
+        self._labels = {"caller": caller(), "statement": statement}
+        metrics.observe("sqlite_query_duration_seconds", elapsed, **self._labels)
+        if self.rowcount > 0:
+            metrics.inc("sqlite_rows_total", self.rowcount, **self._labels)
+
+    def _fetched(self, rows: list, began: float) -> list:
+        labels = getattr(self, "_labels", {"caller": caller(), "statement": ""})
+        metrics.observe(
+            "sqlite_fetch_duration_seconds", time.perf_counter() - began, **labels
+        )
+        metrics.inc("sqlite_rows_total", len(rows), **labels)
+        return rows
+
+    def fetchall(self):
+        began = time.perf_counter()
+        return self._fetched(super().fetchall(), began)
+
+    def fetchmany(self, size=None):
+        began = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        return self._fetched(rows, began)
+
+
+class TimedConnection(sqlite3.Connection):
+    # Every statement runs on a TimedCursor. The execute shortcuts are
+    # overridden too, as the built-in ones bypass the cursor's methods.
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        with metrics.timer("sqlite_commit_duration_seconds", caller=caller()):
+            super().commit()
+
+
+class Database:
+    # WAL-mode SQLite shared by every session. Writes go through one
+    # dedicated connection, one writer at a time. Reads check out a
+    # read-only connection for the calling thread from a small pool, and
+    # keep seeing the last committed data while a write is in progress.
+    def __init__(self, path: str, max_readers: int = 8, busy_timeout: float = 30):
+        self.path = os.path.abspath(path)
+        self.busy_timeout = busy_timeout
+        self._write_lock = threading.RLock()
+        self._reader_slots = threading.BoundedSemaphore(max_readers)
+        self._idle_readers = []
+        self._local = threading.local()
+        # WAL is a property of the file, set once by the writer before any
+        # reader opens it
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._writer.execute("PRAGMA synchronous = NORMAL")
+        # Syncs write in one long transaction; a 64 MB page cache keeps the
+        # pages they rewrite in memory until commit
+        self._writer.execute("PRAGMA cache_size = -65536")
+        self._writer.execute("PRAGMA temp_store = MEMORY")
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        uri = f"file:{quote(self.path)}" + ("?mode=ro" if read_only else "")
+        return sqlite3.connect(
+            uri,
+            uri=True,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            factory=TimedConnection,
+        )
+
+    @contextmanager
+    def write(self):
+        # Yields the writer connection. Callers commit; anything left
+        # uncommitted is rolled back when the block exits.
+        began = time.perf_counter()
+        with self._write_lock:
+            metrics.observe(
+                "sqlite_lock_wait_seconds", time.perf_counter() - began, lock="write"
+            )
+            try:
+                yield self._writer
+            finally:
+                if self._writer.in_transaction:
+                    self._writer.rollback()
+
+    @contextmanager
+    def read(self):
+        # Yields this thread's read-only connection. Nested reads on the
+        # same thread reuse it instead of taking a second pool slot.
+        conn = getattr(self._local, "reader", None)
+        if conn is not None:
+            yield conn
+            return
+        began = time.perf_counter()
+        with self._reader_slots:
+            metrics.observe(
+                "sqlite_lock_wait_seconds", time.perf_counter() - began, lock="read"
+            )
+            try:
+                conn = self._idle_readers.pop()
+            except IndexError:
+                conn = self._connect(read_only=True)
+            self._local.reader = conn
+            try:
+                yield conn
+            finally:
+                self._local.reader = None
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle_readers.append(conn)
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        while self._idle_readers:
+            self._idle_readers.pop().close()
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def interval_overlap(
+    starts: np.ndarray, ends: np.ndarray, weights: np.ndarray, grid: np.ndarray
+) -> np.ndarray:
+    # Sweep line over weighted [start, end) intervals. Returns, for each
+    # bucket [grid[i], grid[i + 1]), the sum of weight * seconds of overlap
+    # over all intervals, in O((n + m) log n) for n intervals, m buckets.
+    grid = np.asarray(grid, dtype=np.float64)
+    if len(starts) == 0:
+        return np.zeros(max(len(grid) - 1, 0))
+    times = np.concatenate([starts, ends]).astype(np.float64)
+    slopes = np.concatenate([weights, np.negative(weights)]).astype(np.float64)
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    # Total weight of the intervals open just after each event
+    slopes = np.cumsum(slopes[order])
+    # Integral of the open weight from the first event to each event
+    area = np.concatenate([[0.0], np.cumsum(slopes[:-1] * np.diff(times))])
+    k = np.searchsorted(times, grid, side="right") - 1
+    before = k < 0
+    k[before] = 0
+    integral = area[k] + slopes[k] * (grid - times[k])
+    integral[before] = 0.0
+    return np.diff(integral)
+
+
+def hour_of_week(timestamps: np.ndarray, tz) -> np.ndarray:
+    # 0 = Monday 00:00-01:00 local time, 167 = Sunday 23:00-24:00
+    local = pd.to_datetime(timestamps, unit="s", utc=True).tz_convert(tz)
+    return np.asarray(local.dayofweek * 24 + local.hour)
+
+
+def fill_by_hour_of_week(
+    starts: np.ndarray,
+    ends: np.ndarray,
+    offered: np.ndarray,
+    booked: np.ndarray,
+    first: int,
+    last: int,
+    tz,
+) -> pd.DataFrame:
+    # Offered and booked seat-hours of the slots, per local hour of the
+    # week, over the hours in [first, last). first should be a local
+    # midnight; offsets from UTC are whole hours, so an hourly grid in epoch
+    # seconds lines up with local hours, DST included.
+    grid = np.arange(first, last + 1, 3600)
+    how = hour_of_week(grid[:-1], tz)
+    seat_hours = {
+        name: np.bincount(
+            how, interval_overlap(starts, ends, weights, grid) / 3600, minlength=168
+        )
+        for name, weights in (("offered", offered), ("booked", booked))
+    }
+    result = pd.DataFrame(seat_hours)
+    result["fill"] = fill_rate(result["booked"], result["offered"])
+    result.insert(0, "weekday", [WEEKDAYS[h // 24] for h in range(168)])
+    result.insert(1, "hour", np.arange(168) % 24)
+    return result
+
+
+def fill_by_key(
+    keys: np.ndarray, offered: np.ndarray, booked: np.ndarray
+) -> pd.DataFrame:
+    # Offered and booked seats summed per key (e.g. product)
+    names, codes = np.unique(keys, return_inverse=True)
+    result = pd.DataFrame(
+        {
+            "offered": np.bincount(codes, offered, minlength=len(names)),
+            "booked": np.bincount(codes, booked, minlength=len(names)),
+        },
+        index=names,
+    )
+    result["fill"] = fill_rate(result["booked"], result["offered"])
+    return result
+
+
+def fill_rate(booked, offered):
+    # NaN where nothing was offered
+    booked = np.asarray(booked, dtype=np.float64)
+    offered = np.asarray(offered, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(offered > 0, booked / offered, np.nan)
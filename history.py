@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+import uuid
+
+import cachetools
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class HistoryStore:
+    # Rows moved out of the database, as Parquet files partitioned by month:
+    # <table>/year=YYYY/month=MM/<name>.parquet, one file per table per
+    # compaction of the month, all sharing its name. Files are written once
+    # and never modified. The database lists the ones in use, so any other
+    # file is either still being written or no longer referenced, and is
+    # deleted once it is older than any read could be.
+    def __init__(self, root: str, cache_size: int = 512):
+        self.root = root
+        self._cache = cachetools.LRUCache(cache_size)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, table: str, month: str, name: str) -> str:
+        year, month = month.split("-")
+        return os.path.join(
+            self.root, table, f"year={year}", f"month={month}", f"{name}.parquet"
+        )
+
+    def write(
+        self, month: str, tables: dict[str, tuple[list[str], list[tuple]]]
+    ) -> str:
+        # Writes each table's (columns, rows) for a month under one new
+        # name, which is returned
+        name = uuid.uuid4().hex
+        for table, (columns, rows) in tables.items():
+            path = self.path(table, month, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            pq.write_table(to_arrow(columns, rows), tmp, compression="zstd")
+            os.replace(tmp, path)
+        return name
+
+    def rows(self, table: str, month: str, name: str) -> tuple[list[str], list[tuple]]:
+        # A file's rows as written, to put back in the database
+        data = pq.read_table(self.path(table, month, name))
+        return data.column_names, list(zip(*(c.to_pylist() for c in data.columns)))
+
+    def frame(
+        self, table: str, month: str, name: str, columns: tuple[str]
+    ) -> pd.DataFrame:
+        # Some columns of a file. Files never change, so these are cached;
+        # callers mustn't modify them.
+        key = (table, month, name, columns)
+        with self._lock:
+            frame = self._cache.get(key)
+        if frame is None:
+            frame = pq.read_table(
+                self.path(table, month, name), columns=list(columns)
+            ).to_pandas()
+            with self._lock:
+                self._cache[key] = frame
+        return frame
+
+    def collect_garbage(self, names: set[str], min_age: float = 3600):
+        # Deletes files whose name isn't in names, and temp files of failed
+        # writes, once min_age seconds old
+        cutoff = time.time() - min_age
+        for directory, _, files in os.walk(self.root):
+            for f in files:
+                path = os.path.join(directory, f)
+                if f.endswith(".parquet") and f[: -len(".parquet")] in names:
+                    continue
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    continue
+
+
+def to_arrow(columns: list[str], rows: list[tuple]) -> pa.Table:
+    # SQLite columns are typed per value: one holding both integers and
+    # text (an INT column storing a non-numeric id) is written as text,
+    # which SQLite converts back when the rows are reinserted
+    arrays = []
+    for values in zip(*rows) if rows else [()] * len(columns):
+        try:
+            arrays.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(
+                pa.array([None if v is None else str(v) for v in values], pa.string())
+            )
+    return pa.Table.from_arrays(arrays, names=list(columns))
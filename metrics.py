@@ -0,0 +1,281 @@
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets, Prometheus
+# style, plus an implicit +Inf
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+IMAP_COMMANDS = {"login", "select", "search", "fetch", "logout"}
+# A *.jsonl metrics file gets at most one snapshot per interval, and moves
+# to <file>.1 once it grows past the size, replacing the previous one
+EXPORT_INTERVAL = 60.0
+EXPORT_MAX_BYTES = 10 * 2**20
+
+
+class Registry:
+    # Process-wide latency histograms and counters, keyed by metric name and
+    # labels. Lives in this module, so it survives reruns of the app script
+    # and collects from background refresh threads too.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._exported = {}
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect_left(BUCKETS, seconds)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                # Per-bucket counts, then sum and count
+                h = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+            h[bucket] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def histograms(self) -> list[dict]:
+        with self._lock:
+            items = [(k, list(h)) for k, h in self._histograms.items()]
+        return [
+            {
+                "name": name,
+                "labels": dict(labels),
+                "buckets": h[:-2],
+                "sum": h[-2],
+                "count": h[-1],
+            }
+            for (name, labels), h in sorted(items)
+        ]
+
+    def counters(self) -> list[dict]:
+        with self._lock:
+            items = sorted(self._counters.items())
+        return [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in items
+        ]
+
+    def summary(self) -> list[dict]:
+        # One row per histogram series with estimated percentiles, for the
+        # debug panel
+        return [
+            {
+                "metric": h["name"],
+                **h["labels"],
+                "count": h["count"],
+                "total_s": h["sum"],
+                "mean_ms": h["sum"] / h["count"] * 1000,
+                "p50_ms": quantile(h["buckets"], 0.5) * 1000,
+                "p95_ms": quantile(h["buckets"], 0.95) * 1000,
+            }
+            for h in self.histograms()
+        ]
+
+    def prometheus(self) -> str:
+        lines = []
+        typed = set()
+        for h in self.histograms():
+            if h["name"] not in typed:
+                typed.add(h["name"])
+                lines.append(f"# TYPE {h['name']} histogram")
+            cumulative = 0
+            for bound, n in zip([*BUCKETS, "+Inf"], h["buckets"]):
+                cumulative += n
+                labels = format_labels({**h["labels"], "le": str(bound)})
+                lines.append(f"{h['name']}_bucket{labels} {cumulative}")
+            labels = format_labels(h["labels"])
+            lines.append(f"{h['name']}_sum{labels} {h['sum']}")
+            lines.append(f"{h['name']}_count{labels} {h['count']}")
+        for c in self.counters():
+            if c["name"] not in typed:
+                typed.add(c["name"])
+                lines.append(f"# TYPE {c['name']} counter")
+            lines.append(f"{c['name']}{format_labels(c['labels'])} {c['value']}")
+        return "\n".join(lines) + "\n"
+
+    def export(
+        self,
+        path: str,
+        force: bool = False,
+        interval: float = EXPORT_INTERVAL,
+        max_bytes: int = EXPORT_MAX_BYTES,
+    ):
+        # *.jsonl files get a snapshot appended, unless one was less than
+        # interval seconds ago (or force), and are rotated past max_bytes.
+        # Anything else is replaced with the Prometheus text format, e.g.
+        # for node_exporter's textfile collector.
+        if path.endswith(".jsonl"):
+            now = time.monotonic()
+            with self._lock:
+                last = self._exported.get(path)
+                if not force and last is not None and now - last < interval:
+                    return
+                self._exported[path] = now
+            try:
+                if os.path.getsize(path) >= max_bytes:
+                    os.replace(path, f"{path}.1")
+            except FileNotFoundError:
+                pass
+            snapshot = {
+                "timestamp": time.time(),
+                "histograms": self.histograms(),
+                "counters": self.counters(),
+            }
+            with open(path, "a") as f:
+                f.write(json.dumps(snapshot) + "\n")
+            return
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def quantile(buckets: list[int], q: float) -> float:
+    # Linear interpolation within the bucket holding the q-th observation,
+    # as Prometheus' histogram_quantile does
+    total = sum(buckets)
+    if total == 0:
+        return float("nan")
+    rank = q * total
+    seen = 0
+    for i, n in enumerate(buckets):
+        if n and seen + n >= rank:
+            if i == len(BUCKETS):
+                return BUCKETS[-1]
+            lower = BUCKETS[i - 1] if i else 0.0
+            return lower + (BUCKETS[i] - lower) * (rank - seen) / n
+        seen += n
+    return BUCKETS[-1]
+
+
+REGISTRY = Registry()
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+
+
+@contextmanager
+def timer(name: str, **labels):
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - began, **labels)
+
+
+def timed(name: str):
+    # Decorator recording each call's latency under name, labeled with the
+    # function
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name, function=fn.__qualname__):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def export(force: bool = False):
+    # Writes the metrics file named by METRICS_FILE, if any. force skips
+    # the export interval, e.g. for the last export before exiting.
+    path = os.environ.get("METRICS_FILE")
+    if path:
+        try:
+            REGISTRY.export(path, force)
+        except OSError as e:
+            print(f"Could not write metrics: {e}")
+
+
+def record_http(service: str, endpoint: str, began: float, res=None):
+    # One HTTP attempt: latency by status ("error" when no response came
+    # back) and response bytes
+    status = str(res.status_code) if res is not None else "error"
+    labels = {"service": service, "endpoint": endpoint}
+    observe(
+        "http_request_duration_seconds",
+        time.perf_counter() - began,
+        status=status,
+        **labels,
+    )
+    if res is not None:
+        inc("http_response_bytes_total", len(res.content), **labels)
+
+
+def response_size(data) -> int:
+    # Bytes in an imaplib response, whose items are bytes or tuples of them
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    if isinstance(data, (list, tuple)):
+        return sum(response_size(item) for item in data)
+    return 0
+
+
+class TimedIMAP:
+    # Wraps an imaplib connection, recording the latency and response bytes
+    # of each command in IMAP_COMMANDS
+    def __init__(self, imap):
+        self._imap = imap
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        with timer("imap_command_duration_seconds", command="logout"):
+            return self._imap.__exit__(*exc)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._imap, name)
+        if name not in IMAP_COMMANDS:
+            return attr
+
+        def command(*args):
+            with timer("imap_command_duration_seconds", command=name):
+                typ, data = attr(*args)
+            inc("imap_response_bytes_total", response_size(data), command=name)
+            return typ, data
+
+        return command
@@ -0,0 +1,112 @@
+import datetime as dt
+import threading
+import time
+from typing import Callable
+
+import metrics
+
+
+class RefreshCoordinator:
+    # Runs `refresh` at most once per `max_age` no matter how many sessions
+    # or threads ask for it. Concurrent callers join the refresh already in
+    # flight instead of starting their own, and callers that pass wait=False
+    # keep reading the last committed data while the refresh runs on a
+    # background thread (unless nothing has been loaded yet). `last_synced`
+    # reads when the data was last refreshed, as epoch seconds (None if
+    # never), from wherever refresh stores it, so a new process starts from
+    # that instead of cold.
+    def __init__(
+        self,
+        refresh: Callable,
+        max_age: dt.timedelta,
+        retry_after: dt.timedelta = dt.timedelta(minutes=1),
+        last_synced: Callable = None,
+    ):
+        self._refresh = refresh
+        self.max_age = max_age.total_seconds()
+        self.retry_after = retry_after.total_seconds()
+        self._last_synced = last_synced
+        self.last_refresh = None
+        self.last_error = None
+        self._last_failure = None
+        self._flight = None
+        self._lock = threading.Lock()
+
+    def _warm_start(self):
+        # Once, on first use: carry over the age of the stored data
+        last_synced, self._last_synced = self._last_synced, None
+        synced = last_synced() if last_synced is not None else None
+        if synced is not None and self.last_refresh is None:
+            age = max(time.time() - synced, 0.0)
+            self.last_refresh = time.monotonic() - age
+
+    def _is_fresh(self) -> bool:
+        now = time.monotonic()
+        if self.last_refresh is not None and now - self.last_refresh < self.max_age:
+            return True
+        # Don't hammer a failing upstream on every rerun
+        return (
+            self._last_failure is not None
+            and now - self._last_failure < self.retry_after
+        )
+
+    @property
+    def refreshing(self) -> bool:
+        return self._flight is not None
+
+    def refresh(self, wait: bool = True, force: bool = False, **kwargs):
+        while True:
+            with self._lock:
+                if self._last_synced is not None:
+                    self._warm_start()
+                if not force and self._is_fresh():
+                    return
+                flight = self._flight
+                if flight is None:
+                    flight = self._flight = threading.Event()
+                    threading.Thread(
+                        target=self._run, args=(flight, kwargs), daemon=True
+                    ).start()
+                    started = True
+                else:
+                    started = False
+                cold = self.last_refresh is None
+            if wait or cold or (force and not started):
+                flight.wait()
+            # A forced refresh that joined someone else's flight still needs
+            # its own run with its own arguments
+            if not force or started:
+                return
+
+    def _run(self, flight: threading.Event, kwargs: dict):
+        began = time.perf_counter()
+        job = self._refresh.__name__
+        try:
+            self._refresh(**kwargs)
+        except Exception as e:
+            print(f"Refresh failed: {e!r}")
+            metrics.observe(
+                "refresh_duration_seconds",
+                time.perf_counter() - began,
+                job=job,
+                outcome="error",
+            )
+            with self._lock:
+                self.last_error = e
+                self._last_failure = time.monotonic()
+        else:
+            metrics.observe(
+                "refresh_duration_seconds",
+                time.perf_counter() - began,
+                job=job,
+                outcome="ok",
+            )
+            with self._lock:
+                self.last_refresh = time.monotonic()
+                self.last_error = None
+                self._last_failure = None
+        finally:
+            with self._lock:
+                self._flight = None
+            flight.set()
+            metrics.export()
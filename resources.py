@@ -0,0 +1,156 @@
+import functools
+import threading
+from typing import Callable
+
+import cachetools
+
+import metrics
+
+_resources = {}
+_lock = threading.RLock()
+_missing = object()
+
+
+def process_resource(factory: Callable):
+    # Like st.cache_resource: one value per process and arguments. Unlike it,
+    # also hits from threads Streamlit doesn't manage (background refreshes)
+    # and outside `streamlit run`, where cache_resource never caches. The
+    # values live in this module, which survives reruns of the app script.
+    key = f"{factory.__module__}.{factory.__qualname__}"
+
+    @functools.wraps(factory)
+    def get(*args):
+        with _lock:
+            if (key, args) not in _resources:
+                _resources[key, args] = factory(*args)
+            return _resources[key, args]
+
+    def clear():
+        with _lock:
+            for k in [k for k in _resources if k[0] == key]:
+                del _resources[k]
+
+    get.clear = clear
+    return get
+
+
+def versioned_cache(generation: Callable, maxsize: int = 128):
+    # LRU cache of a report function's results, keyed by its arguments and
+    # generation(), a counter that moves on whenever the data underneath
+    # changes. Seeing a new generation drops every older entry. List
+    # options are compared as sets, and an empty one is the same as leaving
+    # it out. Results are shared, so callers mustn't modify them.
+    def decorate(fn: Callable):
+        cache = cachetools.LRUCache(maxsize)
+        lock = threading.Lock()
+        current = [None]
+
+        @functools.wraps(fn)
+        def get(*args, **options):
+            gen = generation()
+            key = (args, normalize_options(options))
+            with lock:
+                if gen != current[0]:
+                    cache.clear()
+                    current[0] = gen
+                result = cache.get(key, _missing)
+            if result is not _missing:
+                metrics.inc("cache_requests_total", function=fn.__name__, result="hit")
+                return result
+            metrics.inc("cache_requests_total", function=fn.__name__, result="miss")
+            result = fn(*args, **options)
+            with lock:
+                if gen == current[0]:
+                    cache[key] = result
+            return result
+
+        def clear():
+            with lock:
+                cache.clear()
+
+        get.clear = clear
+        return get
+
+    return decorate
+
+
+def normalize_options(options: dict) -> tuple:
+    normalized = []
+    for k, v in sorted(options.items()):
+        if isinstance(v, (list, tuple, set)):
+            if not v:
+                continue
+            v = tuple(sorted(set(v)))
+        elif v is None:
+            continue
+        normalized.append((k, v))
+    return tuple(normalized)
+
+
+def background_cache(generation: Callable):
+    # Caches the one result of a slow function of no arguments, like
+    # versioned_cache, but once there is a result a newer generation is
+    # computed on a background thread while callers keep getting the
+    # previous one. Only callers with nothing to return wait for it. A
+    # result is tagged with the generation read before computing it, so a
+    # change during the computation is picked up by the next one.
+    # get.generation() is that of the result last returned.
+    def decorate(fn: Callable):
+        lock = threading.Lock()
+        state = {"generation": None, "result": _missing, "flight": None, "epoch": 0}
+
+        def run(flight: threading.Event, gen, epoch: int):
+            try:
+                result = fn()
+            except Exception as e:
+                print(f"Could not compute {fn.__name__}: {e!r}")
+                with lock:
+                    flight.error = e
+            else:
+                with lock:
+                    if epoch == state["epoch"]:
+                        state["generation"], state["result"] = gen, result
+            finally:
+                with lock:
+                    if state["flight"] is flight:
+                        state["flight"] = None
+                flight.set()
+
+        @functools.wraps(fn)
+        def get():
+            gen = generation()
+            with lock:
+                result = state["result"]
+                if result is not _missing and gen == state["generation"]:
+                    return result
+                flight = state["flight"]
+                if flight is None:
+                    flight = state["flight"] = threading.Event()
+                    flight.error = None
+                    threading.Thread(
+                        target=run, args=(flight, gen, state["epoch"]), daemon=True
+                    ).start()
+            if result is not _missing:
+                return result
+            flight.wait()
+            with lock:
+                result = state["result"]
+            if result is _missing:
+                raise flight.error or RuntimeError(f"{fn.__name__} was cleared")
+            return result
+
+        def current_generation():
+            with lock:
+                return state["generation"]
+
+        def clear():
+            # Results still being computed are dropped when they arrive
+            with lock:
+                state.update(generation=None, result=_missing, flight=None)
+                state["epoch"] += 1
+
+        get.generation = current_generation
+        get.clear = clear
+        return get
+
+    return decorate
@@ -0,0 +1,125 @@
+import base64
+import csv
+import imaplib
+import io
+import quopri
+import re
+from itertools import islice, takewhile
+
+TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+def flatten_response(data: list) -> bytes:
+    # imaplib returns IMAP literals ({n}\r\n<n bytes>) as (prefix, literal)
+    # tuples; turn them back into quoted strings so they tokenize normally
+    out = b""
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            prefix = re.sub(rb"\{\d+\}$", b"", prefix)
+            escaped = literal.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+            out += prefix + b'"' + escaped + b'"'
+        elif item is not None:
+            out += item
+    return out
+
+
+def parse_list(data: bytes) -> list:
+    # Parses an IMAP parenthesized list into nested Python lists. Strings
+    # are decoded, NIL becomes None.
+    stack = [[]]
+    for m in TOKEN.finditer(data):
+        open_, close, quoted, atom = m.groups()
+        if open_:
+            stack.append([])
+        elif close:
+            inner = stack.pop()
+            stack[-1].append(inner)
+        elif quoted is not None:
+            stack[-1].append(
+                re.sub(rb"\\(.)", rb"\1", quoted).decode("utf-8", "replace")
+            )
+        elif atom.upper() == b"NIL":
+            stack[-1].append(None)
+        else:
+            stack[-1].append(atom.decode("utf-8", "replace"))
+    return stack[0]
+
+
+def body_params(params: list) -> dict:
+    # ("NAME" "roster.csv" ...) -> {"name": "roster.csv", ...}
+    if not isinstance(params, list):
+        return {}
+    return {k.lower(): v for k, v in zip(params[::2], params[1::2])}
+
+
+def find_attachment(body: list, section: str = "") -> tuple[str, str]:
+    # Returns (section, transfer encoding) of the first part of a
+    # BODYSTRUCTURE that has a filename, or None
+    if isinstance(body[0], list):
+        # multipart: child parts, then subtype and extension data
+        parts = takewhile(lambda p: isinstance(p, list), body)
+        for n, part in enumerate(parts):
+            found = find_attachment(
+                part, f"{section}.{n + 1}" if section else str(n + 1)
+            )
+            if found:
+                return found
+        return None
+    filename = body_params(body[2]).get("name")
+    for ext in body[7:]:
+        # disposition: ("attachment" ("filename" "roster.csv"))
+        if isinstance(ext, list) and len(ext) == 2 and isinstance(ext[1], list):
+            filename = filename or body_params(ext[1]).get("filename")
+    if not filename:
+        return None
+    return section or "1", (body[5] or "7bit").lower()
+
+
+def fetch_latest_attachment(imap: imaplib.IMAP4, criteria: str) -> bytes:
+    # Downloads only the attachment part of the newest message matching
+    # criteria, using BODYSTRUCTURE to find it
+    val, found = imap.search(None, criteria)
+    if val != "OK":
+        return None
+    for id in reversed(found[0].split()):
+        val, data = imap.fetch(id, "(BODYSTRUCTURE)")
+        if val != "OK":
+            continue
+        response = parse_list(flatten_response(data))
+        fields = response[1] if len(response) > 1 else []
+        body = fields[fields.index("BODYSTRUCTURE") + 1]
+        attachment = find_attachment(body)
+        if attachment is None:
+            continue
+        section, encoding = attachment
+        val, data = imap.fetch(id, f"(BODY.PEEK[{section}])")
+        if val != "OK":
+            continue
+        payload = next(item[1] for item in data if isinstance(item, tuple))
+        if encoding == "base64":
+            return base64.b64decode(payload)
+        if encoding == "quoted-printable":
+            return quopri.decodestring(payload)
+        return payload
+    return None
+
+
+def read_roster(data: bytes, batch_size: int = 5000):
+    # Yields (pid, firstName, lastName) batches from a roster CSV
+    reader = csv.DictReader(
+        io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="")
+    )
+    pidKey = firstNameKey = lastNameKey = None
+    for key in reader.fieldnames or []:
+        if "pid" in key.lower():
+            pidKey = key
+        elif "first" in key.lower():
+            firstNameKey = key
+        elif "last" in key.lower():
+            lastNameKey = key
+    if None in [pidKey, firstNameKey, lastNameKey]:
+        raise ValueError("Could not read roster")
+    rows = ((r[pidKey], r[firstNameKey], r[lastNameKey]) for r in reader)
+    while batch := list(islice(rows, batch_size)):
+        yield batch
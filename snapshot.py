@@ -0,0 +1,352 @@
+import numpy as np
+import pandas as pd
+
+# Bookings per checkpoint of the running totals
+CHECKPOINT_EVERY = 4096
+
+
+class ReportSnapshot:
+    # Every uncanceled booking with its participants, and every slot, as
+    # columns in memory, so reports over any range and filters run no
+    # queries. Products, people categories and segments are stored as
+    # codes: 1 + the position of their id in the dimension table given,
+    # 0 for none or an id missing from it. Bookings are held twice, sorted
+    # by start and by creation time, so those run or booked in a range are
+    # one slice found by binary search. Unfiltered totals come from running
+    # totals kept every few thousand bookings, plus the bookings between
+    # the range's ends and the nearest of those; filters mask the slice.
+    def __init__(
+        self,
+        bookings: pd.DataFrame,
+        participants: pd.DataFrame,
+        slots: pd.DataFrame,
+        dimensions: dict[str, pd.DataFrame],
+        segments: dict[str, str],
+    ):
+        # bookings: id, eventId, creationTime, startTime, endTime,
+        # productId and the segments' columns; participants: bookingId,
+        # peopleCategory, onCampus; slots: eventId, productId, startTime,
+        # endTime, capacity; dimensions: id and name of products (with
+        # capacity), peopleCategories, groupCategories and each segment
+        # table; segments: the table of each segment column
+        self.dimensions = dimensions
+        self.segments = segments
+        self.names = {
+            table: np.array([None, *rows.name], dtype=object)
+            for table, rows in dimensions.items()
+        }
+
+        def encode(table: str, ids: pd.Series) -> np.ndarray:
+            index = pd.Index(self.dimensions[table].id)
+            return (index.get_indexer(ids) + 1).astype(np.int32)
+
+        # Participants per people category and booking, a row per category
+        # so each category's counts are contiguous
+        n = len(bookings)
+        k = len(dimensions["peopleCategories"]) + 1
+        booking = pd.Index(bookings.id).get_indexer(participants.bookingId)
+        known = booking >= 0
+        cells = encode("peopleCategories", participants.peopleCategory[known])
+        cells = cells * n + booking[known]
+        seats = np.bincount(cells, minlength=k * n).reshape(k, n)
+        on_campus = np.bincount(
+            cells,
+            participants.onCampus[known].fillna(0).to_numpy(np.float64),
+            minlength=k * n,
+        ).reshape(k, n)
+
+        # Product and group category as one code, filtered with one lookup
+        product = encode("products", bookings.productId)
+        groups = len(self.names["groupCategories"])
+        columns = {
+            "cell": product * groups
+            + encode("groupCategories", bookings.groupCategory),
+            "seats": seats.astype(np.uint16),
+            "onCampus": on_campus.astype(np.uint16),
+            **{c: encode(t, bookings[c]) for c, t in segments.items()},
+        }
+        sizes = {c: len(self.names[t]) for c, t in segments.items()}
+        self.by_start = sorted_bookings(bookings.startTime, columns, sizes)
+        self.by_creation = sorted_bookings(bookings.creationTime, columns, sizes)
+
+        # Seats booked per event, for the fill rates, and the slots with
+        # their event. Event ids are compared as text: history files hold
+        # them as text when any of a month's isn't a number.
+        booked = seats.sum(axis=0)
+        events = (
+            pd.DataFrame(
+                {
+                    "eventId": bookings.eventId.astype(str).to_numpy(),
+                    "product": product,
+                    "startTime": bookings.startTime.to_numpy(np.int64),
+                    "endTime": bookings.endTime.to_numpy(np.int64),
+                    "seats": booked,
+                }
+            )[booked > 0]
+            .groupby("eventId", sort=False)
+            .agg(
+                product=("product", "first"),
+                startTime=("startTime", "min"),
+                endTime=("endTime", "max"),
+                seats=("seats", "sum"),
+            )
+            .sort_values("startTime", kind="stable")
+        )
+        slots = slots.assign(eventId=slots.eventId.astype(str)).sort_values(
+            ["startTime", "eventId"], kind="stable"
+        )
+        self.events = {
+            "product": events["product"].to_numpy(np.int32),
+            "startTime": events.startTime.to_numpy(np.int64),
+            "endTime": events.endTime.to_numpy(np.int64),
+            "seats": events.seats.to_numpy(np.int64),
+            "inSlots": events.index.isin(slots.eventId),
+        }
+        self.slots = {
+            "event": events.index.get_indexer(slots.eventId),
+            "product": encode("products", slots.productId),
+            "startTime": slots.startTime.to_numpy(np.int64),
+            "endTime": slots.endTime.to_numpy(np.int64),
+            "capacity": slots.capacity.fillna(0).to_numpy(np.int64),
+        }
+        self.capacity = np.concatenate(
+            [[0], dimensions["products"].capacity.fillna(0).to_numpy(np.int64)]
+        )
+
+    def codes(self, table: str, names: list[str]) -> np.ndarray:
+        # Codes of a dimension table's rows with any of the names. Segment
+        # names are compared ignoring case, as their tables do.
+        rows = self.dimensions[table].name
+        if table in self.segments.values():
+            rows, names = rows.str.lower(), [name.lower() for name in names]
+        return np.flatnonzero(rows.isin(names)) + 1
+
+    def mask(self, table: str, names: list[str]) -> np.ndarray:
+        # Lookup table of a dimension's codes, True for the named rows, or
+        # for all of them without names
+        if not names:
+            return np.ones(len(self.names[table]), dtype=bool)
+        selected = np.zeros(len(self.names[table]), dtype=bool)
+        selected[self.codes(table, names)] = True
+        return selected
+
+    def report(
+        self,
+        first: int,
+        last: int,
+        products: list[str] = None,
+        groups: list[str] = None,
+        categories: list[str] = None,
+        segment: str = None,
+    ) -> list[tuple]:
+        # The report query's rows for bookings booked and/or run in
+        # [first, last): (segment name, rooms booked, slots booked, rooms
+        # run, slots run, on-campus slots booked, on-campus slots run),
+        # one row with segment None unless a segment column is given
+        booked, run = (
+            self.totals(rows, first, last, products, groups, categories, segment)
+            for rows in (self.by_creation, self.by_start)
+        )
+
+        def metrics(s: int) -> tuple:
+            return tuple(
+                int(v)
+                for v in (booked[1, s], booked[2, s], run[1, s], run[2, s])
+                + (booked[3, s], run[3, s])
+            )
+
+        if segment is None:
+            return [(None, *metrics(0))]
+        names = self.names[self.segments[segment]]
+        return [(names[s], *metrics(s)) for s in np.flatnonzero(booked[0] + run[0])]
+
+    def totals(
+        self,
+        rows: dict,
+        first: int,
+        last: int,
+        products: list[str] = None,
+        groups: list[str] = None,
+        categories: list[str] = None,
+        segment: str = None,
+    ) -> np.ndarray:
+        # Bookings, distinct times, slots and on-campus slots of the rows in
+        # [first, last) passing the filters, per segment code (one column
+        # without a segment). With people categories, only bookings with
+        # some participant in them count, as only their participants do.
+        lo, hi = np.searchsorted(rows["time"], (first, last))
+        if not (products or groups or categories):
+            return running_totals(rows, lo, hi, segment)
+        keep = None
+        if products or groups:
+            cells = np.logical_and.outer(
+                self.mask("products", products), self.mask("groupCategories", groups)
+            )
+            keep = cells.ravel()[rows["cell"][lo:hi]]
+        if categories:
+            columns = self.codes("peopleCategories", categories)
+            slots = rows["seats"][columns, lo:hi].sum(axis=0)
+            on_campus = rows["onCampus"][columns, lo:hi].sum(axis=0)
+            keep = slots > 0 if keep is None else keep & (slots > 0)
+        else:
+            slots = rows["slots"][lo:hi]
+            on_campus = rows["onCampusTotal"][lo:hi]
+        return scan_totals(rows, lo, hi, segment, keep, slots, on_campus)
+
+    def slot_seats(
+        self, first: int, last: int, products: list[str] = None
+    ) -> tuple[np.ndarray, ...]:
+        # Start, end, product code, offered and booked seats of each slot
+        # starting in [first, last), then of each event with seats booked
+        # in it that has no slot at all, offered at its product's capacity
+        # or its seats if more. Without a capacity (no slots synced) such an
+        # event's offer is unknown, so it is left out rather than shown full.
+        lo, hi = np.searchsorted(self.slots["startTime"], (first, last))
+        slot = {c: values[lo:hi] for c, values in self.slots.items()}
+        events = self.events
+        lo, hi = np.searchsorted(events["startTime"], (first, last))
+        missing = lo + np.flatnonzero(~events["inSlots"][lo:hi])
+        missing = missing[self.capacity[events["product"][missing]] > 0]
+        if products:
+            selected = self.mask("products", products)
+            keep = selected[slot["product"]]
+            slot = {c: values[keep] for c, values in slot.items()}
+            missing = missing[selected[events["product"][missing]]]
+        # Seats of the slot's event, if booked in range and of a selected
+        # product
+        e = slot["event"]
+        found = (e >= lo) & (e < hi)
+        if products:
+            found[found] = selected[events["product"][e[found]]]
+        booked = np.zeros(len(e), dtype=np.int64)
+        booked[found] = events["seats"][e[found]]
+        seats = events["seats"][missing]
+        product = events["product"][missing]
+        return (
+            np.concatenate([slot["startTime"], events["startTime"][missing]]),
+            np.concatenate([slot["endTime"], events["endTime"][missing]]),
+            np.concatenate([slot["product"], product]),
+            np.concatenate(
+                [slot["capacity"], np.maximum(self.capacity[product], seats)]
+            ),
+            np.concatenate([booked, seats]),
+        )
+
+
+def sorted_bookings(times: pd.Series, columns: dict, sizes: dict) -> dict:
+    # The booking columns ordered by times, with each booking's total slots
+    # and on-campus slots, per segment column the position of the first
+    # booking with the same time and segment, and the checkpoints
+    times = times.to_numpy(np.int64)
+    order = np.argsort(times, kind="stable")
+    rows = {"time": times[order]}
+    rows.update((c, values[..., order]) for c, values in columns.items())
+    rows["slots"] = rows["seats"].sum(axis=0, dtype=np.int32)
+    rows["onCampusTotal"] = rows["onCampus"].sum(axis=0, dtype=np.int32)
+    rows["pairs"] = {c: first_of_pair(rows["time"], rows[c]) for c in sizes}
+    rows["checkpoints"] = {
+        segment: checkpoints(rows, segment, size)
+        for segment, size in [(None, 1), *sizes.items()]
+    }
+    return rows
+
+
+def first_of_pair(times: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    # For each position in the sorted times, the first position holding the
+    # same time and code
+    order = np.lexsort((codes, times))
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = (times[order][1:] != times[order][:-1]) | (
+        codes[order][1:] != codes[order][:-1]
+    )
+    starts = np.flatnonzero(new)
+    first = np.empty(len(order), dtype=np.int32)
+    first[order] = np.repeat(order[starts], np.diff(np.append(starts, len(order))))
+    return first
+
+
+def checkpoints(rows: dict, segment: str, size: int) -> tuple:
+    # Positions about every CHECKPOINT_EVERY bookings, moved back to the
+    # first booking at their time, and the scan_totals of the rows before
+    # each. No time spans a checkpoint, so distinct times add up across
+    # them.
+    times = rows["time"]
+    n = len(times)
+    marks = np.arange(0, n, CHECKPOINT_EVERY)
+    bounds = np.unique(np.append(np.searchsorted(times, times[marks]), n))
+    block = np.searchsorted(bounds, np.arange(n), side="right") - 1
+    if segment is None:
+        codes = np.zeros(n, dtype=np.int32)
+        new = np.ones(n, dtype=bool)
+        new[1:] = times[1:] != times[:-1]
+    else:
+        codes = rows[segment]
+        new = rows["pairs"][segment] == np.arange(n)
+    cells = block * size + codes
+    sums = np.stack(
+        [
+            np.bincount(cells, weights, minlength=len(bounds) * size)
+            for weights in (None, new, rows["slots"], rows["onCampusTotal"])
+        ]
+    )
+    sums = sums.reshape(4, len(bounds), size).transpose(1, 0, 2).astype(np.int64)
+    totals = np.zeros((len(bounds), 4, size), dtype=np.int64)
+    totals[1:] = np.cumsum(sums[:-1], axis=0)
+    return bounds, totals
+
+
+def running_totals(rows: dict, lo: int, hi: int, segment: str) -> np.ndarray:
+    # scan_totals of all rows in [lo, hi), from the checkpoints inside it
+    # and scans of the rows beyond the outermost ones
+    bounds, totals = rows["checkpoints"][segment]
+    i = np.searchsorted(bounds, lo)
+    j = np.searchsorted(bounds, hi, side="right") - 1
+    if i >= j:
+        return scan_totals(rows, lo, hi, segment)
+    return (
+        totals[j]
+        - totals[i]
+        + scan_totals(rows, lo, bounds[i], segment)
+        + scan_totals(rows, bounds[j], hi, segment)
+    )
+
+
+def scan_totals(
+    rows: dict,
+    lo: int,
+    hi: int,
+    segment: str = None,
+    keep: np.ndarray = None,
+    slots: np.ndarray = None,
+    on_campus: np.ndarray = None,
+) -> np.ndarray:
+    # Bookings, distinct times, slots and on-campus slots per segment code
+    # of the rows in [lo, hi) where keep, or all of them, with the given
+    # slots if not their totals. Bookings with the same time and segment
+    # point at one position, whose code is theirs.
+    if slots is None:
+        slots, on_campus = rows["slots"][lo:hi], rows["onCampusTotal"][lo:hi]
+    if segment is None:
+        times = rows["time"][lo:hi]
+        if keep is not None:
+            times, slots, on_campus = times[keep], slots[keep], on_campus[keep]
+        distinct = np.count_nonzero(np.diff(times)) + 1 if len(times) else 0
+        return np.array(
+            [[len(times)], [distinct], [slots.sum()], [on_campus.sum()]],
+            dtype=np.int64,
+        )
+    codes = rows[segment][lo:hi]
+    pairs = rows["pairs"][segment][lo:hi] - lo
+    size = rows["checkpoints"][segment][1].shape[2]
+    if keep is not None:
+        codes, pairs = codes[keep], pairs[keep]
+        slots, on_campus = slots[keep], on_campus[keep]
+    distinct = np.flatnonzero(np.bincount(pairs, minlength=hi - lo))
+    return np.stack(
+        [
+            np.bincount(codes, minlength=size),
+            np.bincount(rows[segment][lo:hi][distinct], minlength=size),
+            np.bincount(codes, slots, minlength=size),
+            np.bincount(codes, on_campus, minlength=size),
+        ]
+    ).astype(np.int64)
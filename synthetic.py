@@ -0,0 +1,504 @@
+import datetime as dt
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+PRODUCTS = [
+    ("Mystery Manor", "MANOR"),
+    ("Heist", "HEIST"),
+    ("Submarine", "SUB"),
+    ("Haunted Library", "LIBRARY"),
+    ("Space Station", "SPACE"),
+    ("Pharaoh's Tomb", "TOMB"),
+]
+PEOPLE_CATEGORIES = [
+    {"id": "Cadults", "name": "Adult"},
+    {"id": "Cstudents", "name": "Student"},
+    {"id": "Cchildren", "name": "Child"},
+]
+# Seats per slot of each product
+CAPACITY = {code: 8 + 2 * (k % 3) for k, (_, code) in enumerate(PRODUCTS)}
+FIRST_PID = 730000000
+PRICE_PER_PLAYER = 2800
+LOCATIONS = ["L1", "L2"]
+# Free-text answers as customers type them, blanks included
+GROUP_CATEGORIES = [
+    "Friends/Family",
+    "friends/family ",
+    "Birthday",
+    "Corporate",
+    "Student organization",
+    "",
+]
+CONTACT_METHODS = ["Phone", "Email", "Walk-in"]
+
+
+def iso(timestamp: float) -> str:
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc).isoformat()
+
+
+def parse_zulu(value: str) -> float:
+    value = value.removesuffix("Z")
+    return dt.datetime.fromisoformat(value).replace(tzinfo=dt.timezone.utc).timestamp()
+
+
+class SyntheticBookeo:
+    # n bookings spread evenly by start time between start and end. Every
+    # booking is derived from its index and the seed, so nothing is held in
+    # memory except the bookings changed by mutate().
+    def __init__(
+        self,
+        n: int,
+        seed: int = 0,
+        start: dt.date = dt.date(2023, 1, 2),
+        end: dt.date = None,
+    ):
+        end = end or dt.date.today() - dt.timedelta(days=1)
+        self.n = n
+        self.seed = seed
+        self.t0 = dt.datetime.combine(start, dt.time(), dt.timezone.utc).timestamp()
+        self.t1 = dt.datetime.combine(end, dt.time(), dt.timezone.utc).timestamp()
+        self.step = (self.t1 - self.t0) / n
+        self.pids = max(1000, n // 2)
+        self.changed = {}
+        self._lock = threading.Lock()
+
+    def booking(self, i: int) -> dict:
+        rng = random.Random(self.seed * 1_000_003 + i)
+        product, start, count, creation, canceled = self._event(i, rng)
+        change, canceled = self.changed.get(i, (creation, canceled))
+        participants = [
+            {
+                "peopleCategoryId": rng.choice(PEOPLE_CATEGORIES)["id"],
+                "personDetails": {
+                    "firstName": f"First{i}",
+                    "lastName": f"Last{i}",
+                    "customFields": [
+                        {
+                            "name": "PID",
+                            "value": str(FIRST_PID + rng.randrange(self.pids)),
+                        }
+                    ],
+                },
+            }
+            for _ in range(count)
+        ]
+        booking = {
+            "bookingNumber": str(1_000_000 + i),
+            "eventId": f"{product}_{int(start)}",
+            "startTime": iso(start),
+            "endTime": iso(start + 3600),
+            "customerId": str(rng.randrange(self.n)),
+            "title": f"Booking {i}",
+            "canceled": canceled,
+            "accepted": True,
+            "sourceIp": "127.0.0.1",
+            "creationTime": iso(creation),
+            "lastChangeTime": iso(change),
+            "creationAgent": rng.choice([None, "Staff"]),
+            "productId": product,
+            "privateEvent": rng.random() < 0.2,
+            "noShow": False,
+            "participants": {"details": participants},
+        }
+        # Staff record how the customer got in touch
+        fields = [{"name": "Group category", "value": rng.choice(GROUP_CATEGORIES)}]
+        if booking["creationAgent"]:
+            fields.append(
+                {"name": "Contact method", "value": rng.choice(CONTACT_METHODS)}
+            )
+        booking["customFields"] = fields
+        return booking
+
+    def _event(self, i: int, rng: random.Random) -> tuple:
+        # The draws that place a booking in its slot, made before any other
+        # so slots_between() needn't build whole bookings. Slots start on
+        # the hour, one per product and hour.
+        start = self._start(i)
+        product = rng.choice(PRODUCTS)[1]
+        count = rng.randint(1, 8)
+        creation = start - rng.randint(0, 30 * 86400)
+        return product, start, count, creation, rng.random() < 0.05
+
+    def starting_between(self, start: float, end: float) -> range:
+        first = max(0, int((start - self.t0) // self.step))
+        last = min(self.n, int((end - self.t0) // self.step) + 2)
+        # Trim the slop from rounding start times down to the hour
+        ids = range(first, max(first, last))
+        while ids and self._start(ids[0]) < start:
+            ids = ids[1:]
+        while ids and self._start(ids[-1]) > end:
+            ids = ids[:-1]
+        return ids
+
+    def _start(self, i: int) -> float:
+        start = self.t0 + i * self.step
+        return start - start % 3600
+
+    def slots_between(self, product: str, start: float, end: float) -> list[dict]:
+        # Hourly slots of product starting in [start, end), round the clock
+        # while there are bookings, with the seats its bookings leave
+        seats = {}
+        for i in self.starting_between(start, end):
+            code, begin, count, _, canceled = self._event(
+                i, random.Random(self.seed * 1_000_003 + i)
+            )
+            canceled = self.changed.get(i, (None, canceled))[1]
+            if code == product and not canceled:
+                seats[begin] = seats.get(begin, 0) + count
+        first = max(start, self.t0)
+        first += -first % 3600
+        return [
+            {
+                "eventId": f"{product}_{int(t)}",
+                "productId": product,
+                "startTime": iso(t),
+                "endTime": iso(t + 3600),
+                "numSeatsAvailable": max(0, CAPACITY[product] - seats.get(t, 0)),
+            }
+            for t in range(int(first), int(min(end, self.t1)), 3600)
+        ]
+
+    def changed_between(self, start: float, end: float) -> list[int]:
+        with self._lock:
+            return sorted(i for i, (t, _) in self.changed.items() if start <= t <= end)
+
+    def mutate(self, k: int, rng: random.Random = random):
+        # Marks k bookings as changed now, some of them canceled. Whole
+        # seconds, the precision of the lastUpdated filters.
+        changed_at = float(int(time.time()))
+        with self._lock:
+            for i in rng.sample(range(self.n), min(k, self.n)):
+                self.changed[i] = (changed_at, rng.random() < 0.5)
+
+    def roster_csv(self, fraction: float = 0.5, seed: int = 0) -> bytes:
+        rng = random.Random(self.seed * 1_000_003 + seed)
+        pids = rng.sample(range(self.pids), int(self.pids * fraction))
+        rows = "".join(f"{FIRST_PID + p},First{p},Last{p}\r\n" for p in pids)
+        return ("PID,First Name,Last Name\r\n" + rows).encode()
+
+
+class SyntheticSquare:
+    # n completed-or-not Square orders, one payment each, spread evenly by
+    # close time like SyntheticBookeo. Orders and payments are "updated" when
+    # they close, or when mutate() refunds them.
+    def __init__(
+        self,
+        n: int,
+        seed: int = 0,
+        start: dt.date = dt.date(2023, 1, 2),
+        end: dt.date = None,
+    ):
+        end = end or dt.date.today() - dt.timedelta(days=1)
+        self.n = n
+        self.seed = seed
+        self.t0 = dt.datetime.combine(start, dt.time(), dt.timezone.utc).timestamp()
+        self.t1 = dt.datetime.combine(end, dt.time(), dt.timezone.utc).timestamp()
+        self.step = (self.t1 - self.t0) / n
+        self.refunded = {}
+        self._lock = threading.Lock()
+
+    def _closed(self, i: int) -> float:
+        return float(int(self.t0 + i * self.step))
+
+    def order(self, i: int) -> dict:
+        rng = random.Random(self.seed * 1_000_003 + i)
+        closed = self._closed(i)
+        state = "COMPLETED" if rng.random() < 0.95 else "CANCELED"
+        lines = []
+        for n in range(rng.randint(1, 2)):
+            players = rng.randint(2, 8)
+            gross = PRICE_PER_PLAYER * players
+            discount = 500 if rng.random() < 0.1 else 0
+            tax = (gross - discount) * 7 // 100
+            lines.append(
+                {
+                    "uid": f"{i}-{n}",
+                    "name": rng.choice(PRODUCTS)[0],
+                    "catalog_object_id": f"ITEM{n}",
+                    "quantity": str(players),
+                    "gross_sales_money": money(gross),
+                    "total_discount_money": money(discount),
+                    "total_tax_money": money(tax),
+                    "total_money": money(gross - discount + tax),
+                }
+            )
+        order = {
+            "id": f"O{i}",
+            "location_id": LOCATIONS[i % len(LOCATIONS)],
+            "state": state,
+            "created_at": iso(closed - 600),
+            "updated_at": iso(closed),
+            "closed_at": iso(closed) if state == "COMPLETED" else None,
+            "line_items": lines,
+        }
+        with self._lock:
+            refunded_at = self.refunded.get(i)
+        if refunded_at is not None:
+            line = lines[0]
+            order["updated_at"] = iso(refunded_at)
+            order["returns"] = [
+                {
+                    "return_line_items": [
+                        {
+                            "uid": f"{i}-r",
+                            "name": line["name"],
+                            "quantity": line["quantity"],
+                            "gross_return_money": line["gross_sales_money"],
+                            "total_discount_money": line["total_discount_money"],
+                            "total_tax_money": line["total_tax_money"],
+                            "total_money": line["total_money"],
+                        }
+                    ]
+                }
+            ]
+        return order
+
+    def payment(self, i: int) -> dict:
+        order = self.order(i)
+        total = sum(li["total_money"]["amount"] for li in order["line_items"])
+        refunded = sum(
+            li["total_money"]["amount"]
+            for r in order.get("returns", [])
+            for li in r["return_line_items"]
+        )
+        return {
+            "id": f"P{i}",
+            "order_id": order["id"],
+            "location_id": order["location_id"],
+            "status": "COMPLETED" if order["state"] == "COMPLETED" else "CANCELED",
+            "created_at": iso(self._closed(i)),
+            "updated_at": order["updated_at"],
+            "amount_money": money(total),
+            "tip_money": money(0),
+            "refunded_money": money(refunded),
+        }
+
+    def updated_between(self, start: float, end: float) -> list[int]:
+        first = max(0, int(-(-(start - self.t0) // self.step)))
+        last = min(self.n, int((end - self.t0) // self.step) + 1)
+        with self._lock:
+            refunded = dict(self.refunded)
+        ids = [
+            i
+            for i in range(first, last)
+            if i not in refunded and start <= self._closed(i) <= end
+        ]
+        ids += [i for i, t in refunded.items() if start <= t <= end]
+        return sorted(ids)
+
+    def mutate(self, k: int, rng: random.Random = random):
+        # Refunds k orders now, whole seconds like SyntheticBookeo.mutate
+        refunded_at = float(int(time.time()))
+        with self._lock:
+            for i in rng.sample(range(self.n), min(k, self.n)):
+                self.refunded[i] = refunded_at
+
+
+def money(amount: int) -> dict:
+    return {"amount": amount, "currency": "USD"}
+
+
+def query_params(path: str) -> tuple[str, dict]:
+    url = urlsplit(path)
+    return url.path, {k: v[0] for k, v in parse_qs(url.query).items()}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; with Nagle on, every
+    # keep-alive response waits out the client's delayed ACK (~40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_square_handler(data: SyntheticSquare):
+    cursors = {}
+    counter = itertools.count(1)
+
+    class MockSquareHandler(MockHandler):
+        def page(self, key: str, ids: list[int], limit: int, cursor: str, fetch):
+            # Cursor pagination: the result list is kept server side and
+            # the cursor names it and the next offset
+            if cursor:
+                name, offset = cursor.split(":")
+                if name not in cursors:
+                    return self.send_json({"errors": [{"code": "BAD_REQUEST"}]}, 400)
+                ids, offset = cursors[name], int(offset)
+            else:
+                name, offset = str(next(counter)), 0
+                cursors[name] = ids
+            payload = {key: [fetch(i) for i in ids[offset : offset + limit]]}
+            if offset + limit < len(ids):
+                payload["cursor"] = f"{name}:{offset + limit}"
+            self.send_json(payload)
+
+        def do_GET(self):
+            path, q = query_params(self.path)
+            path = path.rstrip("/").rsplit("/v2", 1)[-1]
+            if path == "/locations":
+                return self.send_json({"locations": [{"id": l} for l in LOCATIONS]})
+            if path != "/payments":
+                return self.send_json({"errors": [{"code": "NOT_FOUND"}]}, 404)
+            ids = []
+            if "cursor" not in q:
+                ids = data.updated_between(
+                    parse_zulu(q["updated_at_begin_time"]),
+                    parse_zulu(q["updated_at_end_time"]),
+                )
+            limit = int(q.get("limit", 100))
+            self.page("payments", ids, limit, q.get("cursor"), data.payment)
+
+        def do_POST(self):
+            path, q = query_params(self.path)
+            if path.endswith("/_mutate"):
+                count = int(q.get("count", 100))
+                data.mutate(count, random.Random(int(q.get("seed", 0))))
+                return self.send_json({"mutated": count})
+            if not path.endswith("/orders/search"):
+                return self.send_json({"errors": [{"code": "NOT_FOUND"}]}, 404)
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            ids = []
+            if "cursor" not in body:
+                updated = body["query"]["filter"]["date_time_filter"]["updated_at"]
+                locations = set(body["location_ids"])
+                ids = [
+                    i
+                    for i in data.updated_between(
+                        parse_zulu(updated["start_at"]), parse_zulu(updated["end_at"])
+                    )
+                    if LOCATIONS[i % len(LOCATIONS)] in locations
+                ]
+            limit = int(body.get("limit", 500))
+            self.page("orders", ids, limit, body.get("cursor"), data.order)
+
+    return MockSquareHandler
+
+
+def make_handler(data: SyntheticBookeo):
+    tokens = {}
+    counter = itertools.count(1)
+
+    class MockBookeoHandler(MockHandler):
+        def page(self, items, per_page: int, number: int, token: str, fetch):
+            total = max(1, -(-len(items) // per_page))
+            chunk = items[(number - 1) * per_page : number * per_page]
+            self.send_json(
+                {
+                    "info": {
+                        "totalItems": len(items),
+                        "totalPages": total,
+                        "currentPage": number,
+                        "pageNavigationToken": token,
+                    },
+                    "data": [fetch(i) for i in chunk],
+                }
+            )
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            path = url.path.rstrip("/").rsplit("/v2", 1)[-1]
+            if path == "/settings/peoplecategories":
+                return self.send_json({"categories": PEOPLE_CATEGORIES})
+            if path == "/settings/products":
+                products = [{"name": n, "productCode": c} for n, c in PRODUCTS]
+                return self.page(products, 100, 1, None, lambda p: p)
+            if path not in ("/bookings", "/availability/slots"):
+                return self.send_json({"message": "Not found"}, 404)
+
+            if "pageNavigationToken" in q:
+                token = q["pageNavigationToken"]
+                if token not in tokens:
+                    return self.send_json({"message": "Bad token"}, 400)
+                items, per_page = tokens[token]
+                number = int(q.get("pageNumber", 1))
+            else:
+                if path == "/availability/slots":
+                    items = data.slots_between(
+                        q["productId"],
+                        parse_zulu(q["startTime"]),
+                        parse_zulu(q["endTime"]),
+                    )
+                elif "lastUpdatedStartTime" in q:
+                    items = data.changed_between(
+                        parse_zulu(q["lastUpdatedStartTime"]),
+                        parse_zulu(q["lastUpdatedEndTime"]),
+                    )
+                else:
+                    items = data.starting_between(
+                        parse_zulu(q["startTime"]), parse_zulu(q["endTime"])
+                    )
+                per_page = int(q.get("itemsPerPage", 50))
+                token = str(next(counter))
+                tokens[token] = (items, per_page)
+                number = 1
+            fetch = data.booking if path == "/bookings" else lambda slot: slot
+            self.page(items, per_page, number, token, fetch)
+
+        def do_POST(self):
+            # Test hook: POST /_mutate?count=100 changes bookings so the next
+            # incremental sync has something to fetch
+            url = urlsplit(self.path)
+            q = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if not url.path.endswith("/_mutate"):
+                return self.send_json({"message": "Not found"}, 404)
+            count = int(q.get("count", 100))
+            data.mutate(count, random.Random(int(q.get("seed", 0))))
+            self.send_json({"mutated": count})
+
+    return MockBookeoHandler
+
+
+class MockServer:
+    # Serves a mock API handler over HTTP on localhost:
+    #   with MockBookeoServer(SyntheticBookeo(10_000)) as server:
+    #       BookeoClient(..., base_url=server.url)
+    def __init__(self, handler, port: int = 0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/v2"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class MockBookeoServer(MockServer):
+    def __init__(self, data: SyntheticBookeo, port: int = 0):
+        super().__init__(make_handler(data), port)
+        self.data = data
+
+
+class MockSquareServer(MockServer):
+    def __init__(self, data: SyntheticSquare, port: int = 0):
+        super().__init__(make_square_handler(data), port)
+        self.data = data
+
+
+def serve(n: int, seed: int, conn):
+    # Entry point for running the mock servers in a separate process, so
+    # they don't compete with the client for the GIL. Sends the Bookeo and
+    # Square URLs over conn.
+    with MockBookeoServer(SyntheticBookeo(n, seed)) as bookeo:
+        with MockSquareServer(SyntheticSquare(n, seed)) as square:
+            conn.send((bookeo.url, square.url))
+            conn.recv()
@@ -0,0 +1,137 @@
+import datetime as dt
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import analytics
+from synthetic import (
+    MockBookeoServer,
+    MockHandler,
+    MockSquareServer,
+    SyntheticBookeo,
+    SyntheticSquare,
+)
+
+
+def clear_caches():
+    # Process resources (the database, clients, refreshers) and the report
+    # caches, whose generations restart with every new database
+    for fn in vars(analytics).values():
+        if hasattr(fn, "__wrapped__") and callable(getattr(fn, "clear", None)):
+            fn.clear()
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    # A migrated, empty database in a temporary directory, with the
+    # archive and history next to it
+    monkeypatch.setenv("DATABASE", str(tmp_path / "test.sqlite3"))
+    monkeypatch.setenv("USER_AGENT", analytics.USER_AGENT)
+    clear_caches()
+    db = analytics.get_db()
+    yield db
+    db.close()
+    clear_caches()
+
+
+@pytest.fixture
+def bookeo():
+    # Synthetic bookings over the first five months of 2024
+    return SyntheticBookeo(2000, start=dt.date(2024, 1, 1), end=dt.date(2024, 6, 1))
+
+
+def ingest(db, data: SyntheticBookeo):
+    # Every synthetic booking, written as a sync would, with the rollup
+    pages = [
+        [data.booking(i) for i in range(j, min(j + 100, data.n))]
+        for j in range(0, data.n, 100)
+    ]
+    with db.write() as conn:
+        cur = conn.cursor()
+        analytics.refresh_rollup(cur, analytics.ingest_bookings(cur, iter(pages)))
+        analytics.snapshot_changed(cur)
+        conn.commit()
+
+
+class StubServer:
+    # Answers every GET with respond(number) -> (status, payload, headers),
+    # number counting requests from 1, and tracks the most requests ever in
+    # flight at once
+    def __init__(self, respond, delay: float = 0):
+        stub = self
+        self.requests = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+        class Handler(MockHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                    number = stub.requests
+                    stub.in_flight += 1
+                    stub.peak = max(stub.peak, stub.in_flight)
+                try:
+                    time.sleep(delay)
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+                status, payload, headers = respond(number)
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/v2"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def unauthorized(monkeypatch):
+    # A Bookeo that turns down every request, as it does a revoked key
+    with StubServer(lambda number: (401, {}, {})) as server:
+        monkeypatch.setenv("BOOKEO_API_KEY", "key")
+        monkeypatch.setenv("BOOKEO_SECRET_KEY", "secret")
+        monkeypatch.setenv("BOOKEO_API_URL", server.url)
+        yield server
+
+
+@pytest.fixture
+def bookeo_server(bookeo, monkeypatch):
+    # MockBookeoServer serving the synthetic bookings to get_bookeo()
+    with MockBookeoServer(bookeo) as server:
+        monkeypatch.setenv("BOOKEO_API_KEY", "key")
+        monkeypatch.setenv("BOOKEO_SECRET_KEY", "secret")
+        monkeypatch.setenv("BOOKEO_API_URL", server.url)
+        yield server
+
+
+@pytest.fixture
+def square():
+    # Synthetic Square orders over the first two months of 2024, more per
+    # 30 day window than one page of order search holds
+    return SyntheticSquare(3000, start=dt.date(2024, 1, 1), end=dt.date(2024, 3, 1))
+
+
+@pytest.fixture
+def square_server(square, monkeypatch):
+    with MockSquareServer(square) as server:
+        monkeypatch.setenv("SQUARE_API_KEY", "token")
+        monkeypatch.setenv("SQUARE_API_URL", server.url)
+        yield server
@@ -0,0 +1,143 @@
+import json
+
+import analytics
+from archive import ResponseArchive
+from synthetic import parse_zulu
+
+WINDOW = {"startTime": "2024-01-01T00:00:00Z", "endTime": "2024-01-31T00:00:00Z"}
+
+
+def fetch(archive: ResponseArchive, fetched: str, pages: int, numbers=None):
+    # Records pages numbers (all of them by default) of one fetch of WINDOW
+    digests = []
+    for n in numbers or range(1, pages + 1):
+        digest = archive.put({"fetched": fetched, "page": n})
+        archive.record(
+            kind="blocks",
+            fetched=fetched,
+            window=WINDOW,
+            page=n,
+            pages=pages,
+            digest=digest,
+        )
+        digests.append(digest)
+    return digests
+
+
+def test_only_complete_fetches(tmp_path):
+    archive = ResponseArchive(str(tmp_path))
+    later = fetch(archive, "2024-02-02T00:00:00Z", 3, [3, 1, 2])
+    fetch(archive, "2024-02-03T00:00:00Z", 3, [1, 3])
+    earlier = fetch(archive, "2024-02-01T00:00:00Z", 2)
+    empty = fetch(archive, "2024-02-04T00:00:00Z", 0, [1])
+    assert archive.fetches("blocks") == [
+        {"fetched": "2024-02-01T00:00:00Z", "window": WINDOW, "digests": earlier},
+        # In page order, whatever order the pages came in
+        {
+            "fetched": "2024-02-02T00:00:00Z",
+            "window": WINDOW,
+            "digests": [later[1], later[2], later[0]],
+        },
+        {"fetched": "2024-02-04T00:00:00Z", "window": WINDOW, "digests": empty},
+    ]
+    assert archive.fetches("updates") == []
+    assert archive.get(earlier[1]) == {"fetched": "2024-02-01T00:00:00Z", "page": 2}
+
+
+def test_torn_manifest(tmp_path):
+    archive = ResponseArchive(str(tmp_path))
+    digests = fetch(archive, "2024-02-01T00:00:00Z", 2, [1])
+    # The second page's line, cut short by a sync that died writing it
+    line = json.dumps(
+        {
+            "kind": "blocks",
+            "fetched": "2024-02-01T00:00:00Z",
+            "window": WINDOW,
+            "page": 2,
+            "pages": 2,
+            "digest": archive.put({"page": 2}),
+        },
+        sort_keys=True,
+    )
+    with open(archive.manifest, "a") as f:
+        f.write(line[: len(line) // 2])
+    assert len(archive.entries()) == 1
+    assert archive.fetches("blocks") == []
+
+    # A later sync appends after the torn line
+    with open(archive.manifest, "a") as f:
+        f.write("\n")
+    digests += fetch(archive, "2024-02-01T00:00:00Z", 2, [2])
+    assert archive.fetches("blocks") == [
+        {"fetched": "2024-02-01T00:00:00Z", "window": WINDOW, "digests": digests}
+    ]
+
+
+def tables(db) -> dict:
+    # Bookings, participants and the rollup, with segments by name
+    with db.read() as conn:
+        return {
+            "bookings": conn.execute(
+                """SELECT b.*, g.name, c.name FROM bookings b
+                LEFT JOIN groupCategories g ON g.id=b.groupCategory
+                LEFT JOIN contactMethods c ON c.id=b.contactMethod
+                ORDER BY b.id"""
+            ).fetchall(),
+            "participants": sorted(
+                conn.execute("SELECT * FROM participants").fetchall(), key=repr
+            ),
+            "dailyRollup": sorted(
+                conn.execute(
+                    """SELECT r.*, g.name FROM dailyRollup r
+                    LEFT JOIN groupCategories g ON g.id=r.groupCategory"""
+                ).fetchall(),
+                key=repr,
+            ),
+        }
+
+
+def test_replay_matches_download(database, bookeo, bookeo_server):
+    analytics.update_bookings()
+    downloaded = tables(database)
+    assert len(downloaded["bookings"]) == bookeo.n
+
+    with database.write() as conn:
+        conn.execute("DELETE FROM participants")
+        conn.execute("DELETE FROM bookings")
+        conn.execute("DELETE FROM dailyRollup")
+        conn.commit()
+    analytics.update_bookings(replay=True)
+    assert tables(database) == downloaded
+
+    # Closed blocks are replayed by the next rebuild, not downloaded again
+    before = len(analytics.get_archive().fetches("blocks"))
+    analytics.rebuild_bookings()
+    assert tables(database) == downloaded
+    assert len(analytics.get_archive().fetches("blocks")) - before < before
+
+
+def test_full_resync_downloads_again(database, bookeo, bookeo_server):
+    analytics.update_bookings()
+    archive = analytics.get_archive()
+    blocks = len(archive.fetches("blocks"))
+    # Drift: a booking canceled in Bookeo without a change the incremental
+    # sync would see, so only downloading it again picks it up
+    i = next(i for i in range(bookeo.n) if not bookeo.booking(i)["canceled"])
+    creation = parse_zulu(bookeo.booking(i)["creationTime"])
+    bookeo.changed[i] = (creation, True)
+
+    analytics.update_bookings(replay=True)
+    assert not canceled(database, bookeo, i)
+    analytics.update_bookings(full_resync=True)
+    assert canceled(database, bookeo, i)
+    # Every block fetched again, including the closed ones
+    assert len(archive.fetches("blocks")) == 2 * blocks
+
+
+def canceled(db, data, i: int) -> bool:
+    booking_id = int(data.booking(i)["bookingNumber"])
+    with db.read() as conn:
+        (value,) = conn.execute(
+            "SELECT canceled FROM bookings WHERE id=?", (booking_id,)
+        ).fetchone()
+    return bool(value)
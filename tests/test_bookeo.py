@@ -0,0 +1,117 @@
+import datetime as dt
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import bookeo
+from bookeo import BookeoClient, BookeoError
+from conftest import StubServer
+from synthetic import MockBookeoServer, SyntheticBookeo, iso, parse_zulu
+
+
+def client(url: str, **kwargs) -> BookeoClient:
+    return BookeoClient("api", "secret", "test", base_url=url, **kwargs)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # Retry delays, recorded instead of slept
+    delays = []
+    clock = SimpleNamespace(perf_counter=time.perf_counter, sleep=delays.append)
+    monkeypatch.setattr(bookeo, "time", clock)
+    return delays
+
+
+def test_retries_until_success(sleeps):
+    def respond(number):
+        if number <= 2:
+            return 429, {}, {"Retry-After": "3"}
+        return 200, {"data": ["ok"]}, {}
+
+    with StubServer(respond) as server:
+        page = client(server.url).get_page("bookings")
+    assert page == {"data": ["ok"]}
+    assert server.requests == 3
+    assert sleeps == [3.0, 3.0]
+
+
+def test_backoff_without_retry_after(sleeps):
+    with StubServer(lambda number: (503, {}, {})) as server:
+        res = client(server.url, max_retries=3, backoff=0.5).get("bookings")
+    # Gives up after max_retries and hands back the last response
+    assert res.status_code == 503
+    assert server.requests == 4
+    assert len(sleeps) == 3
+    for attempt, delay in enumerate(sleeps):
+        assert 0.5 * 2**attempt <= delay <= 2 * 0.5 * 2**attempt
+
+
+def test_error_status_not_retried(sleeps):
+    with StubServer(lambda number: (404, {}, {})) as server:
+        with pytest.raises(BookeoError):
+            client(server.url).get_page("bookings")
+    assert server.requests == 1
+    assert sleeps == []
+
+
+def test_errors_leave_out_keys(sleeps):
+    with StubServer(lambda number: (401, {}, {})) as server:
+        with pytest.raises(BookeoError) as error:
+            client(server.url).get_page("bookings", itemsPerPage=100)
+    assert str(error.value) == "Bookeo request failed: 401 /v2/bookings"
+
+    with StubServer(lambda number: (200, {}, {})) as server:
+        url = server.url
+    with pytest.raises(requests.ConnectionError) as error:
+        client(url, max_retries=1).get("bookings")
+    assert "secret" not in str(error.value)
+    assert "/v2/bookings" in str(error.value)
+
+
+def test_in_flight_capped_per_host():
+    def respond(number):
+        info = {"totalPages": 1}
+        return 200, {"info": info, "data": [number]}, {}
+
+    with StubServer(respond, delay=0.05) as server:
+        pages = client(server.url, max_workers=8, max_per_host=2).get_all(
+            "bookings", [{"window": w} for w in range(12)]
+        )
+        assert len(list(pages)) == 12
+    assert server.peak == 2
+
+
+def test_pages_of_every_window():
+    data = SyntheticBookeo(1000, start=dt.date(2024, 1, 1), end=dt.date(2024, 3, 1))
+    windows = [
+        {"startTime": iso(data.t0), "endTime": iso((data.t0 + data.t1) / 2)},
+        {"startTime": iso((data.t0 + data.t1) / 2), "endTime": iso(data.t1)},
+    ]
+    seen = []
+
+    def on_page(window, number, total, page):
+        seen.append((windows.index(window), number, total))
+
+    with MockBookeoServer(data) as server:
+        pages = client(server.url, max_workers=4).get_all(
+            "bookings", windows, on_page=on_page, itemsPerPage=25
+        )
+        numbers = [b["bookingNumber"] for page in pages for b in page]
+
+    expected = [
+        str(1_000_000 + i)
+        for w in windows
+        for i in data.starting_between(
+            parse_zulu(w["startTime"]), parse_zulu(w["endTime"])
+        )
+    ]
+    assert sorted(numbers) == sorted(expected)
+    for w in range(len(windows)):
+        numbers = [n for v, n, _ in seen if v == w]
+        (total,) = {t for v, _, t in seen if v == w}
+        # Page 1 reports the total, so comes before every other page
+        assert numbers[0] == 1
+        assert sorted(numbers) == list(range(1, total + 1))
+    assert len(seen) > 2 * len(windows)
@@ -0,0 +1,72 @@
+import argparse
+import datetime as dt
+
+import pytest
+
+import analytics
+import cli
+
+
+def test_load_config(tmp_path, monkeypatch):
+    path = tmp_path / "secrets.toml"
+    path.write_text(
+        'BOOKEO_API_KEY = "from-file"\nDATABASE_PATH = "bookings.sqlite3"\n'
+    )
+    monkeypatch.setenv("BOOKEO_API_KEY", "from-env")
+    monkeypatch.delenv("DATABASE", raising=False)
+    cli.load_config(str(path), required=True)
+    # The environment wins over the file
+    assert cli.os.environ["BOOKEO_API_KEY"] == "from-env"
+    assert cli.os.environ["DATABASE"] == "bookings.sqlite3"
+
+
+def test_missing_config(tmp_path):
+    cli.load_config(str(tmp_path / "none.toml"), required=False)
+    with pytest.raises(SystemExit):
+        cli.load_config(str(tmp_path / "none.toml"), required=True)
+
+
+def test_monthly_ranges():
+    args = argparse.Namespace(
+        range=None, start=dt.date(2024, 1, 15), end=dt.date(2024, 3, 10), every="month"
+    )
+    assert cli.date_ranges(args) == [
+        (dt.date(2024, 1, 15), dt.date(2024, 1, 31)),
+        (dt.date(2024, 2, 1), dt.date(2024, 2, 29)),
+        (dt.date(2024, 3, 1), dt.date(2024, 3, 10)),
+    ]
+
+
+def sync_args(*only: str) -> argparse.Namespace:
+    return argparse.Namespace(only=list(only), full_resync=False, replay=False)
+
+
+def test_failed_sync_exits_nonzero(database, unauthorized):
+    # A full reload, then an incremental sync
+    assert cli.sync(sync_args("bookings")) == 1
+    refresher = analytics.get_bookings_refresher()
+    assert refresher.last_error is not None
+    assert refresher.last_refresh is None
+    with database.write() as conn:
+        analytics.set_sync_state(
+            conn.cursor(), "bookingsLastUpdated", "2024-01-01T00:00:00Z"
+        )
+        conn.commit()
+    assert cli.sync(sync_args("bookings")) == 1
+    with database.read() as conn:
+        mark = analytics.get_sync_state(conn.cursor(), "bookingsLastUpdated")
+    assert mark == "2024-01-01T00:00:00Z"
+
+
+def test_failed_settings_not_marked(database, unauthorized):
+    assert cli.sync(sync_args("settings")) == 1
+    with database.read() as conn:
+        assert analytics.get_sync_state(conn.cursor(), "settingsSynced") is None
+
+
+def test_settings_marked(database, bookeo_server):
+    assert cli.sync(sync_args("settings")) == 0
+    with database.read() as conn:
+        assert analytics.get_sync_state(conn.cursor(), "settingsSynced") is not None
+    assert analytics.get_products()
+    assert analytics.get_people_categories()
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import analytics
+from conftest import ingest
+
+
+def state(conn) -> tuple:
+    # What a report could see of the staged tables, in one snapshot
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        return cur.execute(
+            """SELECT (SELECT COUNT(*) FROM bookings),
+            (SELECT SUM(canceled) FROM bookings),
+            (SELECT COUNT(*) FROM participants),
+            (SELECT value FROM syncState WHERE key='generation')"""
+        ).fetchone()
+    finally:
+        conn.rollback()
+        cur.close()
+
+
+def test_reads_during_writes(database, bookeo):
+    ingest(database, bookeo)
+    with database.write() as conn:
+        analytics.set_sync_state(conn.cursor(), "test", "before")
+        conn.commit()
+        before = state(conn)
+    done = threading.Event()
+    seen = set()
+    errors = []
+
+    def read():
+        while not done.is_set():
+            try:
+                with database.read() as conn:
+                    seen.add(state(conn))
+            except Exception as e:
+                errors.append(repr(e))
+
+    readers = [threading.Thread(target=read) for _ in range(6)]
+    for reader in readers:
+        reader.start()
+    try:
+        with database.write() as conn:
+            # A transaction that never commits
+            cur = conn.cursor()
+            cur.execute("BEGIN")
+            cur.execute("UPDATE bookings SET canceled=1")
+            cur.execute("DELETE FROM participants WHERE rowid % 2 = 0")
+            time.sleep(0.3)
+            conn.rollback()
+
+            # A full resync: staging tables filled over several commits,
+            # then swapped in
+            analytics.create_staging(conn)
+            conn.commit()
+            for step in (
+                "INSERT INTO bookingsStaging SELECT * FROM bookings",
+                "UPDATE bookingsStaging SET canceled = 1 - canceled",
+                """INSERT INTO participantsStaging
+                SELECT * FROM participants WHERE rowid % 2 = 0""",
+            ):
+                cur.execute(step)
+                conn.commit()
+                time.sleep(0.1)
+            cur.execute("BEGIN")
+            analytics.swap_staging(cur)
+            analytics.set_sync_state(cur, "test", "after")
+            conn.commit()
+            after = state(conn)
+        time.sleep(0.1)
+    finally:
+        done.set()
+        for reader in readers:
+            reader.join()
+
+    assert errors == []
+    assert before != after
+    assert seen == {before, after}
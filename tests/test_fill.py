@@ -0,0 +1,76 @@
+import datetime as dt
+
+import numpy as np
+
+import analytics
+import cli
+from conftest import ingest
+from synthetic import CAPACITY, PRODUCTS
+
+START, END = dt.date(2024, 1, 1), dt.date(2024, 5, 31)
+
+
+def slot_counts(db) -> dict[str, int]:
+    with db.read() as conn:
+        rows = conn.execute("SELECT productId, COUNT(*) FROM slots GROUP BY productId")
+        return dict(rows.fetchall())
+
+
+def test_unknown_capacity_left_out(database, bookeo):
+    # Booked events without slots, before any slot sync: nothing is known
+    # to have been offered, so nothing is shown as full
+    ingest(database, bookeo)
+    rates = analytics.get_fill_rates(START, END)
+    assert rates["offered"] == 0
+    assert rates["booked"] == 0
+    assert np.isnan(rates["fill"])
+    assert rates["slots"].empty
+
+
+def test_capacity_of_unsynced_events(database, bookeo):
+    ingest(database, bookeo)
+    with database.write() as conn:
+        conn.executemany(
+            "INSERT INTO products (name, id, capacity) VALUES (?, ?, ?)",
+            [(name, code, CAPACITY[code]) for name, code in PRODUCTS],
+        )
+        analytics.snapshot_changed(conn.cursor())
+        conn.commit()
+    rates = analytics.get_fill_rates(START, END)
+    assert 0 < rates["booked"] < rates["offered"]
+    assert (rates["slots"].offered >= rates["slots"].booked).all()
+
+
+def test_slots_need_products(database, unauthorized):
+    # Settings fail, so there are no products to fetch slots of
+    args = cli.argparse.Namespace(only=["slots"], full_resync=False, replay=False)
+    assert cli.sync(args) == 1
+    with database.read() as conn:
+        assert analytics.get_sync_state(conn.cursor(), "slotsLastSynced") is None
+
+
+def test_product_added_later(database, bookeo_server):
+    code = PRODUCTS[0][1]
+    analytics.update_settings()
+    with database.write() as conn:
+        conn.execute("DELETE FROM products WHERE id=?", (code,))
+        conn.commit()
+    analytics.update_slots()
+    counts = slot_counts(database)
+    assert code not in counts and counts
+
+    with database.write() as conn:
+        conn.execute(
+            "INSERT INTO products (name, id) VALUES (?, ?)", (PRODUCTS[0][0], code)
+        )
+        conn.commit()
+    analytics.update_slots()
+    # Its slots from the start, not just since the last slot sync
+    assert slot_counts(database)[code] > 0
+    with database.read() as conn:
+        first = conn.execute(
+            "SELECT MIN(startTime) FROM slots WHERE productId=?", (code,)
+        ).fetchone()[0]
+    assert first < analytics.to_epoch("2024-02-01T00:00:00Z")
+    # The other products' slots are unchanged
+    assert {p: n for p, n in slot_counts(database).items() if p != code} == counts
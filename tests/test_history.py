@@ -0,0 +1,198 @@
+import datetime as dt
+
+import pandas as pd
+import pytest
+
+import analytics
+from conftest import clear_caches, ingest
+from synthetic import PEOPLE_CATEGORIES, PRODUCTS, parse_zulu
+
+RANGES = [
+    (dt.date(2023, 12, 1), dt.date(2024, 7, 1)),
+    (dt.date(2024, 1, 20), dt.date(2024, 2, 10)),
+    (dt.date(2024, 3, 31), dt.date(2024, 3, 31)),
+    (dt.date(2024, 5, 15), dt.date(2024, 6, 15)),
+]
+FILTERS = [{}, {"product": ["Heist"], "pricingcat": ["Student"]}]
+
+
+@pytest.fixture
+def history(database, bookeo):
+    # The synthetic bookings, every month of them long closed, with a roster
+    ingest(database, bookeo)
+    with database.write() as conn:
+        conn.executemany("INSERT INTO products (name, id) VALUES (?, ?)", PRODUCTS)
+        conn.executemany(
+            "INSERT INTO peopleCategories (id, name) VALUES (:id, :name)",
+            PEOPLE_CATEGORIES,
+        )
+        analytics.snapshot_changed(conn.cursor())
+        conn.commit()
+    analytics.load_roster(bookeo.roster_csv())
+    return database
+
+
+def reports() -> list:
+    return [
+        (
+            analytics.get_report(start, end, **options),
+            analytics.get_segments(start, end, "Group category", **options),
+            analytics.get_trend(start, end, "Week", **options),
+        )
+        for start, end in RANGES
+        for options in FILTERS
+    ]
+
+
+def assert_same(reports: list, expected: list):
+    for (report, segments, trend), (report0, segments0, trend0) in zip(
+        reports, expected
+    ):
+        assert report == report0
+        pd.testing.assert_frame_equal(segments, segments0)
+        pd.testing.assert_frame_equal(trend, trend0)
+
+
+def rollup(db) -> list[tuple]:
+    with db.read() as conn:
+        return conn.execute(
+            """SELECT * FROM dailyRollup
+            ORDER BY day, productId, peopleCategory, groupCategory"""
+        ).fetchall()
+
+
+def count(db, q: str) -> int:
+    with db.read() as conn:
+        return conn.execute(q).fetchone()[0]
+
+
+def reload(db):
+    # Compaction leaves the generation alone, as reports don't change. Bumped
+    # here, and the snapshot dropped rather than loaded in the background,
+    # so the next reports are read again from the tables and history files.
+    with db.write() as conn:
+        analytics.snapshot_changed(conn.cursor())
+        conn.commit()
+    analytics.get_snapshot.clear()
+
+
+def test_compaction_keeps_reports(history, bookeo):
+    expected = reports()
+    daily = rollup(history)
+    analytics.compact_history()
+    reload(history)
+
+    assert count(history, "SELECT COUNT(*) FROM bookings") == 0
+    assert count(history, "SELECT COUNT(*) FROM participants") == 0
+    assert count(history, "SELECT SUM(bookings) FROM historyPartitions") == bookeo.n
+    assert count(history, "SELECT COUNT(*) FROM historyBookings") == bookeo.n
+    # A file per local month, the first of them New Year's Eve alone
+    months = count(history, "SELECT COUNT(DISTINCT month) FROM historyPartitions")
+    assert months == count(history, "SELECT COUNT(*) FROM historyPartitions") == 6
+    assert_same(reports(), expected)
+    assert rollup(history) == daily
+
+    # Recomputed from the history files, all at once or a few days at a time
+    with history.write() as conn:
+        analytics.refresh_rollup(conn.cursor())
+        conn.commit()
+    assert rollup(history) == daily
+    with history.write() as conn:
+        analytics.refresh_rollup(conn.cursor(), {"2024-02-29", "2024-03-01"})
+        conn.commit()
+    assert rollup(history) == daily
+
+    # Compacting again changes nothing
+    analytics.compact_history()
+    assert count(history, "SELECT COUNT(*) FROM historyPartitions") == 6
+    assert rollup(history) == daily
+
+
+def test_changed_booking_thaws_its_month(history, bookeo):
+    analytics.compact_history()
+    reload(history)
+    i = next(
+        i for i in range(bookeo.n // 2, bookeo.n) if not bookeo.booking(i)["canceled"]
+    )
+    booking = bookeo.booking(i)
+    start = analytics.to_epoch(booking["startTime"])
+    day = dt.date.fromisoformat(analytics.local_day(start))
+    month = day.strftime("%Y-%m")
+    before = analytics.get_report(day, day)
+
+    # Canceled since, and synced like any other change
+    bookeo.changed[i] = (parse_zulu(booking["creationTime"]), True)
+    with history.write() as conn:
+        cur = conn.cursor()
+        days = analytics.ingest_bookings(cur, iter([[bookeo.booking(i)]]))
+        analytics.refresh_rollup(cur, days)
+        conn.commit()
+    reload(history)
+
+    with history.read() as conn:
+        remaining = [m for (m,) in conn.execute("SELECT month FROM historyPartitions")]
+        (canceled,) = conn.execute(
+            "SELECT canceled FROM bookings WHERE id=?", (booking["bookingNumber"],)
+        ).fetchone()
+        months = {
+            analytics.local_day(t)[:7]
+            for (t,) in conn.execute("SELECT startTime FROM bookings")
+        }
+    assert month not in remaining and len(remaining) == 5
+    assert months == {month}
+    assert canceled
+    report = analytics.get_report(day, day)
+    slots = len(booking["participants"]["details"])
+    assert report["slots_run"] == before["slots_run"] - slots
+    daily = rollup(history)
+    with history.write() as conn:
+        analytics.refresh_rollup(conn.cursor())
+        conn.commit()
+    assert rollup(history) == daily
+
+    # The next compaction moves the month back out, change and all
+    analytics.compact_history()
+    reload(history)
+    assert count(history, "SELECT COUNT(*) FROM bookings") == 0
+    assert analytics.get_report(day, day) == report
+
+
+def test_validation_counts_compacted(history, bookeo, bookeo_server):
+    analytics.compact_history()
+    with history.write() as conn:
+        analytics.create_staging(conn)
+        problem = analytics.validate_staging(conn.cursor())
+        analytics.drop_staging(conn)
+    assert problem == f"only 0 rows downloaded for bookings, which has {bookeo.n}"
+
+    # A full download has every compacted booking, and starts history over
+    analytics.update_bookings(full_resync=True)
+    assert count(history, "SELECT COUNT(*) FROM bookings") == bookeo.n
+    assert count(history, "SELECT COUNT(*) FROM historyPartitions") == 0
+    assert count(history, "SELECT COUNT(*) FROM historyBookings") == 0
+
+
+def test_migration_thaws_history(history, bookeo):
+    expected = reports()
+    # A PID too long to be one, from before migration 10 cleared them
+    with history.write() as conn:
+        conn.execute(
+            """UPDATE participants SET pid=1234567890 WHERE rowid=(
+            SELECT MIN(rowid) FROM participants WHERE NOT onCampus)"""
+        )
+        conn.commit()
+    analytics.compact_history()
+    with history.write() as conn:
+        conn.execute("PRAGMA user_version = 9")
+        conn.commit()
+    history.close()
+    clear_caches()
+    db = analytics.get_db()
+    try:
+        assert count(db, "PRAGMA user_version") == len(analytics.MIGRATIONS)
+        assert count(db, "SELECT COUNT(*) FROM bookings") == bookeo.n
+        assert count(db, "SELECT COUNT(*) FROM historyPartitions") == 0
+        assert count(db, "SELECT COUNT(*) FROM participants WHERE pid > 999999999") == 0
+        assert_same(reports(), expected)
+    finally:
+        db.close()
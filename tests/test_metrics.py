@@ -0,0 +1,50 @@
+import json
+
+from metrics import Registry
+
+
+def snapshots(path) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_jsonl_once_per_interval(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    registry = Registry()
+    registry.inc("renders_total")
+    for _ in range(5):
+        registry.export(path)
+    assert len(snapshots(path)) == 1
+
+    registry.inc("renders_total")
+    registry.export(path, force=True)
+    assert [s["counters"][0]["value"] for s in snapshots(path)] == [1, 2]
+
+    registry.export(path, interval=0)
+    assert len(snapshots(path)) == 3
+
+
+def test_jsonl_rotated(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    registry = Registry()
+    for n in range(20):
+        registry.inc("http_requests_total", endpoint=f"/endpoint/{n}")
+    registry.export(path, force=True, max_bytes=1000)
+    size = len(open(path).read())
+    assert size > 1000
+    registry.export(path, force=True, max_bytes=1000)
+    registry.export(path, force=True, max_bytes=1000)
+    assert len(snapshots(path)) == 1
+    assert len(snapshots(f"{path}.1")) == 1
+    assert not (tmp_path / "metrics.jsonl.2").exists()
+
+
+def test_prometheus_replaced(tmp_path):
+    path = str(tmp_path / "metrics.prom")
+    registry = Registry()
+    registry.observe("report_duration_seconds", 0.003, function="get_report")
+    registry.export(path)
+    registry.export(path)
+    text = open(path).read()
+    assert text.count("report_duration_seconds_count") == 1
+    assert 'le="0.005"' in text
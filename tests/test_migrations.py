@@ -0,0 +1,55 @@
+import sqlite3
+
+import analytics
+from conftest import clear_caches, ingest
+
+# The tables the app created before schema versions, which it emptied on
+# every start
+LEGACY_SCHEMA = """
+CREATE TABLE bookings (id INT PRIMARY KEY, eventId INT NOT NULL,
+    startTime TEXT NOT NULL, endTime TEXT NOT NULL, customerId TEXT,
+    title TEXT, canceled INT NOT NULL, accepted INT NOT NULL, sourceIP TEXT,
+    creationTime TEXT NOT NULL, privateEvent INT NOT NULL,
+    noShow INT NOT NULL, productId TEXT NOT NULL, creationAgent TEXT);
+CREATE TABLE peopleCategories (id TEXT PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE participants (bookingId INT NOT NULL, firstName TEXT,
+    lastName TEXT, peopleCategory TEXT);
+CREATE TABLE products (id TEXT PRIMARY KEY, name TEXT);
+INSERT INTO participants VALUES (1, 'Ada', 'Lovelace', 'Cadults');
+"""
+
+
+def columns(conn, table: str) -> list[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def test_legacy_file_starts_over(tmp_path, monkeypatch):
+    path = tmp_path / "db.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+    monkeypatch.setenv("DATABASE", str(path))
+    clear_caches()
+    db = analytics.init_db()
+    try:
+        with db.read() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            assert version == len(analytics.MIGRATIONS)
+            assert "pid" in columns(conn, "participants")
+            assert conn.execute("SELECT COUNT(*) FROM participants").fetchone() == (0,)
+            assert conn.execute("SELECT COUNT(*) FROM onCampusPids").fetchone() == (0,)
+    finally:
+        db.close()
+
+
+def test_data_kept_across_restarts(database, bookeo):
+    ingest(database, bookeo)
+    with database.read() as conn:
+        before = conn.execute("SELECT COUNT(*) FROM bookings").fetchone()
+    database.close()
+    db = analytics.init_db()
+    try:
+        with db.read() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM bookings").fetchone() == before
+    finally:
+        db.close()
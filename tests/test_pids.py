@@ -0,0 +1,80 @@
+import pytest
+
+import analytics
+from conftest import ingest
+
+
+@pytest.mark.parametrize(
+    "value, pid",
+    [
+        ("730123456", 730123456),
+        (" 730-123-456 ", 730123456),
+        ("730 123 456", 730123456),
+        ("730 123-456", 730123456),
+        (730123456, 730123456),
+        ("PID: 730123456.", 730123456),
+        ("730123456.0", 730123456),
+        ("730123456 / 730-123-456", 730123456),
+        ("730123456 or (919) 555-1234", 730123456),
+        # Several PIDs, or none
+        ("730-123-456, 730-654-321, 730-111-222", None),
+        ("730123456 730654321", None),
+        ("(919) 555-1234", None),
+        ("919-555-1234", None),
+        ("9195551234", None),
+        ("7" * 40, None),
+        ("730-123-4567", None),
+        ("730 123 4567", None),
+        ("919 555 1234", None),
+        ("", None),
+        ("N/A", None),
+        (None, None),
+    ],
+)
+def test_normalize_pid(value, pid):
+    assert analytics.normalize_pid(value) == pid
+
+
+def test_ingest_free_text_pids(database, bookeo, monkeypatch):
+    # Text with many digits in it is stored without a PID, rather than
+    # failing the whole sync
+    values = iter(
+        ["730-123-456, 730-654-321, 730-111-222", "9" * 30, "730123456 or 919-555-1234"]
+    )
+    booking = bookeo.booking
+
+    def with_free_text(i: int) -> dict:
+        data = booking(i)
+        if i < 3:
+            fields = data["participants"]["details"][0]["personDetails"]
+            fields["customFields"][0]["value"] = next(values)
+        return data
+
+    monkeypatch.setattr(bookeo, "booking", with_free_text)
+    ingest(database, bookeo)
+    with database.read() as conn:
+        pids = conn.execute(
+            """SELECT p.pid FROM participants p JOIN bookings b ON b.id=p.bookingId
+            WHERE b.title IN ('Booking 0', 'Booking 1', 'Booking 2')
+            AND p.rowid IN (SELECT MIN(rowid) FROM participants GROUP BY bookingId)
+            ORDER BY b.title"""
+        ).fetchall()
+        longest = conn.execute("SELECT MAX(pid) FROM participants").fetchone()[0]
+    assert pids == [(None,), (None,), (730123456,)]
+    assert longest <= 999_999_999
+
+
+def test_migration_clears_glued_pids(database):
+    with database.write() as conn:
+        conn.execute("INSERT INTO onCampusPids (pid) VALUES (730123456730654321)")
+        conn.execute(
+            """INSERT INTO participants (bookingId, pid, onCampus)
+            VALUES (1, 730123456730654321, 1), (1, 730123456, 0)"""
+        )
+        conn.execute("PRAGMA user_version = 9")
+        conn.commit()
+        analytics.migrate_db(conn)
+        rows = conn.execute("SELECT pid, onCampus FROM participants").fetchall()
+        roster = conn.execute("SELECT pid FROM onCampusPids").fetchall()
+    assert sorted(rows, key=str) == [(730123456, 0), (None, 0)]
+    assert roster == []
@@ -0,0 +1,73 @@
+import datetime as dt
+import re
+
+import analytics
+from conftest import ingest
+
+# A full pass over one of the big tables, by name or by the report
+# queries' aliases, or an index SQLite builds on the fly for want of one
+FULL_SCAN = re.compile(r"^SCAN (bookings|participants|b|p)\b|AUTOMATIC")
+
+
+def traced(conn, run) -> list[str]:
+    # The statements run(conn) executes on conn, with parameters inlined
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        run(conn)
+    finally:
+        conn.set_trace_callback(None)
+    return statements
+
+
+def plan(conn, sql: str) -> list[str]:
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+def test_rollup_uses_covering_indexes(database, bookeo):
+    ingest(database, bookeo)
+    with database.write() as conn:
+        conn.execute("ANALYZE")
+        statements = traced(
+            conn,
+            lambda conn: analytics.refresh_rollup(
+                conn.cursor(), {"2024-02-01", "2024-02-02"}
+            ),
+        )
+        inserts = [s for s in statements if s.startswith("INSERT INTO dailyRollup")]
+        assert inserts
+        for sql in inserts:
+            steps = plan(conn, sql)
+            assert not [s for s in steps if FULL_SCAN.search(s)], steps
+            assert any(
+                re.match(r"SEARCH b USING COVERING INDEX bookingsBy(Start|Creation)", s)
+                for s in steps
+            ), steps
+            assert any(
+                s.startswith("SEARCH p USING") and "participantsByBooking" in s
+                for s in steps
+            ), steps
+        conn.rollback()
+
+
+def test_trend_searches_rollup(database, bookeo):
+    ingest(database, bookeo)
+    with database.write() as conn:
+        analytics.refresh_rollup(conn.cursor())
+        conn.commit()
+        conn.execute("ANALYZE")
+    with database.read() as conn:
+        statements = traced(
+            conn,
+            lambda conn: analytics.get_trend(
+                dt.date(2024, 2, 1),
+                dt.date(2024, 3, 1),
+                "Week",
+                product=["Heist"],
+                pricingcat=["Adult"],
+            ),
+        )
+        (sql,) = [s for s in statements if "FROM dailyRollup" in s]
+        steps = plan(conn, sql)
+    assert "SEARCH dailyRollup USING PRIMARY KEY (day>? AND day<?)" in steps
+    assert not [s for s in steps if FULL_SCAN.search(s)], steps
@@ -0,0 +1,154 @@
+import datetime as dt
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import refresh
+from refresh import RefreshCoordinator
+
+
+class SlowRefresh:
+    # A refresh that signals started, then holds until released, recording
+    # the arguments of each run. Fails while error is set.
+    __name__ = "slow_refresh"
+
+    def __init__(self):
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.error = None
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        self.started.set()
+        assert self.release.wait(10)
+        if self.error:
+            raise self.error
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Monotonic time that only moves when the test says, and wall time
+    # that follows it
+    now = SimpleNamespace(value=1000.0)
+    fake = SimpleNamespace(
+        monotonic=lambda: now.value,
+        time=lambda: 1_700_000_000 + now.value,
+        perf_counter=time.perf_counter,
+    )
+    monkeypatch.setattr(refresh, "time", fake)
+    return now
+
+
+def callers(n: int, fn) -> list[threading.Thread]:
+    threads = [threading.Thread(target=fn, daemon=True) for _ in range(n)]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def test_single_flight(clock):
+    slow = SlowRefresh()
+    coordinator = RefreshCoordinator(slow, dt.timedelta(minutes=5))
+    returned = []
+    threads = callers(8, lambda: returned.append(coordinator.refresh()))
+    assert slow.started.wait(10)
+    time.sleep(0.05)
+    # Everyone waits on the one run in flight
+    assert coordinator.refreshing
+    assert returned == []
+    slow.release.set()
+    for t in threads:
+        t.join(10)
+    assert len(returned) == 8
+    assert slow.calls == [{}]
+    assert not coordinator.refreshing
+
+    # Fresh until max_age has passed
+    clock.value += 299
+    coordinator.refresh()
+    assert len(slow.calls) == 1
+    clock.value += 2
+    coordinator.refresh()
+    assert len(slow.calls) == 2
+
+
+def test_stale_data_served_without_waiting(clock):
+    slow = SlowRefresh()
+    # Synced an hour ago by an earlier process
+    coordinator = RefreshCoordinator(
+        slow,
+        dt.timedelta(minutes=5),
+        last_synced=lambda: refresh.time.time() - 3600,
+    )
+    coordinator.refresh(wait=False)
+    # Returned with the run still held
+    assert slow.started.wait(10)
+    assert coordinator.refreshing
+    assert not slow.release.is_set()
+    coordinator.refresh(wait=False)
+    assert slow.calls == [{}]
+    slow.release.set()
+    coordinator.refresh()
+    assert slow.calls == [{}]
+
+
+def test_cold_start_blocks(clock):
+    slow = SlowRefresh()
+    coordinator = RefreshCoordinator(slow, dt.timedelta(minutes=5))
+    returned = []
+    threads = callers(3, lambda: returned.append(coordinator.refresh(wait=False)))
+    assert slow.started.wait(10)
+    time.sleep(0.05)
+    # Nothing loaded yet, so wait=False waits too
+    assert returned == []
+    slow.release.set()
+    for t in threads:
+        t.join(10)
+    assert len(returned) == 3
+    assert slow.calls == [{}]
+
+
+def test_force_runs_after_joining_flight(clock):
+    slow = SlowRefresh()
+    coordinator = RefreshCoordinator(slow, dt.timedelta(minutes=5))
+    threads = callers(1, coordinator.refresh)
+    assert slow.started.wait(10)
+    forced = callers(2, lambda: coordinator.refresh(force=True, full_resync=True))
+    time.sleep(0.05)
+    assert slow.calls == [{}]
+    slow.release.set()
+    for t in threads + forced:
+        t.join(10)
+    # The flight joined ran without the forced arguments, so each forced
+    # caller ran again with them, one at a time
+    assert slow.calls == [{}, {"full_resync": True}, {"full_resync": True}]
+
+
+def test_retry_after_failure(clock, capsys):
+    slow = SlowRefresh()
+    slow.release.set()
+    slow.error = RuntimeError("Bookeo is down")
+    coordinator = RefreshCoordinator(
+        slow, dt.timedelta(minutes=5), retry_after=dt.timedelta(minutes=1)
+    )
+    coordinator.refresh()
+    assert coordinator.last_error is slow.error
+    assert coordinator.last_refresh is None
+    assert "Bookeo is down" in capsys.readouterr().out
+
+    # Not tried again until retry_after, unless forced
+    clock.value += 59
+    for t in callers(4, coordinator.refresh):
+        t.join(10)
+    assert len(slow.calls) == 1
+    coordinator.refresh(force=True)
+    assert len(slow.calls) == 2
+    clock.value += 61
+    slow.error = None
+    coordinator.refresh()
+    assert len(slow.calls) == 3
+    assert coordinator.last_error is None
+    assert coordinator.last_refresh == clock.value
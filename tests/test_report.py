@@ -0,0 +1,125 @@
+import datetime as dt
+import json
+import random
+
+import pandas as pd
+import pytest
+
+import analytics
+import snapshot
+from conftest import ingest
+from synthetic import PEOPLE_CATEGORIES, PRODUCTS
+
+FILTERS = [
+    {},
+    {"product": ["Heist", "Submarine"]},
+    {"pricingcat": ["Student"]},
+    {"groupcat": ["Birthday", "Corporate"]},
+    {"product": ["Mystery Manor"], "pricingcat": ["Adult", "Child"]},
+    {"product": ["Heist"], "groupcat": ["Friends/Family"], "pricingcat": ["Adult"]},
+]
+
+
+def reference(
+    db, start: dt.date, end: dt.date, options: dict, segment: str = None
+) -> pd.DataFrame:
+    # The report as a plain SQL count over every booking, per segment name
+    first, last = analytics.day_range(start, end)
+    params = {"first": first, "last": last}
+    filters = ""
+    categories = ""
+    for option, table, column in (
+        ("product", "products", "b.productId"),
+        ("groupcat", "groupCategories", "b.groupCategory"),
+    ):
+        if options.get(option):
+            filters += f"""AND {column} IN (SELECT id FROM {table}
+                WHERE name IN (SELECT value FROM json_each(:{option})))"""
+            params[option] = json.dumps(options[option])
+    if options.get("pricingcat"):
+        categories = """AND p.peopleCategory IN (SELECT id FROM peopleCategories
+            WHERE name IN (SELECT value FROM json_each(:pricingcat)))"""
+        params["pricingcat"] = json.dumps(options["pricingcat"])
+    if segment:
+        column, table = analytics.SEGMENTS[segment]
+        name = f"""COALESCE((SELECT name FROM {table} WHERE id=b.{column}),
+            '{analytics.UNSPECIFIED}')"""
+    else:
+        name = "NULL"
+    q = f"""SELECT segment,
+        COUNT(DISTINCT CASE WHEN booked THEN creationTime END) AS rooms_booked,
+        SUM(CASE WHEN booked THEN slots ELSE 0 END) AS slots_booked,
+        COUNT(DISTINCT CASE WHEN run THEN startTime END) AS rooms_run,
+        SUM(CASE WHEN run THEN slots ELSE 0 END) AS slots_run,
+        SUM(CASE WHEN booked THEN onCampus ELSE 0 END) AS on_campus_booked,
+        SUM(CASE WHEN run THEN onCampus ELSE 0 END) AS on_campus_run
+        FROM (
+            SELECT {name} AS segment, b.creationTime, b.startTime,
+            b.creationTime >= :first AND b.creationTime < :last AS booked,
+            b.startTime >= :first AND b.startTime < :last AS run,
+            COUNT(p.bookingId) AS slots,
+            COALESCE(SUM(p.onCampus), 0) AS onCampus
+            FROM bookings b
+            LEFT JOIN participants p ON p.bookingId=b.id {categories}
+            WHERE NOT b.canceled {filters}
+            GROUP BY b.id
+            HAVING (booked OR run) {"AND slots > 0" if categories else ""}
+        )
+        GROUP BY segment
+        ORDER BY segment"""
+    with db.read() as conn:
+        result = pd.read_sql_query(q, conn, params=params, index_col="segment")
+    if segment:
+        result.index.name = segment
+    return result
+
+
+@pytest.fixture
+def reports(database, bookeo, monkeypatch):
+    # The synthetic bookings with a roster, and checkpoints every few dozen
+    # bookings, so most ranges have some inside them
+    monkeypatch.setattr(snapshot, "CHECKPOINT_EVERY", 50)
+    ingest(database, bookeo)
+    with database.write() as conn:
+        conn.executemany("INSERT INTO products (name, id) VALUES (?, ?)", PRODUCTS)
+        conn.executemany(
+            "INSERT INTO peopleCategories (id, name) VALUES (:id, :name)",
+            PEOPLE_CATEGORIES,
+        )
+        analytics.snapshot_changed(conn.cursor())
+        conn.commit()
+    analytics.load_roster(bookeo.roster_csv())
+    return database
+
+
+def ranges() -> list[tuple[dt.date, dt.date]]:
+    rng = random.Random(7)
+    base = dt.date(2023, 12, 1)
+    days = [
+        sorted(base + dt.timedelta(days=rng.randrange(200)) for _ in range(2))
+        for _ in range(8)
+    ]
+    return [(base, dt.date(2024, 7, 1)), (dt.date(2024, 3, 10),) * 2, *days]
+
+
+@pytest.mark.parametrize("options", FILTERS)
+def test_report_matches_sql(reports, options):
+    for start, end in ranges():
+        expected = reference(reports, start, end, options)
+        if len(expected):
+            expected = expected.iloc[0].to_dict()
+        else:
+            expected = dict.fromkeys(analytics.REPORT_METRICS, 0)
+        report = analytics.get_report(start, end, **options)
+        assert report == expected, (start, end)
+
+
+@pytest.mark.parametrize("segment", analytics.SEGMENTS)
+@pytest.mark.parametrize("options", FILTERS[:4])
+def test_segments_match_sql(reports, segment, options):
+    for start, end in ranges():
+        expected = reference(reports, start, end, options, segment)
+        segments = analytics.get_segments(start, end, segment, **options)
+        pd.testing.assert_frame_equal(
+            segments, expected.sort_index(), check_dtype=False
+        )
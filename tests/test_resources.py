@@ -0,0 +1,75 @@
+import threading
+
+from resources import normalize_options, versioned_cache
+
+
+class Report:
+    # A report function over a generation counter, recording each call it
+    # wasn't cached for. Calls for a start in gates signal the first event
+    # and wait for the second before computing.
+    def __init__(self):
+        self.generation = 0
+        self.calls = []
+        self.gates = {}
+        self.get = versioned_cache(lambda: self.generation, maxsize=8)(self.run)
+
+    def run(self, start: int, **options) -> dict:
+        if start in self.gates:
+            started, release = self.gates[start]
+            started.set()
+            release.wait()
+        self.calls.append((start, options))
+        return {"start": start, "generation": self.generation, **options}
+
+
+def test_options_compared_as_sets():
+    report = Report()
+    first = report.get(1, product=["Heist", "Submarine"], groupcat=None)
+    assert report.get(1, product=["Submarine", "Heist", "Heist"]) is first
+    assert report.get(1, product=("Heist", "Submarine"), pricingcat=[]) is first
+    assert report.get(1, pricingcat=[]) is report.get(1, pricingcat=None)
+    assert report.get(1) is report.get(1, product=[], groupcat=None)
+    assert len(report.calls) == 2
+    assert report.get(1, product=["Heist"]) is not first
+    assert report.get(2, product=["Heist", "Submarine"]) is not first
+    assert len(report.calls) == 4
+    assert normalize_options({"b": ["y", "x"], "a": [], "c": None, "d": 3}) == (
+        ("b", ("x", "y")),
+        ("d", 3),
+    )
+
+
+def test_generation_evicts():
+    report = Report()
+    first = report.get(1)
+    report.get(2)
+    report.generation += 1
+    again = report.get(1)
+    assert again is not first
+    assert again["generation"] == 1
+    # The older entries went with the generation, not just the one read
+    report.get(2)
+    assert [start for start, _ in report.calls] == [1, 2, 1, 2]
+    assert report.get(1) is again
+    report.get.clear()
+    assert report.get(1) is not again
+
+
+def test_stale_result_not_stored():
+    report = Report()
+    started, release = report.gates[1] = threading.Event(), threading.Event()
+    results = []
+    thread = threading.Thread(target=lambda: results.append(report.get(1)))
+    thread.start()
+    started.wait()
+    # The data changes while the report is computed, and another caller
+    # sees the new generation first
+    report.generation += 1
+    report.get(2)
+    release.set()
+    thread.join()
+    del report.gates[1]
+    # Computed under generation 0, so computed again rather than served
+    assert report.get(1) is not results[0]
+    assert [start for start, _ in report.calls] == [2, 1, 1]
+    assert report.get(1) is report.get(1)
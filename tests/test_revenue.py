@@ -0,0 +1,117 @@
+import datetime as dt
+import json
+import random
+import threading
+
+import analytics
+
+START, END = dt.date(2023, 12, 1), dt.date(2024, 3, 31)
+
+
+def net_sales(orders: list[dict], names: set[str] = None) -> int:
+    # Gross less discounts of the completed orders' lines and returns
+    total = 0
+    for o in orders:
+        if o["state"] != "COMPLETED":
+            continue
+        lines = [(1, li) for li in o["line_items"]]
+        for r in o.get("returns", []):
+            lines += [(-1, li) for li in r["return_line_items"]]
+        for sign, li in lines:
+            if names is None or li["name"] in names:
+                gross = li.get("gross_sales_money") or li["gross_return_money"]
+                total += sign * (gross["amount"] - li["total_discount_money"]["amount"])
+    return total
+
+
+def counts(db) -> tuple:
+    with db.read() as conn:
+        return conn.execute(
+            """SELECT (SELECT COUNT(*) FROM squareOrders),
+            (SELECT COUNT(*) FROM squarePayments),
+            (SELECT COUNT(*) FROM squareOrderLines WHERE quantity < 0),
+            (SELECT SUM(refunded) FROM dailyRevenue)"""
+        ).fetchone()
+
+
+def test_every_page_synced(database, square, square_server):
+    analytics.update_revenue()
+    orders = [square.order(i) for i in range(square.n)]
+    # Order search pages hold 500, so each window took several
+    assert counts(database)[:3] == (square.n, square.n, 0)
+    assert analytics.get_revenue(START, END) == net_sales(orders)
+    with database.read() as conn:
+        marks = [
+            analytics.get_sync_state(conn.cursor(), key)
+            for key in ("squareOrdersUpdated", "squarePaymentsUpdated")
+        ]
+    assert None not in marks
+
+
+def test_refunds_since_watermark(database, square, square_server, monkeypatch):
+    analytics.update_revenue()
+    before = analytics.get_revenue(START, END)
+    square.mutate(25, random.Random(3))
+    fetched = []
+    upsert = analytics.upsert_square_orders
+
+    def record(cur, orders):
+        fetched.extend(o["id"] for o in orders)
+        return upsert(cur, orders)
+
+    monkeypatch.setattr(analytics, "upsert_square_orders", record)
+    analytics.update_revenue()
+    # Only what changed since the last sync is downloaded again
+    assert sorted(fetched) == sorted(f"O{i}" for i in square.refunded)
+    refunded = [square.order(i) for i in square.refunded]
+    payments = [square.payment(i) for i in square.refunded]
+    orders, _, returns, refunds = counts(database)
+    assert orders == square.n
+    assert returns == len(refunded)
+    assert refunds == sum(
+        p["refunded_money"]["amount"] for p in payments if p["status"] == "COMPLETED"
+    )
+    expected = before + sum(
+        net_sales([o]) - net_sales([{**o, "returns": []}]) for o in refunded
+    )
+    assert expected < before
+    assert analytics.get_revenue(START, END) == expected
+
+
+def test_product_and_category_filters(database, square, square_server, monkeypatch):
+    analytics.update_revenue()
+    orders = [square.order(i) for i in range(square.n)]
+    heist = analytics.get_revenue(START, END, product=["Heist"])
+    assert heist == net_sales(orders, {"Heist"})
+    # A Bookeo product sold under other Square item names
+    monkeypatch.setenv("SQUARE_ITEMS", json.dumps({"Heist": ["Heist", "Submarine"]}))
+    analytics.get_revenue.clear()
+    assert analytics.get_revenue(START, END, product=["Heist"]) == net_sales(
+        orders, {"Heist", "Submarine"}
+    )
+    # Square sales have no people or group categories
+    assert analytics.get_revenue(START, END, pricingcat=["Adult"]) is None
+    assert analytics.get_revenue(START, END, groupcat=["Birthday"]) is None
+
+
+def test_download_outside_write(database, square_server, monkeypatch):
+    # Other syncs can write while Square pages download
+    writable = []
+    list_all = analytics.SquareClient.list_all
+
+    def check(self, *args):
+        thread = threading.Thread(target=analytics.mark_synced, args=("rosterFetched",))
+        thread.start()
+        thread.join(timeout=5)
+        writable.append(not thread.is_alive())
+        yield from list_all(self, *args)
+
+    monkeypatch.setattr(analytics.SquareClient, "list_all", check)
+    analytics.update_revenue()
+    assert writable == [True, True]
+
+
+def test_square_items_config(monkeypatch):
+    monkeypatch.setenv("SQUARE_ITEMS", "")
+    analytics.configure({"SQUARE_ITEMS": {"Heist": "The Heist"}})
+    assert analytics.square_items(["Heist", "Submarine"]) == ["The Heist", "Submarine"]
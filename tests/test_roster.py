@@ -0,0 +1,196 @@
+import base64
+import quopri
+
+import pytest
+
+import analytics
+from conftest import ingest
+from roster import fetch_latest_attachment, parse_list
+
+CSV = b"PID,First Name,Last Name\r\n730000001,Ada,Lovelace\r\n"
+TEXT_PART = b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1 NIL NIL NIL)'
+HTML_PART = b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" 30 1 NIL NIL NIL)'
+
+
+def csv_part(encoding: bytes = b"BASE64", filename: bytes = b'"roster.csv"') -> bytes:
+    return (
+        b'("TEXT" "CSV" NIL NIL NIL "' + encoding + b'" 80 2 NIL '
+        b'("ATTACHMENT" ("FILENAME" ' + filename + b")) NIL)"
+    )
+
+
+def multipart(*parts: bytes, subtype: bytes = b"MIXED") -> bytes:
+    return b"(" + b"".join(parts) + b' "' + subtype + b'" ("BOUNDARY" "b") NIL NIL)'
+
+
+class FakeIMAP:
+    # Answers search and fetch like imaplib.IMAP4 for a few messages, each
+    # a BODYSTRUCTURE response (a list of imaplib data items) and the raw
+    # payload of each of its sections
+    def __init__(self, messages: dict[bytes, tuple[list, dict[str, bytes]]]):
+        self.messages = messages
+        self.fetched = []
+
+    def search(self, charset, criteria: str):
+        return "OK", [b" ".join(self.messages)]
+
+    def fetch(self, id: bytes, parts: str):
+        self.fetched.append((id, parts))
+        structure, sections = self.messages[id]
+        if parts == "(BODYSTRUCTURE)":
+            return "OK", structure
+        section = parts[len("(BODY.PEEK[") : -len("])")]
+        payload = sections[section]
+        prefix = id + b" (BODY[" + section.encode() + b"] {%d}" % len(payload)
+        return "OK", [(prefix, payload), b")"]
+
+
+def structure(id: bytes, body: bytes) -> list:
+    return [id + b" (UID 7 BODYSTRUCTURE " + body + b")"]
+
+
+def test_parse_list():
+    parsed = parse_list(b'(1 "a \\"b\\"" NIL (x ()) "")')
+    assert parsed == [["1", 'a "b"', None, ["x", []], ""]]
+
+
+def test_nested_multipart():
+    body = multipart(
+        multipart(TEXT_PART, HTML_PART, subtype=b"ALTERNATIVE"), csv_part()
+    )
+    imap = FakeIMAP({b"1": (structure(b"1", body), {"2": base64.encodebytes(CSV)})})
+    assert fetch_latest_attachment(imap, "ALL") == CSV
+    assert imap.fetched[-1] == (b"1", "(BODY.PEEK[2])")
+
+
+def test_attachment_inside_nested_part():
+    body = multipart(multipart(TEXT_PART, csv_part()), HTML_PART)
+    imap = FakeIMAP({b"1": (structure(b"1", body), {"1.2": base64.encodebytes(CSV)})})
+    assert fetch_latest_attachment(imap, "ALL") == CSV
+
+
+def test_literal_filename():
+    # Servers send some strings as literals, which imaplib splits out
+    body = multipart(TEXT_PART, csv_part(filename=b"{10}"))
+    head, tail = body.split(b"{10}")
+    data = [
+        (b"1 (UID 7 BODYSTRUCTURE " + head + b"{10}", b"roster.csv"),
+        tail + b")",
+    ]
+    imap = FakeIMAP({b"1": (data, {"2": base64.encodebytes(CSV)})})
+    assert fetch_latest_attachment(imap, "ALL") == CSV
+
+
+def test_quoted_printable():
+    body = multipart(TEXT_PART, csv_part(b"QUOTED-PRINTABLE"))
+    payload = quopri.encodestring(CSV.replace(b"Ada", b"Ad\xc3\xa9"))
+    imap = FakeIMAP({b"1": (structure(b"1", body), {"2": payload})})
+    assert fetch_latest_attachment(imap, "ALL") == CSV.replace(b"Ada", b"Ad\xc3\xa9")
+
+
+def test_single_part_message():
+    imap = FakeIMAP({b"1": (structure(b"1", csv_part(b"7BIT")), {"1": CSV})})
+    assert fetch_latest_attachment(imap, "ALL") == CSV
+
+
+def test_newest_message_with_an_attachment():
+    imap = FakeIMAP(
+        {
+            b"1": (structure(b"1", multipart(TEXT_PART, csv_part())), {"2": b""}),
+            b"2": (
+                structure(b"2", multipart(TEXT_PART, csv_part(b"7BIT"))),
+                {"2": CSV},
+            ),
+            b"3": (structure(b"3", multipart(TEXT_PART, HTML_PART)), {}),
+        }
+    )
+    assert fetch_latest_attachment(imap, "ALL") == CSV
+    assert (b"1", "(BODYSTRUCTURE)") not in imap.fetched
+
+
+def test_no_attachment():
+    imap = FakeIMAP({b"1": (structure(b"1", multipart(TEXT_PART, HTML_PART)), {})})
+    assert fetch_latest_attachment(imap, "ALL") is None
+    assert fetch_latest_attachment(FakeIMAP({}), "ALL") is None
+
+
+def roster_csv(people: dict[int, tuple[str, str]]) -> bytes:
+    rows = "".join(f"{pid},{first},{last}\r\n" for pid, (first, last) in people.items())
+    return ("PID,First Name,Last Name\r\n" + rows).encode()
+
+
+def roster(db) -> dict[int, tuple[str, str]]:
+    with db.read() as conn:
+        rows = conn.execute("SELECT pid, firstName, lastName FROM onCampusPids")
+        return {pid: (first, last) for pid, first, last in rows}
+
+
+def generation(db) -> int:
+    with db.read() as conn:
+        return int(
+            conn.execute(
+                "SELECT value FROM syncState WHERE key='generation'"
+            ).fetchone()[0]
+        )
+
+
+@pytest.fixture
+def participants(database, bookeo) -> list[int]:
+    # The distinct PIDs of the participants of the synthetic bookings
+    ingest(database, bookeo)
+    with database.read() as conn:
+        rows = conn.execute("SELECT DISTINCT pid FROM participants ORDER BY pid")
+        return [pid for (pid,) in rows]
+
+
+def check_on_campus(db):
+    # Every participant's flag and the rollup agree with the roster
+    with db.read() as conn:
+        wrong = conn.execute(
+            """SELECT COUNT(*) FROM participants
+            WHERE onCampus != (pid IN (SELECT pid FROM onCampusPids))"""
+        ).fetchone()[0]
+        rollup = conn.execute(
+            "SELECT * FROM dailyRollup ORDER BY 1, 2, 3, 4"
+        ).fetchall()
+    assert wrong == 0
+    with db.write() as conn:
+        analytics.refresh_rollup(conn.cursor())
+        rebuilt = conn.execute(
+            "SELECT * FROM dailyRollup ORDER BY 1, 2, 3, 4"
+        ).fetchall()
+        conn.rollback()
+    assert rollup == rebuilt
+
+
+def test_roster_diff(database, participants):
+    a, b, c = participants[:3]
+    analytics.load_roster(roster_csv({a: ("A", "One"), b: ("B", "Two")}))
+    assert roster(database) == {a: ("A", "One"), b: ("B", "Two")}
+    check_on_campus(database)
+
+    # a leaves, b is renamed, c joins
+    analytics.load_roster(roster_csv({b: ("Bea", "Two"), c: ("C", "Three")}))
+    assert roster(database) == {b: ("Bea", "Two"), c: ("C", "Three")}
+    check_on_campus(database)
+
+
+def test_same_roster_skipped(database, participants):
+    data = roster_csv({participants[0]: ("A", "One")})
+    analytics.load_roster(data)
+    before = generation(database)
+    with database.write() as conn:
+        conn.execute("DELETE FROM onCampusPids")
+        conn.commit()
+    analytics.load_roster(data)
+    assert roster(database) == {}
+    assert generation(database) == before
+
+
+def test_unreadable_roster_ignored(database, participants):
+    analytics.load_roster(roster_csv({participants[0]: ("A", "One")}))
+    before = generation(database)
+    analytics.load_roster(b"Name,Email\r\nA,a@example.com\r\n")
+    assert roster(database) == {participants[0]: ("A", "One")}
+    assert generation(database) == before
+    check_on_campus(database)
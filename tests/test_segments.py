@@ -0,0 +1,93 @@
+from collections import Counter
+
+import pytest
+
+import analytics
+from conftest import ingest
+
+
+def booking(agent: str = None, **fields) -> dict:
+    return {
+        "creationAgent": agent,
+        "customFields": [
+            {"name": name.replace("_", " "), "value": value}
+            for name, value in fields.items()
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "data,expected",
+    [
+        (booking(Group_category="Birthday"), "Birthday"),
+        (booking(group_category="  Student   organization "), "Student organization"),
+        (booking(Group_category=""), analytics.UNSPECIFIED),
+        (booking(Group_category="   "), analytics.UNSPECIFIED),
+        (booking(Group_category=None), analytics.UNSPECIFIED),
+        (booking(Contact_method="Phone"), analytics.UNSPECIFIED),
+        ({}, analytics.UNSPECIFIED),
+        ({"customFields": None}, analytics.UNSPECIFIED),
+    ],
+)
+def test_group_category(data, expected):
+    assert analytics.extract_group_category(data) == expected
+
+
+@pytest.mark.parametrize(
+    "data,expected",
+    [
+        (booking("Sam", Contact_method="Walk-in"), "Walk-in"),
+        (booking("Sam", CONTACT_METHOD=" Email\t"), "Email"),
+        # Entered by staff without saying how the customer got in touch
+        (booking("Sam"), "Staff"),
+        (booking("Sam", Contact_method=""), "Staff"),
+        # Booked online, so no agent
+        (booking(), "Online"),
+        (booking(Group_category="Birthday"), "Online"),
+        (booking(Contact_method="Phone"), "Phone"),
+    ],
+)
+def test_contact_method(data, expected):
+    assert analytics.extract_contact_method(data) == expected
+
+
+def test_spellings_merged(database, bookeo):
+    ingest(database, bookeo)
+    with database.read() as conn:
+        names = {
+            table: dict(conn.execute(f"SELECT id, name FROM {table}").fetchall())
+            for _, table in analytics.SEGMENTS.values()
+        }
+        rows = conn.execute("SELECT groupCategory, contactMethod FROM bookings")
+        rows = rows.fetchall()
+    # "Friends/Family" and "friends/family " are one category, and blanks
+    # are Unspecified
+    assert sorted(n.casefold() for n in names["groupCategories"].values()) == [
+        "birthday",
+        "corporate",
+        "friends/family",
+        "student organization",
+        "unspecified",
+    ]
+    assert sorted(names["contactMethods"].values()) == [
+        "Email",
+        "Online",
+        "Phone",
+        "Walk-in",
+    ]
+
+    expected = Counter()
+    for i in range(bookeo.n):
+        data = bookeo.booking(i)
+        expected[
+            analytics.extract_group_category(data).casefold(),
+            analytics.extract_contact_method(data),
+        ] += 1
+    stored = Counter(
+        (
+            names["groupCategories"][group].casefold(),
+            names["contactMethods"][contact],
+        )
+        for group, contact in rows
+    )
+    assert stored == expected
@@ -0,0 +1,109 @@
+import datetime as dt
+import threading
+import time
+
+import pytest
+
+import analytics
+from conftest import ingest
+
+START, END = dt.date(2024, 1, 1), dt.date(2024, 5, 31)
+
+
+def roster_csv(people: list[int]) -> bytes:
+    lines = ["PID,First Name,Last Name"] + [f"{pid},A,B" for pid in people]
+    return "\r\n".join(lines).encode() + b"\r\n"
+
+
+def cancel_half(db):
+    # A sync that cancels every other booking
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE bookings SET canceled=1 WHERE id % 2 = 0")
+        analytics.refresh_rollup(cur)
+        analytics.snapshot_changed(cur)
+        analytics.set_sync_state(cur, "bookingsLastUpdated", "2024-06-01T00:00:00Z")
+        conn.commit()
+
+
+def wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_marks_leave_snapshot(database, bookeo):
+    ingest(database, bookeo)
+    before = analytics.get_snapshot_generation()
+    generation = analytics.get_generation()
+    analytics.mark_synced("settingsSynced")
+    with database.write() as conn:
+        cur = conn.cursor()
+        analytics.set_sync_state(cur, "squareOrdersLastUpdated", "2024-06-01T00:00:00Z")
+        analytics.set_sync_state(cur, "peopleCategoriesETag", '"abc"')
+        conn.commit()
+    assert analytics.get_generation() > generation
+    assert analytics.get_snapshot_generation() == before
+
+    with database.read() as conn:
+        pids = [pid for (pid,) in conn.execute("SELECT DISTINCT pid FROM participants")]
+    analytics.load_roster(roster_csv(pids[:2]))
+    assert analytics.get_snapshot_generation() == before + 1
+    # The same PIDs under other names: nothing the snapshot holds changed
+    analytics.load_roster(roster_csv(pids[:2]).replace(b",A,B", b",C,D"))
+    assert analytics.get_snapshot_generation() == before + 1
+
+
+def test_reload_in_background(database, bookeo, monkeypatch):
+    ingest(database, bookeo)
+    old = analytics.get_snapshot()
+    report = analytics.get_report(START, END)
+
+    release = threading.Event()
+    load_snapshot = analytics.load_snapshot
+
+    def slow_load():
+        release.wait()
+        return load_snapshot()
+
+    monkeypatch.setattr(analytics, "load_snapshot", slow_load)
+    cancel_half(database)
+    # The previous snapshot and its reports are served while the next loads
+    assert analytics.get_snapshot() is old
+    assert analytics.get_report(START, END) == report
+
+    release.set()
+    wait_for(lambda: analytics.get_snapshot() is not old)
+    assert analytics.get_snapshot.generation() == analytics.get_snapshot_generation()
+    reloaded = analytics.get_report(START, END)
+    assert reloaded["rooms_booked"] < report["rooms_booked"]
+    analytics.get_snapshot.clear()
+    analytics.get_report.clear()
+    assert analytics.get_report(START, END) == reloaded
+
+
+def test_failed_loads(database, bookeo, monkeypatch):
+    ingest(database, bookeo)
+    load_snapshot = analytics.load_snapshot
+    failures = []
+
+    def failing_load():
+        failures.append(time.monotonic())
+        raise OSError("history file missing")
+
+    monkeypatch.setattr(analytics, "load_snapshot", failing_load)
+    # Nothing to serve, so the error reaches the caller
+    with pytest.raises(OSError):
+        analytics.get_snapshot()
+
+    monkeypatch.setattr(analytics, "load_snapshot", load_snapshot)
+    old = analytics.get_snapshot()
+    monkeypatch.setattr(analytics, "load_snapshot", failing_load)
+    cancel_half(database)
+    # The previous snapshot is kept, and the next request tries again
+    assert analytics.get_snapshot() is old
+    wait_for(lambda: len(failures) == 2)
+    assert analytics.get_snapshot() is old
+    monkeypatch.setattr(analytics, "load_snapshot", load_snapshot)
+    wait_for(lambda: analytics.get_snapshot() is not old)
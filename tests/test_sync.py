@@ -0,0 +1,80 @@
+import datetime as dt
+
+import pytest
+import requests
+
+import analytics
+from synthetic import SyntheticBookeo
+
+
+class Shrinking(SyntheticBookeo):
+    # Bookings changed by mutate() also lose all but their first participant
+    def booking(self, i: int) -> dict:
+        booking = super().booking(i)
+        if i in self.changed:
+            details = booking["participants"]["details"]
+            booking["participants"]["details"] = details[:1]
+        return booking
+
+
+@pytest.fixture
+def bookeo():
+    return Shrinking(2000, start=dt.date(2024, 1, 1), end=dt.date(2024, 6, 1))
+
+
+def table(db, q: str, *params) -> list[tuple]:
+    with db.read() as conn:
+        return conn.execute(q, params).fetchall()
+
+
+def sync_mark(db) -> str:
+    return table(db, "SELECT value FROM syncState WHERE key=?", "bookingsLastUpdated")[
+        0
+    ][0]
+
+
+def test_incremental_sync_upserts(database, bookeo, bookeo_server):
+    analytics.update_bookings()
+    participants = dict(
+        table(database, "SELECT bookingId, COUNT(*) FROM participants GROUP BY 1")
+    )
+    # Synced an hour ago, so the changes below fall in the next sync's window
+    mark = sync_mark(database)
+    earlier = dt.datetime.strptime(mark, analytics.ZULU_FORMAT) - dt.timedelta(hours=1)
+    with database.write() as conn:
+        analytics.set_sync_state(
+            conn.cursor(),
+            "bookingsLastUpdated",
+            earlier.strftime(analytics.ZULU_FORMAT),
+        )
+        conn.commit()
+
+    res = requests.post(f"{bookeo_server.url}/_mutate?count=40&seed=1")
+    assert res.json() == {"mutated": 40}
+    analytics.update_bookings()
+
+    assert sync_mark(database) >= mark
+    assert table(database, "SELECT COUNT(*) FROM bookings") == [(bookeo.n,)]
+    for i, (_, canceled) in bookeo.changed.items():
+        id = int(bookeo.booking(i)["bookingNumber"])
+        # Updated in place, with its participants replaced rather than added to
+        assert table(database, "SELECT canceled FROM bookings WHERE id=?", id) == [
+            (canceled,)
+        ]
+        assert table(
+            database, "SELECT COUNT(*) FROM participants WHERE bookingId=?", id
+        ) == [(1,)]
+        del participants[id]
+    unchanged = dict(
+        table(database, "SELECT bookingId, COUNT(*) FROM participants GROUP BY 1")
+    )
+    assert {id: unchanged[id] for id in participants} == participants
+    assert len(unchanged) == bookeo.n
+
+    # The days the sync refreshed leave the rollup as a full rebuild would
+    rollup = "SELECT * FROM dailyRollup ORDER BY 1, 2, 3, 4"
+    daily = table(database, rollup)
+    with database.write() as conn:
+        analytics.refresh_rollup(conn.cursor())
+        conn.commit()
+    assert table(database, rollup) == daily